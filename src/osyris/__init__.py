@@ -4,5 +4,8 @@
 # flake8: noqa
 
 from .config import config, units
-from .plot import histogram1d, histogram2d, plane, scatter, map, plot
-from .core import Array, Datagroup, Dataset, Plot
+from .plot import (histogram1d, histogram2d, plane, scatter, map, map_many, plot,
+                   animate, CameraPath, timeseries, rasterize, write_image, Histogram1D,
+                   Histogram2D, Camera, TransferFunction, volume_render)
+from .core import Array, Datagroup, Dataset, LazyArray, Plot
+from .analysis import deposit, fof, profile
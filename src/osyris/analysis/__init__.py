@@ -0,0 +1,8 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (c) 2022 Osyris contributors (https://github.com/nvaytet/osyris)
+
+# flake8: noqa
+
+from .profile import profile
+from .deposit import deposit
+from .fof import fof
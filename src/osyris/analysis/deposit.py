@@ -0,0 +1,413 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (c) 2022 Osyris contributors (https://github.com/nvaytet/osyris)
+
+import weakref
+import numpy as np
+from numba import get_num_threads, njit, prange
+from typing import Union
+from ..core import Array
+from ..core.spatial import KDTree
+from ..plot.utils import sort_buckets
+from .profile import _magnitude, _position
+
+# Mass assignment schemes: nearest grid point, cloud in cell, triangular shaped
+# cloud, and a cubic spline SPH kernel with a per-particle smoothing length
+KERNELS = {"ngp": 0, "cic": 1, "tsc": 2, "sph": 3}
+
+# The distance, in voxels, beyond which the voxels touched by a particle may be
+# outside of a grid which just contains the particle (the SPH kernel reaches the
+# smoothing length instead)
+_SUPPORT = {"ngp": 0.0, "cic": 0.5, "tsc": 1.0, "sph": 0.0}
+
+# Number of samples of the tabulated SPH kernels
+_TABLE_SIZE = 257
+
+# Smoothing lengths of the particle groups, with the group versions
+_smoothing = weakref.WeakKeyDictionary()
+
+
+def _spline(q):
+    """
+    The cubic spline kernel, with a support of radius 1, up to normalization.
+    """
+    q = np.asarray(q, dtype=np.float64)
+    return np.where(q < 0.5, 1.0 - 6.0 * q**2 + 6.0 * q**3,
+                    np.where(q < 1.0, 2.0 * (1.0 - q)**3, 0.0))
+
+
+def _kernel_table(projected):
+    """
+    The SPH kernel tabulated on ``[0, 1]``. If ``projected`` is ``True``, the
+    kernel is integrated along the line of sight, for deposition onto maps.
+    """
+    q = np.linspace(0.0, 1.0, _TABLE_SIZE)
+    if not projected:
+        return _spline(q)
+    z = np.linspace(0.0, 1.0, 4 * _TABLE_SIZE)
+    column = _spline(np.sqrt(q.reshape(-1, 1)**2 + z.reshape(1, -1)**2))
+    return np.trapz(column, z, axis=1)
+
+
+def smoothing_lengths(positions, neighbours=32):
+    """
+    The adaptive smoothing lengths of particles: the distance of each particle to
+    its ``neighbours``-th nearest neighbour (itself included), found with a
+    :class:`KDTree`. The particles are queried in the order of the tree, so that
+    successive queries visit the same nodes.
+    """
+    positions = np.asarray(positions, dtype=np.float64).reshape(len(positions), -1)
+    tree = KDTree(positions)
+    out = np.empty(len(positions))
+    chunk = 2**20
+    for start in range(0, len(positions), chunk):
+        stop = min(start + chunk, len(positions))
+        distances, _ = tree.query(tree.sorted_positions[start:stop], k=neighbours)
+        out[tree.perm[start:stop]] = distances[:, -1]
+    return out
+
+
+def _group_smoothing(group, position, neighbours):
+    """
+    The smoothing lengths of the particles of a group. They are kept until the
+    positions are changed, so that successive maps re-use them.
+    """
+    version = (group._version, id(position._array), neighbours)
+    entry = _smoothing.get(group)
+    if entry is None or entry[0] != version:
+        entry = (version, smoothing_lengths(position.values, neighbours=neighbours))
+        _smoothing[group] = entry
+    return entry[1]
+
+
+def deposit_particles(positions,
+                      values,
+                      lower,
+                      spacing,
+                      shape,
+                      kernel,
+                      weights=None,
+                      smoothing=None,
+                      projected=False):
+    """
+    Deposit the ``values`` (with shape ``(nvalues, npoints)``) of particles onto
+    a uniform grid with the given ``shape`` (with up to 3 dimensions), whose lower
+    corner is ``lower`` and whose voxels have sizes ``spacing``. The ``positions``
+    have shape ``(npoints, ndim)``, with the dimensions in the order of the grid.
+
+    The ``kernel`` is one of :data:`KERNELS`. The ``'sph'`` kernel requires the
+    ``smoothing`` lengths of the particles, and is normalized over the voxels it
+    covers, so that the mass is conserved even for smoothing lengths smaller than
+    the voxels. If ``projected`` is ``True``, the SPH kernel is integrated along
+    the line of sight (for 2D maps of 3D particles).
+
+    The deposition is race-free without private copies of the grid: the grid is
+    split into slabs along its first axis, which are filled in parallel, each
+    slab by a single thread. The particles are sorted into buckets by the first
+    slab they touch, and a thread visits the buckets which can reach its slab.
+
+    Returns an array with shape ``(nvalues + 1,) + shape``, containing the sums of
+    ``value * weight * kernel``, followed by the sum of ``weight * kernel``.
+    Particles outside of the grid only contribute to the voxels they overlap.
+    """
+    if kernel not in KERNELS:
+        raise ValueError("Unknown deposition kernel '{}', possible choices are "
+                         "{}.".format(kernel, list(KERNELS.keys())))
+    positions = np.asarray(positions, dtype=np.float64)
+    npoints = len(positions)
+    positions = positions.reshape(npoints, -1)
+    ndim = positions.shape[1]
+    values = np.ascontiguousarray(values, dtype=np.float64).reshape(-1, npoints)
+    if kernel == "sph" and smoothing is None:
+        raise ValueError("The 'sph' kernel requires the smoothing lengths.")
+    weighted = weights is not None
+    weights = np.asarray(weights, dtype=np.float64) if weighted else np.empty(0)
+    smoothing = (np.asarray(smoothing, dtype=np.float64)
+                 if smoothing is not None else np.empty(0))
+
+    # Pad to 3 dimensions, with a single voxel along the missing ones
+    full_shape = np.ones(3, dtype=np.int64)
+    full_shape[:ndim] = np.asarray(shape, dtype=np.int64).reshape(ndim)
+    full_lower = np.zeros(3)
+    full_lower[:ndim] = np.asarray(lower, dtype=np.float64).reshape(ndim)
+    full_spacing = np.ones(3)
+    full_spacing[:ndim] = np.asarray(spacing, dtype=np.float64).reshape(ndim)
+
+    nslabs = int(min(full_shape[0], 4 * get_num_threads()))
+    edges = (np.arange(nslabs + 1) * full_shape[0]) // nslabs
+    buckets = _buckets(positions, full_lower, full_spacing, full_shape, KERNELS[kernel],
+                       smoothing, edges)
+    order, offsets, reach = sort_buckets(buckets, nslabs)
+    out = np.zeros((values.shape[0] + 1, ) + tuple(full_shape))
+    _deposit(positions, values, weights, weighted, full_lower,
+             full_spacing, full_shape, KERNELS[kernel], smoothing,
+             _kernel_table(projected), edges, order, offsets, reach, out)
+    return out.reshape((values.shape[0] + 1, ) + tuple(full_shape[:ndim]))
+
+
+@njit
+def _stencil(u, kernel, hu):
+    """
+    The range of the voxels touched by a particle along one axis, where ``u`` is
+    the position of the particle in voxel units and ``hu`` its smoothing length.
+    """
+    if kernel == 0:
+        first = int(np.floor(u))
+        return first, first
+    if kernel == 1:
+        first = int(np.floor(u - 0.5))
+        return first, first + 1
+    if kernel == 2:
+        first = int(np.floor(u)) - 1
+        return first, first + 2
+    first = int(np.ceil(u - 0.5 - hu))
+    last = int(np.floor(u - 0.5 + hu))
+    if first > last:
+        # No voxel center within the smoothing length
+        first = int(np.floor(u))
+        return first, first
+    return first, last
+
+
+@njit
+def _weight(u, i, kernel):
+    """
+    The weight of voxel ``i`` along one axis, for the separable kernels.
+    """
+    if kernel == 0:
+        return 1.0
+    d = abs(u - (i + 0.5))
+    if kernel == 1:
+        return max(1.0 - d, 0.0)
+    if d < 0.5:
+        return 0.75 - d * d
+    return 0.5 * max(1.5 - d, 0.0)**2
+
+
+@njit
+def _sph_weight(position, i, j, k, lower, spacing, ndim, h, table):
+    """
+    The (unnormalized) SPH kernel at the center of voxel ``(i, j, k)``.
+    """
+    r2 = (lower[0] + (i + 0.5) * spacing[0] - position[0])**2
+    if ndim > 1:
+        r2 += (lower[1] + (j + 0.5) * spacing[1] - position[1])**2
+    if ndim > 2:
+        r2 += (lower[2] + (k + 0.5) * spacing[2] - position[2])**2
+    q = np.sqrt(r2) / h
+    if not q < 1.0:
+        return 0.0
+    x = q * (len(table) - 1)
+    b = min(int(x), len(table) - 2)
+    return table[b] + (x - b) * (table[b + 1] - table[b])
+
+
+@njit
+def _particle_stencil(position, lower, spacing, shape, kernel, h, first, last, u):
+    """
+    Fill the ranges of voxels touched by a particle along each axis. Returns
+    ``False`` if the particle does not touch the grid.
+    """
+    ndim = len(position)
+    for d in range(3):
+        if d >= ndim:
+            first[d] = 0
+            last[d] = 0
+            u[d] = 0.5
+            continue
+        u[d] = (position[d] - lower[d]) / spacing[d]
+        if not np.isfinite(u[d]):
+            return False
+        first[d], last[d] = _stencil(u[d], kernel, h / spacing[d])
+        if last[d] < 0 or first[d] >= shape[d]:
+            return False
+    return True
+
+
+@njit(parallel=True)
+def _buckets(positions, lower, spacing, shape, kernel, smoothing, edges):
+    """
+    The first slab touched by each particle, and the last voxel along the first
+    axis it touches. The slab is -1 for particles outside of the grid.
+    """
+    npoints = positions.shape[0]
+    out = np.empty((npoints, 2), dtype=np.int64)
+    for p in prange(npoints):
+        first = np.empty(3, dtype=np.int64)
+        last = np.empty(3, dtype=np.int64)
+        u = np.empty(3)
+        h = smoothing[p] if kernel == 3 else 0.0
+        if not _particle_stencil(positions[p], lower, spacing, shape, kernel, h, first,
+                                 last, u):
+            out[p, 0] = -1
+            continue
+        out[p, 0] = np.searchsorted(edges, max(first[0], 0), side="right") - 1
+        out[p, 1] = last[0]
+    return out
+
+
+@njit(parallel=True)
+def _deposit(positions, values, weights, weighted, lower, spacing, shape, kernel,
+             smoothing, table, edges, order, offsets, reach, out):
+
+    nvalues = values.shape[0]
+    ndim = positions.shape[1]
+    nslabs = len(edges) - 1
+
+    # Each slab is filled by a single thread
+    for s in prange(nslabs):
+        first = np.empty(3, dtype=np.int64)
+        last = np.empty(3, dtype=np.int64)
+        u = np.empty(3)
+        for b in range(s + 1):
+            if reach[b] < edges[s]:
+                continue
+            for n in range(offsets[b], offsets[b + 1]):
+                p = order[n]
+                h = smoothing[p] if kernel == 3 else 0.0
+                _particle_stencil(positions[p], lower, spacing, shape, kernel, h, first,
+                                  last, u)
+                if last[0] < edges[s]:
+                    continue
+                # Normalize the SPH kernel over all the voxels it covers
+                total = 1.0
+                if kernel == 3:
+                    total = 0.0
+                    for i in range(first[0], last[0] + 1):
+                        for j in range(first[1], last[1] + 1):
+                            for k in range(first[2], last[2] + 1):
+                                total += _sph_weight(positions[p], i, j, k, lower,
+                                                     spacing, ndim, h, table)
+                    if total == 0:
+                        # Smaller than the voxels: deposit onto the nearest one
+                        for d in range(3):
+                            first[d] = min(max(int(np.floor(u[d])), first[d]), last[d])
+                            last[d] = first[d]
+                weight = weights[p] if weighted else 1.0
+                for i in range(max(first[0], edges[s]), min(last[0] + 1, edges[s + 1])):
+                    wi = _weight(u[0], i, kernel) if kernel < 3 else 1.0
+                    for j in range(max(first[1], 0), min(last[1] + 1, shape[1])):
+                        wj = _weight(u[1], j,
+                                     kernel) if kernel < 3 and ndim > 1 else 1.0
+                        for k in range(max(first[2], 0), min(last[2] + 1, shape[2])):
+                            if kernel < 3:
+                                wk = _weight(u[2], k, kernel) if ndim > 2 else 1.0
+                                w = wi * wj * wk * weight
+                            elif total > 0:
+                                w = _sph_weight(positions[p], i, j, k, lower, spacing,
+                                                ndim, h, table) * weight / total
+                            else:
+                                w = weight
+                            if w == 0:
+                                continue
+                            for v in range(nvalues):
+                                out[v, i, j, k] += values[v, p] * w
+                            out[nvalues, i, j, k] += w
+
+
+def deposit(data: Array,
+            kernel: str = "cic",
+            region: list = None,
+            shape: Union[int, tuple] = 64,
+            operation: str = "sum",
+            weights: Array = None,
+            position: Array = None,
+            smoothing: Array = None,
+            neighbours: int = 32) -> Array:
+    """
+    Deposit a particle field (e.g. the mass) onto a uniform grid, with a
+    mass assignment kernel. The deposition is done by a multi-threaded, race-free
+    kernel (see :func:`map` for depositing particles onto the pixels of a map).
+
+    :param data: The particle field to deposit, e.g. ``data['part']['mass']``.
+        Vector fields are deposited component by component.
+
+    :param kernel: The deposition kernel: ``'ngp'`` (nearest grid point),
+        ``'cic'`` (cloud in cell), ``'tsc'`` (triangular shaped cloud), or
+        ``'sph'`` (cubic spline kernel, with adaptive smoothing lengths).
+        Default is ``'cic'``.
+
+    :param region: The lower and upper corners of the grid, as Arrays, Quantities
+        or lists of numbers (in the unit of the positions). Default is ``None``,
+        in which case the bounding box of the particles is used, enlarged by the
+        support of the kernel so that all the particles are fully deposited.
+
+    :param shape: The number of voxels along each dimension, as an integer or a
+        tuple. Default is ``64``.
+
+    :param operation: ``'sum'`` for the sum of the field in each voxel,
+        ``'density'`` for the sum divided by the volume of the voxels (e.g. the
+        mass density), or ``'mean'`` for the mean of the field in each voxel,
+        weighted by the kernel and the ``weights``. Default is ``'sum'``.
+
+    :param weights: The weights used to compute the means. Default is ``None``,
+        in which case all particles have the same weight.
+
+    :param position: The positions of the particles. Default is ``None``, in which
+        case the ``position`` of the group of ``data`` is used.
+
+    :param smoothing: The smoothing lengths of the particles for the ``'sph'``
+        kernel. Default is ``None``, in which case they are the distances to the
+        ``neighbours``-th nearest neighbours, found with a kd-tree.
+
+    :param neighbours: The number of neighbours which sets the smoothing lengths.
+        Default is ``32``.
+
+    :return: An Array with shape ``(nx, ny, nz)`` (followed by the number of
+        components for vector fields). Voxels without particles are NaN for
+        ``operation='mean'``.
+    """
+    if operation not in ["sum", "density", "mean"]:
+        raise ValueError("Unknown operation '{}', possible choices are ['sum', "
+                         "'density', 'mean'].".format(operation))
+    if position is None:
+        position = _position([data])
+    unit = position.unit
+    positions = np.asarray(position.values, dtype=np.float64)
+    positions = positions.reshape(len(positions), -1)
+    ndim = positions.shape[1]
+    shape = tuple(np.broadcast_to(np.asarray(shape, dtype=np.int64), (ndim, )))
+
+    h = None
+    if kernel == "sph":
+        if smoothing is not None:
+            h = _magnitude(smoothing, unit)
+        elif position.parent is not None:
+            h = _group_smoothing(position.parent, position, neighbours)
+        else:
+            h = smoothing_lengths(positions, neighbours=neighbours)
+
+    if region is None:
+        reach = 0.0 if h is None else np.reshape(h, (-1, 1))
+        lower = np.nanmin(positions - reach, axis=0)
+        upper = np.nanmax(positions + reach, axis=0)
+        # Enlarge the box by the support of the kernel, and by a small fraction of
+        # a voxel to include the particles on the upper faces
+        pad = _SUPPORT[kernel] + 1.0e-6
+        spacing = (upper - lower) / np.maximum(np.array(shape) - 2.0 * pad, 1.0)
+        lower = lower - pad * spacing
+    else:
+        lower, upper = [_magnitude(corner, unit).reshape(ndim) for corner in region]
+        spacing = (upper - lower) / np.array(shape)
+    ncomp = int(np.prod(data.shape[1:]))
+    grid = deposit_particles(
+        positions=positions,
+        values=data.values.reshape(len(positions), ncomp).T,
+        lower=lower,
+        spacing=spacing,
+        shape=shape,
+        kernel=kernel,
+        weights=weights.values if weights is not None and operation == "mean" else None,
+        smoothing=h)
+    field_unit = data.unit
+    if operation == "mean":
+        with np.errstate(invalid="ignore", divide="ignore"):
+            values = grid[:-1] / grid[-1]
+    else:
+        values = grid[:-1]
+        if operation == "density":
+            values = values / np.prod(spacing)
+            field_unit = field_unit / unit**ndim
+    values = np.moveaxis(values, 0, -1)
+    if ncomp == 1 and len(data.shape) == 1:
+        values = values[..., 0]
+    return Array(values=values, unit=field_unit, name=data.name)
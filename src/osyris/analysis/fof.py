@@ -0,0 +1,300 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (c) 2022 Osyris contributors (https://github.com/nvaytet/osyris)
+
+import numpy as np
+from numba import get_num_threads, njit, prange
+from pint.quantity import Quantity
+from typing import Union
+from ..core import Array, Datagroup
+from .profile import _magnitude
+
+# The offsets (along the first two axes) of the rows of cells which are linked to
+# a row of cells: the row itself, and the neighbouring rows which come after it,
+# so that every pair of neighbouring cells is visited once
+_ROW_OFFSETS = np.array([[0, 0], [0, 1], [1, -1], [1, 0], [1, 1]], dtype=np.int64)
+
+
+def fof(data: Datagroup,
+        linking_length: Union[Quantity, float],
+        min_members: int = 20,
+        boxsize: Union[Quantity, float] = None) -> tuple:
+    """
+    Find groups of particles with the friends-of-friends algorithm: two particles
+    closer than the ``linking_length`` belong to the same group.
+
+    The particles are sorted into the cells of a grid whose cells are at least as
+    large as the linking length, and the pairs of particles in neighbouring cells
+    are linked with a union-find structure. The grid is split into slabs which are
+    linked in parallel, each by a single thread, and the links between the slabs
+    are added at the end.
+
+    :param data: The Datagroup of the particles, e.g. ``data['part']``. It must
+        contain the ``position`` of the particles. The ``mass`` and ``velocity``
+        are used for the properties of the groups if they are present.
+
+    :param linking_length: The linking length, as a Quantity, or a number in the
+        unit of the positions.
+
+    :param min_members: The minimum number of particles in a group. Default is
+        ``20``.
+
+    :param boxsize: The size of a periodic box whose lower corner is at the
+        origin. Default is ``None``, for non-periodic positions.
+
+    :return: The id of the group of each particle (-1 for the particles which are
+        not in a group), as an Array, and a Datagroup containing the number of
+        particles ``npart``, ``mass``, center of mass ``position``, and mass
+        weighted ``velocity`` of the groups. The groups are sorted by decreasing
+        number of particles.
+    """
+    position = data["position"]
+    unit = position.unit
+    positions = np.asarray(position.values, dtype=np.float64)
+    npoints = len(positions)
+    positions = positions.reshape(npoints, -1)
+    ndim = positions.shape[1]
+    length = float(_magnitude(linking_length, unit))
+    if not length > 0:
+        raise ValueError("The linking length must be positive.")
+    periodic = boxsize is not None
+    box = np.zeros(3)
+
+    # The grid of cells
+    if periodic:
+        box[:ndim] = _magnitude(boxsize, unit)
+        lower = np.zeros(ndim)
+        ncells = np.maximum(np.floor(box[:ndim] / length), 1).astype(np.int64)
+        size = box[:ndim] / ncells
+    else:
+        lower = np.nanmin(positions, axis=0)
+        upper = np.nanmax(positions, axis=0)
+        ncells = np.floor((upper - lower) / length).astype(np.int64) + 1
+        size = np.full(ndim, length)
+    shape = np.ones(3, dtype=np.int64)
+    shape[:ndim] = ncells
+    spacing = np.ones(3)
+    spacing[:ndim] = size
+    origin = np.zeros(3)
+    origin[:ndim] = lower
+
+    # Sort the particles by cell, the first axis varying the slowest
+    keys = _cell_keys(positions, origin, spacing, shape, periodic)
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+    sorted_positions = np.ascontiguousarray(positions[order])
+    starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+    cell_keys = sorted_keys[starts]
+    starts = np.append(starts, npoints)
+    # The rows of cells along the last axis
+    all_rows = cell_keys // shape[2]
+    row_starts = np.flatnonzero(np.r_[True, all_rows[1:] != all_rows[:-1]])
+    row_keys = all_rows[row_starts]
+    row_starts = np.append(row_starts, len(cell_keys))
+
+    # Link the particles in parallel inside slabs of planes along the first axis
+    nslabs = int(min(shape[0], 4 * get_num_threads()))
+    slab_edges = (np.arange(nslabs + 1) * shape[0]) // nslabs
+    slab_starts = np.searchsorted(row_keys // shape[1], slab_edges)
+    parents = _link(sorted_positions, starts, cell_keys, row_keys, row_starts,
+                    slab_edges, slab_starts, shape, length * length, periodic, box)
+    roots = _roots(parents)
+
+    # Number the groups by decreasing number of particles
+    unique, inverse, counts = np.unique(roots, return_inverse=True, return_counts=True)
+    large = counts >= min_members
+    ranking = np.argsort(-counts[large], kind="stable")
+    labels = np.full(len(unique), -1, dtype=np.int64)
+    labels[np.flatnonzero(large)[ranking]] = np.arange(int(large.sum()))
+    sorted_ids = labels[inverse]
+    ids = np.empty(npoints, dtype=np.int64)
+    ids[order] = sorted_ids
+    ngroups = int(large.sum())
+
+    groups = Datagroup()
+    members = ids >= 0
+    group_ids = ids[members]
+    groups["npart"] = Array(values=np.bincount(group_ids, minlength=ngroups))
+    if "mass" in data:
+        mass = np.asarray(data["mass"].values, dtype=np.float64)[members]
+        groups["mass"] = Array(values=np.bincount(group_ids,
+                                                  weights=mass,
+                                                  minlength=ngroups),
+                               unit=data["mass"].unit)
+    else:
+        mass = np.ones(len(group_ids))
+    total = np.bincount(group_ids, weights=mass, minlength=ngroups)
+
+    # The positions are taken relative to a member of the group, so that groups
+    # which go across the boundaries of a periodic box are not split
+    reference = np.zeros((ngroups, ndim))
+    reference[group_ids] = positions[members]
+    offsets = positions[members] - reference[group_ids]
+    if periodic:
+        offsets -= box[:ndim] * np.round(offsets / box[:ndim])
+    center = np.array([
+        np.bincount(group_ids, weights=mass * offsets[:, d], minlength=ngroups)
+        for d in range(ndim)
+    ]).T / total.reshape(-1, 1) + reference
+    if periodic:
+        center = np.mod(center, box[:ndim])
+    groups["position"] = Array(values=center if ndim > 1 else center[:, 0], unit=unit)
+    if "velocity" in data:
+        velocities = np.asarray(data["velocity"].values,
+                                dtype=np.float64).reshape(npoints, -1)[members]
+        velocity = np.array([
+            np.bincount(group_ids, weights=mass * velocities[:, d], minlength=ngroups)
+            for d in range(velocities.shape[1])
+        ]).T / total.reshape(-1, 1)
+        groups["velocity"] = Array(values=velocity.reshape((ngroups, ) +
+                                                           data["velocity"].shape[1:]),
+                                   unit=data["velocity"].unit)
+    return Array(values=ids), groups
+
+
+@njit(parallel=True)
+def _cell_keys(positions, origin, spacing, shape, periodic):
+    """
+    The index of the cell of each particle, in the raveled grid.
+    """
+    npoints, ndim = positions.shape
+    keys = np.empty(npoints, dtype=np.int64)
+    for p in prange(npoints):
+        key = 0
+        for d in range(3):
+            coord = 0
+            if d < ndim:
+                coord = int(np.floor((positions[p, d] - origin[d]) / spacing[d]))
+                if periodic:
+                    coord = coord % shape[d]
+                else:
+                    coord = min(max(coord, 0), shape[d] - 1)
+            key = key * shape[d] + coord
+        keys[p] = key
+    return keys
+
+
+@njit
+def _find(parents, i):
+    # Path halving
+    while parents[i] != i:
+        parents[i] = parents[parents[i]]
+        i = parents[i]
+    return i
+
+
+@njit
+def _union(parents, i, j):
+    """
+    Merge the trees of ``i`` and ``j``. The root with the smallest index is kept,
+    so that the parent of a particle never comes after it.
+    """
+    a = _find(parents, i)
+    b = _find(parents, j)
+    if a < b:
+        parents[b] = a
+    elif b < a:
+        parents[a] = b
+
+
+@njit
+def _link_row(positions, starts, cell_keys, row_keys, row_starts, r, shape, length2,
+              periodic, box, slab_edges, slab, inside, parents):
+    """
+    Link the particles of the cells of row ``r`` with the particles of the
+    neighbouring cells in the rows given by :data:`_ROW_OFFSETS`. If ``inside`` is
+    ``True``, only the rows which are in the same ``slab`` as the row are used,
+    otherwise only the ones in other slabs. The cells are sorted along the rows,
+    so that the neighbours of a cell are found with binary searches in the short
+    ranges of cells of the neighbouring rows.
+    """
+    ndim = positions.shape[1]
+    depth = shape[2]
+    x = row_keys[r] // shape[1]
+    y = row_keys[r] % shape[1]
+    for o in range(len(_ROW_OFFSETS)):
+        nx = x + _ROW_OFFSETS[o, 0]
+        ny = y + _ROW_OFFSETS[o, 1]
+        if periodic:
+            nx = nx % shape[0]
+            ny = ny % shape[1]
+        elif nx >= shape[0] or ny < 0 or ny >= shape[1]:
+            continue
+        same_slab = nx >= slab_edges[slab] and nx < slab_edges[slab + 1]
+        if inside != same_slab:
+            continue
+        # The range of cells of the neighbouring row
+        if o == 0:
+            lo = row_starts[r]
+            hi = row_starts[r + 1]
+        else:
+            n = np.searchsorted(row_keys, nx * shape[1] + ny)
+            if n == len(row_keys) or row_keys[n] != nx * shape[1] + ny:
+                continue
+            lo = row_starts[n]
+            hi = row_starts[n + 1]
+        for c in range(row_starts[r], row_starts[r + 1]):
+            z = cell_keys[c] % depth
+            # In the same row, only the cell itself and the next one
+            for dz in range(0 if o == 0 else -1, 2):
+                nz = z + dz
+                if periodic:
+                    nz = nz % depth
+                elif nz < 0 or nz >= depth:
+                    continue
+                if o > 0 or dz > 0:
+                    key = (nx * shape[1] + ny) * depth + nz
+                    m = lo + np.searchsorted(cell_keys[lo:hi], key)
+                    if m == hi or cell_keys[m] != key:
+                        continue
+                else:
+                    m = c
+                for i in range(starts[c], starts[c + 1]):
+                    first = i + 1 if m == c else starts[m]
+                    for j in range(first, starts[m + 1]):
+                        r2 = 0.0
+                        for d in range(ndim):
+                            delta = positions[i, d] - positions[j, d]
+                            if periodic:
+                                delta -= box[d] * np.round(delta / box[d])
+                            r2 += delta * delta
+                        if r2 <= length2:
+                            _union(parents, i, j)
+
+
+@njit(parallel=True)
+def _link(positions, starts, cell_keys, row_keys, row_starts, slab_edges, slab_starts,
+          shape, length2, periodic, box):
+    """
+    Link all the pairs of particles closer than the linking length, and return the
+    parent of every particle in the union-find forest.
+    """
+    npoints = positions.shape[0]
+    nslabs = len(slab_edges) - 1
+    parents = np.arange(npoints)
+
+    # The links inside a slab only involve the particles of the slab, so that
+    # every slab can be processed by a different thread
+    for slab in prange(nslabs):
+        for r in range(slab_starts[slab], slab_starts[slab + 1]):
+            _link_row(positions, starts, cell_keys, row_keys, row_starts, r, shape,
+                      length2, periodic, box, slab_edges, slab, True, parents)
+
+    # The links across slabs come from the rows of the last plane of each slab
+    for slab in range(nslabs):
+        for r in range(slab_starts[slab], slab_starts[slab + 1]):
+            if row_keys[r] // shape[1] == slab_edges[slab + 1] - 1:
+                _link_row(positions, starts, cell_keys, row_keys, row_starts, r, shape,
+                          length2, periodic, box, slab_edges, slab, False, parents)
+    return parents
+
+
+@njit
+def _roots(parents):
+    """
+    The root of the tree of every particle. As the parent of a particle never
+    comes after it, the roots are found in a single pass.
+    """
+    roots = np.empty_like(parents)
+    for i in range(len(parents)):
+        roots[i] = i if parents[i] == i else roots[parents[i]]
+    return roots
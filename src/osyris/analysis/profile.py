@@ -0,0 +1,316 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (c) 2022 Osyris contributors (https://github.com/nvaytet/osyris)
+
+import numpy as np
+from numba import get_num_threads, njit, prange
+from pint.quantity import Quantity
+from typing import Union
+from ..core import Array, Datagroup, DatagroupView
+from ..core.tools import to_bin_centers
+from ..plot.utils import find_bin
+
+_AXES = {"x": 0, "y": 1, "z": 2}
+
+
+def _magnitude(value, unit):
+    """
+    The values of an Array, Quantity or number, in the given unit (a Quantity).
+    Plain numbers are assumed to already be in that unit.
+    """
+    if isinstance(value, Array):
+        value = value.values * value.unit
+    if isinstance(value, Quantity):
+        return np.asarray(value.to(unit.units).magnitude / unit.magnitude,
+                          dtype=np.float64)
+    return np.asarray(value, dtype=np.float64)
+
+
+def _fields(data):
+    """
+    The names of the fields to be profiled, with functions returning their values
+    and units, so that the fields of a group are fetched one at a time. The
+    derived fields of a group are not profiled, and its evicted columns are read
+    without being loaded back into memory.
+    """
+    if isinstance(data, (Datagroup, DatagroupView)):
+        return [(key, lambda key=key: data._peek(key)) for key in data.keys()
+                if not data.is_derived(key)]
+    if isinstance(data, Array):
+        data = [data]
+    return [(field.name, lambda field=field: (field.values, field.unit.units))
+            for field in data]
+
+
+def _position(data):
+    """
+    Find the positions of the elements of the profiled fields: the ``position`` of
+    their group (for particles), or the ``xyz`` of the ``amr`` group.
+    """
+    if isinstance(data, (Datagroup, DatagroupView)):
+        group = data
+    elif isinstance(data, Array):
+        group = data.parent
+    else:
+        group = data[0].parent
+    if group is None:
+        raise ValueError("The positions cannot be found for Arrays which do not "
+                         "belong to a Dataset, use the 'position' argument.")
+    if "position" in group:
+        return group["position"]
+    xyz = group.parent["amr"]["xyz"]
+    if isinstance(group, DatagroupView):
+        # Select the cells of the view
+        return xyz[group.selection]
+    return xyz
+
+
+def _axis(axis, ndim):
+    if isinstance(axis, str):
+        vector = np.zeros(ndim)
+        vector[_AXES[axis]] = 1.0
+    else:
+        vector = np.asarray(getattr(axis, "values", axis), dtype=np.float64).ravel()
+    return vector / np.linalg.norm(vector)
+
+
+def profile(data: Union[Array, Datagroup, DatagroupView, list],
+            center: Union[Array, Quantity] = None,
+            bins: Union[int, Array, Quantity] = 50,
+            kind: str = "spherical",
+            weights: Array = None,
+            position: Array = None,
+            axis: Union[str, Array] = "z",
+            rmin: Quantity = None,
+            rmax: Quantity = None,
+            height: Quantity = None,
+            logr: bool = False) -> Datagroup:
+    """
+    Compute radial profiles of one or more fields around a ``center``, in
+    spherical shells or cylindrical annuli. The bins of the elements are found once
+    by a multi-threaded kernel, without making a copy of the positions, and the
+    fields are then binned one at a time, without making copies of their values.
+
+    The result is a Datagroup, which contains the ``radius`` at the bin centers,
+    the ``count`` of elements in each bin, and for each field ``f``:
+
+    - ``f``: the mean of the field in each bin, weighted by ``weights``
+    - ``f_sum``: the sum of the field in each bin
+    - ``f_enclosed``: the cumulative sum of the field, from the inner edge of the
+      first bin to the outer edge of each bin
+
+    If ``weights`` are given, their sum and cumulative sum are also included, as
+    ``w_sum`` and ``w_enclosed``, where ``w`` is the name of the weights (e.g. the
+    enclosed mass for ``weights=data['hydro']['mass']``).
+
+    :param data: The field(s) to profile: an Array, a list of Arrays or a
+        Datagroup or a selection of its rows (in which case all its fields, except
+        for the derived fields, are profiled). Vector fields are profiled component
+        by component.
+
+    :param center: The center of the profile. Default is ``None``, in which case
+        the origin of the coordinate system is used.
+
+    :param bins: The number of bins, or the bin edges. Default is ``50``.
+
+    :param kind: ``'spherical'`` or ``'cylindrical'``. Default is
+        ``'spherical'``.
+
+    :param weights: The weights used to compute the means. Default is ``None``,
+        in which case all elements have the same weight.
+
+    :param position: The positions of the elements. Default is ``None``, in which
+        case the ``position`` of the particle group the fields belong to is used,
+        or the ``xyz`` positions of the AMR cells.
+
+    :param axis: The axis of cylindrical profiles, as ``'x'``, ``'y'``, ``'z'``,
+        or a vector. Default is ``'z'``.
+
+    :param rmin: The inner radius of the profile. Default is ``None``, in which
+        case ``0`` is used (or the smallest radius if ``logr`` is ``True``).
+
+    :param rmax: The outer radius of the profile. Elements further away are
+        discarded before their distance is computed. Default is ``None``, in
+        which case the largest radius is used.
+
+    :param height: The height of the cylinder for cylindrical profiles, centered
+        on the ``center``. Default is ``None``, for an infinite cylinder.
+
+    :param logr: If ``True``, the bins are logarithmically spaced. Default is
+        ``False``.
+    """
+    if kind not in ["spherical", "cylindrical"]:
+        raise ValueError("Unknown kind of profile '{}', possible choices are "
+                         "['spherical', 'cylindrical'].".format(kind))
+    fields = _fields(data)
+    if len(fields) == 0:
+        raise ValueError("No fields to profile.")
+    if position is None:
+        position = _position(data)
+    unit = position.unit
+    positions = np.asarray(position.values, dtype=np.float64)
+    positions = positions.reshape(len(positions), -1)
+    ndim = positions.shape[1]
+    if center is None:
+        center = np.zeros(ndim)
+    center = _magnitude(center, unit).reshape(ndim)
+    cylindrical = kind == "cylindrical"
+    direction = _axis(axis, ndim) if cylindrical else np.zeros(ndim)
+    half_height = np.inf
+    if cylindrical and height is not None:
+        half_height = 0.5 * float(_magnitude(height, unit))
+    weighted = weights is not None
+    wvalues = np.asarray(weights.values, dtype=np.float64) if weighted else np.empty(0)
+    nthreads = max(min(get_num_threads(), len(positions) // 1000), 1)
+
+    # Radial bins
+    if isinstance(bins, int):
+        lower = 0.0 if rmin is None else float(_magnitude(rmin, unit))
+        upper = np.inf if rmax is None else float(_magnitude(rmax, unit))
+        if rmax is None or (logr and rmin is None):
+            smallest, largest = _radial_range(positions, center, direction, cylindrical,
+                                              half_height, upper, nthreads)
+            if rmax is None:
+                upper = largest
+            if logr and rmin is None:
+                lower = smallest
+        if logr:
+            edges = np.logspace(np.log10(lower), np.log10(upper), bins + 1)
+            first, width = np.log10(lower), (np.log10(upper) - np.log10(lower)) / bins
+        else:
+            edges = np.linspace(lower, upper, bins + 1)
+            first, width = lower, (upper - lower) / bins
+        uniform = True
+    else:
+        edges = _magnitude(bins, unit)
+        first, width, uniform = edges[0], 1.0, False
+
+    nbins = len(edges) - 1
+    element_bins = _find_bins(positions, center, direction, cylindrical, half_height,
+                              edges, first, width, uniform, logr)
+    counts, wsums = _bin_weights(element_bins, wvalues, weighted, nbins, nthreads)
+    # Reduce the bins of all the threads
+    counts = counts.sum(axis=0)
+    wsums = wsums.sum(axis=0)
+
+    out = Datagroup()
+    out["radius"] = Array(values=to_bin_centers(edges), unit=unit)
+    out["count"] = Array(values=counts)
+    for i, (name, fetch) in enumerate(fields):
+        # The fields are binned one at a time, from their own values
+        values, field_unit = fetch()
+        values = np.asarray(values)
+        sums, weighted_sums = _bin_values(element_bins,
+                                          values.reshape(len(positions), -1), wvalues,
+                                          weighted, nbins, nthreads)
+        sums = sums.sum(axis=0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            means = weighted_sums.sum(axis=0) / wsums
+        means[:, wsums == 0] = np.nan
+        name = name if name else "field{}".format(i)
+        shape = (nbins, ) + values.shape[1:]
+        for suffix, array in [("", means), ("_sum", sums),
+                              ("_enclosed", np.cumsum(sums, axis=1))]:
+            out[name + suffix] = Array(values=array.T.reshape(shape), unit=field_unit)
+    if weighted:
+        name = weights.name if weights.name else "weights"
+        out[name + "_sum"] = Array(values=wsums, unit=weights.unit)
+        out[name + "_enclosed"] = Array(values=np.cumsum(wsums), unit=weights.unit)
+    return out
+
+
+@njit
+def _radius(positions, i, center, direction, cylindrical, half_height, rmax):
+    """
+    The distance of element ``i`` to the center (or to the axis of the cylinder).
+    Elements outside of the region are rejected with cheap per-axis comparisons
+    first, and have a radius of -1.
+    """
+    ndim = positions.shape[1]
+    r2 = 0.0
+    along = 0.0
+    for d in range(ndim):
+        delta = positions[i, d] - center[d]
+        if not cylindrical and abs(delta) > rmax:
+            return -1.0
+        r2 += delta * delta
+        along += delta * direction[d]
+    if cylindrical:
+        if abs(along) > half_height:
+            return -1.0
+        r2 = max(r2 - along * along, 0.0)
+    return np.sqrt(r2)
+
+
+@njit(parallel=True)
+def _radial_range(positions, center, direction, cylindrical, half_height, rmax,
+                  nthreads):
+    npoints = positions.shape[0]
+    mins = np.full(nthreads, np.inf)
+    maxs = np.zeros(nthreads)
+    chunk = (npoints + nthreads - 1) // nthreads
+    for t in prange(nthreads):
+        for i in range(t * chunk, min((t + 1) * chunk, npoints)):
+            r = _radius(positions, i, center, direction, cylindrical, half_height, rmax)
+            if r < 0 or r > rmax or not np.isfinite(r):
+                continue
+            if r > 0:
+                mins[t] = min(mins[t], r)
+            maxs[t] = max(maxs[t], r)
+    return mins.min(), maxs.max()
+
+
+@njit(parallel=True)
+def _find_bins(positions, center, direction, cylindrical, half_height, edges, lower,
+               width, uniform, log):
+    """
+    The radial bin of every element, or -1 for the elements outside of the bins.
+    """
+    npoints = positions.shape[0]
+    rmax = edges[-1]
+    out = np.empty(npoints, dtype=np.int64)
+    for i in prange(npoints):
+        r = _radius(positions, i, center, direction, cylindrical, half_height, rmax)
+        out[i] = -1 if r < 0 else find_bin(r, edges, lower, width, uniform, log)
+    return out
+
+
+@njit(parallel=True)
+def _bin_weights(bins, weights, weighted, nbins, nthreads):
+
+    npoints = bins.shape[0]
+    counts = np.zeros((nthreads, nbins), dtype=np.int64)
+    wsums = np.zeros((nthreads, nbins))
+
+    # Every thread bins a contiguous chunk of the elements into private bins
+    chunk = (npoints + nthreads - 1) // nthreads
+    for t in prange(nthreads):
+        for i in range(t * chunk, min((t + 1) * chunk, npoints)):
+            b = bins[i]
+            if b < 0:
+                continue
+            counts[t, b] += 1
+            wsums[t, b] += weights[i] if weighted else 1.0
+
+    return counts, wsums
+
+
+@njit(parallel=True)
+def _bin_values(bins, values, weights, weighted, nbins, nthreads):
+
+    npoints, nvalues = values.shape
+    sums = np.zeros((nthreads, nvalues, nbins))
+    weighted_sums = np.zeros((nthreads, nvalues, nbins))
+
+    # Every thread bins a contiguous chunk of the elements into private bins
+    chunk = (npoints + nthreads - 1) // nthreads
+    for t in prange(nthreads):
+        for i in range(t * chunk, min((t + 1) * chunk, npoints)):
+            b = bins[i]
+            if b < 0:
+                continue
+            weight = weights[i] if weighted else 1.0
+            for v in range(nvalues):
+                sums[t, v, b] += values[i, v]
+                weighted_sums[t, v, b] += values[i, v] * weight
+
+    return sums, weighted_sums
@@ -96,18 +96,26 @@ def additional_variables(data):
     It is recommended to place your variables in a `try/except` block, which
     will prevent errors if the variables are not found, for instance when
     loading data from a different simulation.
+
+    Variables registered with `Datagroup.derive` are only computed when they are
+    first accessed, and are re-computed if one of their dependencies changes.
+    Expressions built from `Array.lazy()` are evaluated in a single pass, without
+    creating intermediate arrays.
     """
 
     # Magnetic field
     try:
-        data['hydro']['B_field'] = 0.5 * (data['hydro']['B_left'] +
-                                          data['hydro']['B_right'])
+        data['hydro'].derive('B_field',
+                             lambda left, right: 0.5 * (left.lazy() + right),
+                             dependencies=['B_left', 'B_right'])
     except KeyError:
         pass
 
     # Mass
     try:
-        data['hydro']['mass'] = data['hydro']['density'] * data['amr']['dx']**3
-        data['hydro']['mass'].to('msun')
+        data['hydro'].derive('mass',
+                             lambda density, dx:
+                             (density.lazy() * dx.lazy()**3).to('msun'),
+                             dependencies=['density', ('amr', 'dx')])
     except KeyError:
         pass
@@ -4,6 +4,7 @@
 # flake8: noqa
 
 from .array import Array
-from .datagroup import Datagroup
+from .datagroup import Datagroup, DatagroupView
 from .dataset import Dataset
+from .lazy import LazyArray
 from .plot import Plot
@@ -1,22 +1,39 @@
 # SPDX-License-Identifier: BSD-3-Clause
 # Copyright (c) 2022 Osyris contributors (https://github.com/nvaytet/osyris)
+from functools import wraps
 import numpy as np
 from pint.quantity import Quantity
-from pint.unit import Unit
 from .tools import value_to_string, make_label
+from .unit import (from_pint, conversion_factor, multiply_units, divide_units,
+                   power_unit, inverse_unit, equivalent_units)
 from .. import units
 
 
 def _comparison_operator(lhs, rhs, op):
     func = getattr(np, op)
     if isinstance(rhs, Array):
-        scale_r = rhs.unit.to(lhs._unit.units)
-        return func(lhs._array, rhs._array * scale_r.magnitude)
+        scale_r = conversion_factor(rhs._unit, lhs._unit)
+        return func(lhs._array, rhs._array * scale_r)
     if isinstance(rhs, Quantity):
-        return func(lhs._array, rhs.to(lhs._unit.units).magnitude)
+        return func(lhs._array,
+                    rhs.magnitude * conversion_factor(from_pint(rhs.units), lhs._unit))
     return func(lhs._array, rhs)
 
 
+def _defer_to_lazy(op):
+    """
+    Let a LazyArray operand handle the operation, so that it is added to the lazy
+    expression instead of being evaluated.
+    """
+    @wraps(op)
+    def wrapper(self, other):
+        if getattr(other, "is_lazy", False):
+            return NotImplemented
+        return op(self, other)
+
+    return wrapper
+
+
 class Array:
     def __init__(self, values=None, unit=None, parent=None, name=""):
 
@@ -25,19 +42,14 @@ class Array:
         else:
             self._array = np.asarray(values)
 
+        # The unit is stored internally as a CompactUnit, the pint Quantity is only
+        # created when the `unit` property is accessed.
         if unit is None:
-            self._unit = 1.0 * units.dimensionless
-        elif isinstance(unit, str):
-            self._unit = units(unit)
-        elif isinstance(unit, Quantity):
-            self._unit = unit
-        elif isinstance(unit, Unit):
-            self._unit = 1.0 * unit
+            self._unit = from_pint(units.dimensionless)
         else:
-            raise TypeError("Unsupported unit type {}".format(type(unit)))
+            self._unit = from_pint(unit)
         self._parent = parent
         self._name = name
-        self.special_functions = ["sqrt", "power"]
 
     # def __array__(self):
     #     return self._array
@@ -70,7 +82,7 @@ class Array:
 
     def copy(self):
         return self.__class__(values=self._array.copy(),
-                              unit=self._unit.copy(),
+                              unit=self._unit,
                               name=self._name)
 
     @property
@@ -95,15 +107,15 @@ class Array:
             return self
         else:
             return self.__class__(values=np.linalg.norm(self._array, axis=1),
-                                  unit=self.unit)
+                                  unit=self._unit)
 
     @property
     def unit(self):
-        return self._unit
+        return self._unit.quantity
 
     @unit.setter
     def unit(self, unit_):
-        self._unit = unit_
+        self._unit = from_pint(unit_)
 
     @property
     def ndim(self):
@@ -178,120 +190,122 @@ class Array:
     def _raise_incompatible_units_error(self, other, op):
         raise TypeError("Could not {} types {} and {}.".format(op, self, other))
 
+    def _quantity_to_self(self, other):
+        """
+        Convert the magnitude of a Quantity to the unit of this Array.
+        """
+        return other.magnitude * conversion_factor(from_pint(other.units), self._unit)
+
+    @_defer_to_lazy
     def __add__(self, other):
         if isinstance(other, self.__class__):
-            scale_r = other.unit.to(self._unit.units)
+            scale_r = conversion_factor(other._unit, self._unit)
             lhs = self._array
-            rhs = other._array * scale_r.magnitude
+            rhs = other._array * scale_r
             lhs, rhs = self._broadcast(lhs, rhs)
             return self.__class__(values=lhs + rhs, unit=self._unit)
         if isinstance(other, Quantity):
-            return self.__class__(values=self._array +
-                                  other.to(self._unit.units).magnitude,
+            return self.__class__(values=self._array + self._quantity_to_self(other),
                                   unit=self._unit)
         self._raise_incompatible_units_error(other, "add")
 
+    @_defer_to_lazy
     def __iadd__(self, other):
         if isinstance(other, self.__class__):
-            scale_r = other.unit.to(self._unit.units)
-            rhs = other._array * scale_r.magnitude
+            scale_r = conversion_factor(other._unit, self._unit)
+            rhs = other._array * scale_r
             self._array += rhs
         elif isinstance(other, Quantity):
-            self._array += other.to(self._unit.units).magnitude
+            self._array += self._quantity_to_self(other)
         else:
             self._raise_incompatible_units_error(other, "add")
         return self
 
+    @_defer_to_lazy
     def __sub__(self, other):
         if isinstance(other, self.__class__):
-            scale_r = other.unit.to(self._unit.units)
+            scale_r = conversion_factor(other._unit, self._unit)
             lhs = self._array
-            rhs = other._array * scale_r.magnitude
+            rhs = other._array * scale_r
             lhs, rhs = self._broadcast(lhs, rhs)
             return self.__class__(values=lhs - rhs, unit=self._unit)
         if isinstance(other, Quantity):
-            return self.__class__(values=self._array -
-                                  other.to(self._unit.units).magnitude,
+            return self.__class__(values=self._array - self._quantity_to_self(other),
                                   unit=self._unit)
         self._raise_incompatible_units_error(other, "subtract")
 
+    @_defer_to_lazy
     def __isub__(self, other):
         if isinstance(other, self.__class__):
-            scale_r = other.unit.to(self._unit.units)
-            rhs = other._array * scale_r.magnitude
+            scale_r = conversion_factor(other._unit, self._unit)
+            rhs = other._array * scale_r
             self._array -= rhs
         elif isinstance(other, Quantity):
-            self._array -= other.to(self._unit.units).magnitude
+            self._array -= self._quantity_to_self(other)
         else:
             self._raise_incompatible_units_error(other, "subtract")
         return self
 
+    @_defer_to_lazy
     def __mul__(self, other):
         if isinstance(other, self.__class__):
-            scale_l = self._unit.to_base_units()
-            scale_r = other._unit.to_base_units()
-            result = scale_l * scale_r
+            result = self._unit.scale * other._unit.scale
             lhs = self._array
-            rhs = other._array * result.magnitude
+            rhs = other._array * result
             lhs, rhs = self._broadcast(lhs, rhs)
-            return self.__class__(values=lhs * rhs, unit=1.0 * result.units)
+            return self.__class__(values=lhs * rhs,
+                                  unit=multiply_units(self._unit, other._unit))
         if isinstance(other, Quantity):
-            scale_l = self._unit.to_base_units()
-            scale_r = other.to_base_units()
-            result = scale_l * scale_r
-            return self.__class__(values=self._array * result.magnitude,
-                                  unit=1.0 * result.units)
+            other_unit = from_pint(other.units)
+            result = self._unit.scale * (other.magnitude * other_unit.factor)
+            return self.__class__(values=self._array * result,
+                                  unit=multiply_units(self._unit, other_unit))
         return self.__class__(values=self._array * other, unit=self._unit)
 
+    @_defer_to_lazy
     def __imul__(self, other):
         if isinstance(other, self.__class__):
-            scale_l = self._unit.to_base_units()
-            scale_r = other._unit.to_base_units()
-            result = scale_l * scale_r
-            rhs = other._array * result.magnitude
+            result = self._unit.scale * other._unit.scale
+            rhs = other._array * result
             self._array *= rhs
-            self._unit = 1.0 * result.units
+            self._unit = multiply_units(self._unit, other._unit)
         elif isinstance(other, Quantity):
-            scale_l = self._unit.to_base_units()
-            scale_r = other.to_base_units()
-            result = scale_l * scale_r
-            self._array *= result.magnitude
-            self._unit = 1.0 * result.units
+            other_unit = from_pint(other.units)
+            result = self._unit.scale * (other.magnitude * other_unit.factor)
+            self._array *= result
+            self._unit = multiply_units(self._unit, other_unit)
         else:
             self._array *= other
         return self
 
+    @_defer_to_lazy
     def __truediv__(self, other):
         if isinstance(other, self.__class__):
-            scale_l = self._unit.to_base_units()
-            scale_r = other._unit.to_base_units()
-            result = scale_l / scale_r
+            result = self._unit.scale / other._unit.scale
             lhs = self._array
-            rhs = other._array / result.magnitude
+            rhs = other._array / result
             lhs, rhs = self._broadcast(lhs, rhs)
-            return self.__class__(values=lhs / rhs, unit=1.0 * result.units)
+            return self.__class__(values=lhs / rhs,
+                                  unit=divide_units(self._unit, other._unit))
         if isinstance(other, Quantity):
-            scale_l = self._unit.to_base_units()
-            scale_r = other.to_base_units()
-            result = scale_l / scale_r
-            return self.__class__(values=self._array * result.magnitude,
-                                  unit=1.0 * result.units)
+            other_unit = from_pint(other.units)
+            result = self._unit.scale / (other.magnitude * other_unit.factor)
+            return self.__class__(values=self._array * result,
+                                  unit=divide_units(self._unit, other_unit))
         return self.__class__(values=self._array / other, unit=self._unit)
 
+    @_defer_to_lazy
     def __itruediv__(self, other):
         if isinstance(other, self.__class__):
-            scale_l = self._unit.to_base_units()
-            scale_r = other._unit.to_base_units()
-            result = scale_l / scale_r
-            rhs = other._array / result.magnitude
+            result = self._unit.scale / other._unit.scale
+            rhs = other._array / result
             self._array /= rhs
-            self._unit = 1.0 * result.units
+            self._unit = divide_units(self._unit, other._unit)
         elif isinstance(other, Quantity):
-            scale_l = self._unit.to_base_units()
-            scale_r = other.to_base_units()
-            result = scale_l / scale_r
-            self._array *= result.magnitude
-            self._unit = 1.0 * result.units
+            other_unit = from_pint(other.units)
+            result = self._unit.scale / (other.magnitude * other_unit.factor)
+            self._array *= result
+            self._unit = divide_units(self._unit, other_unit)
         else:
             self._array /= other
         return self
@@ -301,20 +315,18 @@ class Array:
 
     def __rtruediv__(self, other):
         if isinstance(other, self.__class__):
-            scale_r = self._unit.to_base_units()
-            scale_l = other._unit.to_base_units()
-            result = scale_l / scale_r
+            result = other._unit.scale / self._unit.scale
             lhs = self._array
-            rhs = other._array / result.magnitude
+            rhs = other._array / result
             lhs, rhs = self._broadcast(lhs, rhs)
-            return self.__class__(values=lhs / rhs, unit=1.0 * result.units)
+            return self.__class__(values=lhs / rhs,
+                                  unit=divide_units(other._unit, self._unit))
         if isinstance(other, Quantity):
-            scale_r = self._unit.to_base_units()
-            scale_l = other.to_base_units()
-            result = scale_l / scale_r
-            return self.__class__(values=self._array * result.magnitude,
-                                  unit=1.0 * result.units)
-        return self.__class__(values=other / self._array, unit=1.0 / self._unit)
+            other_unit = from_pint(other.units)
+            result = (other.magnitude * other_unit.factor) / self._unit.scale
+            return self.__class__(values=self._array * result,
+                                  unit=divide_units(other_unit, self._unit))
+        return self.__class__(values=other / self._array, unit=inverse_unit(self._unit))
 
     def __pow__(self, number):
         return np.power(self, number)
@@ -337,25 +349,32 @@ class Array:
     def __ne__(self, other):
         return _comparison_operator(self, other, "not_equal")
 
+    def lazy(self):
+        """
+        Return a :class:`LazyArray` wrapping this Array. Operations on it build an
+        expression which is evaluated in a single pass by calling ``compute()``.
+        """
+        from .lazy import LazyArray
+        return LazyArray.from_array(self)
+
     def to(self, unit):
-        if isinstance(unit, str):
-            new_unit = units(unit)
-        else:
-            new_unit = unit
-        ratio = self._unit.to(new_unit) / new_unit
-        self._unit = 1.0 * new_unit
-        self._array *= ratio.magnitude
+        new_unit = from_pint(unit)
+        ratio = conversion_factor(self._unit, new_unit) / new_unit.magnitude
+        self._unit = new_unit.with_magnitude(1.0 * new_unit.magnitude)
+        self._array *= ratio
         return self
 
     def _wrap_numpy(self, func, *args, **kwargs):
-        if func.__name__ in self.special_functions:
-            unit = func(self.unit, *args[1:], **kwargs)
+        if func.__name__ == "power":
+            unit = power_unit(self._unit, *args[1:])
+        elif func.__name__ == "sqrt":
+            unit = power_unit(self._unit, 0.5)
         else:
-            unit = self.unit
+            unit = self._unit
         if isinstance(args[0], tuple) or isinstance(args[0], list):
             # Case where we have a sequence of arrays, e.g. `concatenate`
             for a in args[0]:
-                if a.unit != unit:
+                if not equivalent_units(a._unit, unit):
                     self._raise_incompatible_units_error(a, func.__name__)
             args = (tuple(a._array for a in args[0]), ) + args[1:]
         elif (len(args) > 1 and hasattr(args[1], "_array")):
@@ -379,24 +398,260 @@ class Array:
     def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
         """
         Numpy array_ufunc protocol to allow Array to work with numpy ufuncs.
+        Supports the ``__call__``, ``reduce``, ``accumulate``, ``reduceat``,
+        ``outer`` and ``at`` methods, as well as the ``out`` and ``where`` arguments.
+        Operands are converted to a common unit where the ufunc requires it, and
+        the unit of the result is propagated to the ``out`` Arrays.
         """
-        if method != "__call__":
-            # Only handle ufuncs as callables
+        if isinstance(kwargs.get("where"), Array):
+            kwargs["where"] = kwargs["where"]._array
+        out = kwargs.pop("out", None)
+        if out is not None:
+            kwargs["out"] = tuple(o._array if isinstance(o, Array) else o for o in out)
+
+        if method == "at":
+            return _ufunc_at(ufunc, *inputs, **kwargs)
+        if method in ["__call__", "outer"]:
+            values, unit = _ufunc_call(ufunc, method, inputs, kwargs)
+        elif method in ["reduce", "accumulate", "reduceat"]:
+            values, unit = _ufunc_reduce(ufunc, method, inputs, kwargs)
+        else:
             return NotImplemented
-        return self._wrap_numpy(ufunc, *inputs, **kwargs)
+
+        if unit is None:
+            # Comparisons return plain boolean arrays
+            return values
+        if out is None:
+            if isinstance(values, tuple):
+                return tuple(self.__class__(values=v, unit=unit) for v in values)
+            return self.__class__(values=values, unit=unit)
+        results = []
+        for o, v in zip(out, kwargs["out"]):
+            if isinstance(o, Array):
+                o._unit = unit
+                results.append(o)
+            else:
+                results.append(self.__class__(values=v, unit=unit))
+        return results[0] if len(results) == 1 else tuple(results)
 
     def __array_function__(self, func, types, args, kwargs):
         """
         Numpy array_function protocol to allow Array to work with numpy
         functions.
         """
+        if func.__name__ == "average":
+            return _average(*args, **kwargs)
+        if func.__name__ == "var":
+            result = self._wrap_numpy(func, *args, **kwargs)
+            result._unit = power_unit(self._unit, 2)
+            return result
         return self._wrap_numpy(func, *args, **kwargs)
 
-    def min(self):
-        return self.__class__(values=self._array.min(), unit=self._unit)
+    def min(self, axis=None, **kwargs):
+        return self.__class__(values=self._array.min(axis=axis, **kwargs),
+                              unit=self._unit)
+
+    def max(self, axis=None, **kwargs):
+        return self.__class__(values=self._array.max(axis=axis, **kwargs),
+                              unit=self._unit)
+
+    def sum(self, axis=None, **kwargs):
+        return self.__class__(values=self._array.sum(axis=axis, **kwargs),
+                              unit=self._unit)
+
+    def mean(self, axis=None, **kwargs):
+        return self.__class__(values=self._array.mean(axis=axis, **kwargs),
+                              unit=self._unit)
+
+    def std(self, axis=None, **kwargs):
+        return self.__class__(values=self._array.std(axis=axis, **kwargs),
+                              unit=self._unit)
 
-    def max(self):
-        return self.__class__(values=self._array.max(), unit=self._unit)
+    def average(self, axis=None, weights=None, **kwargs):
+        return _average(self, axis=axis, weights=weights, **kwargs)
 
     def reshape(self, *shape):
         return self.__class__(values=self._array.reshape(*shape), unit=self._unit)
+
+
+# Ufuncs whose operands must have the same unit, which is also the unit of the result
+_SAME_UNIT_UFUNCS = [
+    "add", "subtract", "maximum", "minimum", "fmax", "fmin", "hypot", "remainder",
+    "fmod", "copysign", "nextafter"
+]
+# Ufuncs whose operands must have the same unit, and which return booleans
+_COMPARISON_UFUNCS = [
+    "less", "less_equal", "greater", "greater_equal", "equal", "not_equal"
+]
+# Ufuncs whose operands must have compatible units, and whose result has a fixed unit
+_RATIO_UFUNCS = {"arctan2": "radian", "floor_divide": "dimensionless"}
+# Ufuncs that change the unit of their (single) Array operand
+_POWER_UFUNCS = {"sqrt": 0.5, "square": 2, "cbrt": 1.0 / 3.0, "reciprocal": -1}
+
+
+def _values_in(operand, unit):
+    """
+    The values of an Array, Quantity or plain number, expressed in ``unit``.
+    Plain numbers and ndarrays are assumed to already be in ``unit``.
+    """
+    if isinstance(operand, Array):
+        factor = conversion_factor(operand._unit, unit)
+        return operand._array if factor == 1.0 else operand._array * factor
+    if isinstance(operand, Quantity):
+        return operand.magnitude * conversion_factor(from_pint(operand.units), unit)
+    return operand
+
+
+def _raw_values(operand):
+    """
+    The values of an Array or Quantity, without any unit conversion.
+    """
+    if isinstance(operand, Array):
+        return operand._array
+    if isinstance(operand, Quantity):
+        return operand.magnitude
+    return operand
+
+
+def _unit_of(operand):
+    """
+    The unit of an Array, or of a Quantity (excluding its magnitude).
+    """
+    if isinstance(operand, Array):
+        return operand._unit
+    if isinstance(operand, Quantity):
+        return from_pint(operand.units)
+    return None
+
+
+def _ufunc_call(ufunc, method, inputs, kwargs):
+    """
+    Apply a ufunc (``__call__`` or ``outer``) and find the unit of the result.
+    """
+    func = getattr(ufunc, method) if method != "__call__" else ufunc
+    name = ufunc.__name__
+    units_ = [_unit_of(operand) for operand in inputs]
+    unit = next(u for u in units_ if u is not None)
+
+    if name in _SAME_UNIT_UFUNCS or name in _COMPARISON_UFUNCS:
+        values = func(*[_values_in(operand, unit) for operand in inputs], **kwargs)
+        return values, (None if name in _COMPARISON_UFUNCS else unit)
+
+    if name in _RATIO_UFUNCS:
+        values = func(*[_values_in(operand, unit) for operand in inputs], **kwargs)
+        return values, from_pint(units(_RATIO_UFUNCS[name]).units)
+
+    if name in ["multiply", "true_divide", "divide"]:
+        lhs, rhs = inputs
+        lunit, runit = units_
+        scale = 1.0
+        if lunit is not None and runit is not None:
+            scale = lunit.scale * runit.scale if name == "multiply" else (lunit.scale /
+                                                                          runit.scale)
+            combine = multiply_units if name == "multiply" else divide_units
+            unit = combine(lunit, runit)
+        elif lunit is None:
+            unit = runit if name == "multiply" else inverse_unit(runit)
+        else:
+            unit = lunit
+        values = func(
+            *[
+                operand.magnitude if isinstance(operand, Quantity) else
+                operand._array if isinstance(operand, Array) else operand
+                for operand in inputs
+            ], **kwargs)
+        if scale != 1.0:
+            if "out" in kwargs:
+                np.multiply(values, scale, out=values, where=kwargs.get("where", True))
+            elif np.issubdtype(np.result_type(values), np.inexact):
+                values *= scale
+            else:
+                # Integer results cannot be scaled in place
+                values = values * scale
+        return values, unit
+
+    if name == "power":
+        if units_[1] is not None and not units_[1].dimensionless:
+            raise TypeError("The exponent of a power must be dimensionless.")
+        exponent = _raw_values(inputs[1])
+        if np.ndim(exponent) > 0:
+            raise TypeError("The exponent of a power applied to an Array must be a "
+                            "scalar.")
+        values = func(inputs[0]._array, exponent, **kwargs)
+        return values, power_unit(inputs[0]._unit, np.asarray(exponent).item())
+
+    if name in _POWER_UFUNCS:
+        values = func(inputs[0]._array, **kwargs)
+        return values, power_unit(unit, _POWER_UFUNCS[name])
+
+    if len(inputs) > 1 and all(u is not None for u in units_):
+        # Generic binary operation between two Arrays: let pint find the unit
+        unit = from_pint(
+            ufunc(*[u.quantity for u in units_]) if method == "__call__" else func(
+                *[u.quantity for u in units_]))
+    values = func(*[_raw_values(operand) for operand in inputs], **kwargs)
+    return values, unit
+
+
+def _ufunc_reduce(ufunc, method, inputs, kwargs):
+    """
+    Apply a ufunc ``reduce``, ``accumulate`` or ``reduceat``, and find the unit of
+    the result.
+    """
+    array = inputs[0]
+    name = ufunc.__name__
+    if isinstance(kwargs.get("initial"), (Array, Quantity)):
+        kwargs["initial"] = _values_in(kwargs["initial"], array._unit)
+    values = getattr(ufunc, method)(array._array, *inputs[1:], **kwargs)
+    if name in _SAME_UNIT_UFUNCS or array._unit.dimensionless:
+        return values, array._unit
+    if name in _COMPARISON_UFUNCS or name.startswith("logical_"):
+        return values, None
+    if name == "multiply" and method == "reduce" and "where" not in kwargs:
+        axis = kwargs.get("axis", 0)
+        if axis is None:
+            count = array._array.size
+        else:
+            axes = axis if isinstance(axis, tuple) else (axis, )
+            count = int(np.prod([array._array.shape[a] for a in axes]))
+        return values, power_unit(array._unit, count)
+    raise TypeError("Cannot apply {}.{} to an Array with unit {}: the resulting unit "
+                    "would not be the same for all elements.".format(
+                        name, method, array.unit))
+
+
+def _ufunc_at(ufunc, array, indices, *operands, **kwargs):
+    """
+    Apply a ufunc in-place on selected elements of an Array (``ufunc.at``).
+    """
+    if isinstance(indices, Array):
+        indices = indices._array
+    name = ufunc.__name__
+    if operands:
+        operand = operands[0]
+        if name in _SAME_UNIT_UFUNCS:
+            operand = _values_in(operand, array._unit)
+        elif _unit_of(operand) is not None and not (_unit_of(operand).dimensionless
+                                                    and _unit_of(operand).scale == 1.0):
+            raise TypeError("Cannot apply {}.at with an operand that has a unit, as "
+                            "the unit of the Array would not be the same for all "
+                            "elements.".format(name))
+        else:
+            operand = _raw_values(operand)
+        operands = (operand, )
+    elif name in _POWER_UFUNCS and not array._unit.dimensionless:
+        raise TypeError("Cannot apply {}.at to an Array with unit {}.".format(
+            name, array.unit))
+    ufunc.at(array._array, indices, *operands)
+
+
+def _average(array, axis=None, weights=None, **kwargs):
+    """
+    Weighted average of an Array. The weights can be Arrays or plain numbers.
+    """
+    if isinstance(weights, Array):
+        weights = weights._array
+    result = np.average(array._array, axis=axis, weights=weights, **kwargs)
+    if isinstance(result, tuple):
+        return tuple(Array(values=r, unit=array._unit) for r in result)
+    return Array(values=result, unit=array._unit)
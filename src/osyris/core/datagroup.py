@@ -1,13 +1,52 @@
 # SPDX-License-Identifier: BSD-3-Clause
 # Copyright (c) 2022 Osyris contributors (https://github.com/nvaytet/osyris)
+import os
+import uuid
+import weakref
 import numpy as np
 from .array import Array
+from .lazy import LazyArray
 from .tools import bytes_to_human_readable
 
 
+def _compose_selection(selection, key, size):
+    """
+    Combine an existing selection (``None``, a slice or an array of indices) with a
+    new key (integer, slice, boolean mask or array of indices). Chains of slices
+    remain slices, everything else becomes a single array of indices.
+    """
+    if size is None:
+        size = 0
+    if isinstance(key, Array):
+        key = key.values
+    if isinstance(key, (int, np.integer)):
+        if key < 0:
+            key += size if selection is None else _selection_size(selection, size)
+        key = slice(key, key + 1, 1)
+    if selection is None:
+        selection = slice(None)
+    if isinstance(key, slice) and isinstance(selection, slice):
+        indices = range(size)[selection][key]
+        return slice(indices.start, indices.stop if indices.stop >= 0 else None,
+                     indices.step)
+    if isinstance(selection, slice):
+        selection = np.arange(size)[selection]
+    return selection[key]
+
+
+def _selection_size(selection, size):
+    if isinstance(selection, slice):
+        return len(range(size)[selection])
+    return len(selection)
+
+
 class Datagroup:
     def __init__(self, data=None, parent=None):
         self._container = {}
+        self._derived = {}
+        self._evicted = {}
+        # Incremented every time the content of the group changes
+        self._version = 0
         self._parent = parent
         self._name = ""
         self.shape = None
@@ -16,23 +55,43 @@ class Datagroup:
                 self[key] = array
 
     def __iter__(self):
-        return self._container.__iter__()
+        return iter(self.keys())
 
     def __len__(self):
-        return self._container.__len__()
+        return len(self.keys())
+
+    def __contains__(self, key):
+        return key in self._container or key in self._derived or key in self._evicted
 
     def __getitem__(self, key):
         if isinstance(key, str):
-            return self._container[key]
+            if key in self._evicted:
+                self._reload(key)
+            elif key not in self._container and key in self._derived:
+                func, dependencies = self._derived[key]
+                self._insert(key,
+                             func(*[self._dependency(dep) for dep in dependencies]))
+            array = self._container[key]
+            if self._parent is not None:
+                self._parent._touch(self, key)
+            return array
         else:
-            if isinstance(key, int):
-                key = slice(key, key + 1, 1)
-            d = self.__class__()
-            for name, val in self.items():
-                d[name] = val[key]
-            return d
+            return DatagroupView(source=self,
+                                 selection=_compose_selection(None, key, self.shape))
 
     def __setitem__(self, key, value):
+        # Explicitly setting a value replaces any derived field with the same name
+        self._derived.pop(key, None)
+        self._discard_spill(key)
+        self._insert(key, value)
+        self._invalidate(key)
+        self._version += 1
+        if self._parent is not None:
+            self._parent._touch(self, key)
+
+    def _insert(self, key, value):
+        if isinstance(value, LazyArray):
+            value = value.compute()
         if len(value.shape) > 0:
             shape = value.shape[0]
         else:
@@ -53,15 +112,30 @@ class Datagroup:
             self._container[key] = Array(values=value, name=key, parent=self)
 
     def __delitem__(self, key):
-        return self._container.__delitem__(key)
+        if key in self._derived:
+            del self._derived[key]
+            self._container.pop(key, None)
+        elif key in self._evicted:
+            self._discard_spill(key)
+        else:
+            self._container.__delitem__(key)
+        self._invalidate(key)
+        self._version += 1
+        if self._parent is not None:
+            self._parent._usage.pop((self.name, key), None)
 
     def __repr__(self):
         return str(self)
 
     def __str__(self):
         output = "Datagroup: {} {}\n".format(self.name, self.print_size())
-        for key, item in self.items():
+        for key, item in self._container.items():
             output += str(item) + "\n"
+        for key in self._derived:
+            if key not in self._container:
+                output += "'{}' Derived (not computed)\n".format(key)
+        for key in self._evicted:
+            output += "'{}' Evicted\n".format(key)
         return output
 
     @property
@@ -81,21 +155,325 @@ class Datagroup:
         self._name = name_
 
     def keys(self):
-        return self._container.keys()
+        return list(self._container.keys()) + list(self._evicted.keys()) + [
+            key for key in self._derived if key not in self._container
+        ]
 
     def items(self):
-        return self._container.items()
+        return [(key, self[key]) for key in self.keys()]
 
     def values(self):
-        return self._container.values()
+        return [self[key] for key in self.keys()]
+
+    def derive(self, key, func, dependencies):
+        """
+        Register a derived field, which is computed from other fields only when it
+        is first accessed, and then cached. The cached value is discarded when one
+        of its dependencies is replaced or deleted, and computed again on the next
+        access.
+
+        :param key: The name of the derived field.
+
+        :param func: The function computing the field. It receives the dependencies
+            as positional arguments, and should return an Array or a LazyArray.
+
+        :param dependencies: A list of the fields the derived field depends on.
+            Each dependency is either the name of a field in this Datagroup, or a
+            ``(group, key)`` tuple for a field in another group of the parent
+            Dataset, e.g. ``('amr', 'dx')``.
+        """
+        dependencies = list(dependencies)
+        for dep in dependencies:
+            if not self._has_dependency(dep):
+                raise KeyError("Dependency {} of derived field '{}' was not "
+                               "found.".format(dep, key))
+        self._derived[key] = (func, dependencies)
+        self._container.pop(key, None)
+        self._invalidate(key)
+        self._version += 1
+
+    def is_derived(self, key):
+        """
+        Return ``True`` if ``key`` is a derived field.
+        """
+        return key in self._derived
+
+    def _has_dependency(self, dep):
+        if isinstance(dep, str):
+            return dep in self
+        if self._parent is None:
+            return False
+        group, key = dep
+        return group in self._parent.keys() and key in self._parent[group]
+
+    def _dependency(self, dep):
+        if isinstance(dep, str):
+            return self[dep]
+        group, key = dep
+        return self._parent[group][key]
+
+    def _depends_on(self, dep, group, key):
+        """
+        Check whether the dependency ``dep`` of a derived field of this Datagroup
+        refers to the field ``key`` of ``group``.
+        """
+        if isinstance(dep, str):
+            return group is self and dep == key
+        if self._parent is None:
+            return False
+        return dep[1] == key and self._parent.groups.get(dep[0]) is group
+
+    def _invalidate(self, key):
+        """
+        Discard the cached values of all the derived fields (in this group or in
+        the other groups of the parent Dataset) which depend on ``key``.
+        """
+        groups = [self] if self._parent is None else list(self._parent.values())
+        for group in groups:
+            for name, (func, dependencies) in group._derived.items():
+                if name in group._container and any(
+                        group._depends_on(dep, self, key) for dep in dependencies):
+                    del group._container[name]
+                    group._invalidate(name)
+
+    def _evict(self, key, directory):
+        """
+        Remove a column from memory. Derived fields are simply dropped, as they
+        can be computed again, other columns are saved to a spill file in
+        ``directory``, and are loaded back on the next access.
+        """
+        array = self._container.pop(key)
+        if key in self._derived:
+            return
+        filename = os.path.join(directory, "{}.npy".format(uuid.uuid4().hex))
+        np.save(filename, array._array)
+        # Keep track of the column in case it is still referenced outside of the
+        # group, so that changes made through these references are not lost
+        self._evicted[key] = (filename, array._unit, weakref.ref(array),
+                              weakref.ref(array._array))
+
+    def _reload(self, key):
+        """
+        Load an evicted column back into memory. If the Array, or its values, are
+        still alive, they are used instead of the spill file.
+        """
+        filename, unit, array_ref, values_ref = self._evicted.pop(key)
+        array = array_ref()
+        if array is None:
+            values = values_ref()
+            if values is None:
+                values = np.load(filename)
+            array = Array(values=values, unit=unit)
+        self._insert(key, array)
+        os.remove(filename)
+
+    def _peek(self, key):
+        """
+        The values and unit of a stored column. An evicted column is not loaded
+        back into the group, a memory map of its spill file is returned instead.
+        """
+        if key not in self._evicted:
+            array = self[key]
+            return array._array, array._unit
+        filename, unit, array_ref, values_ref = self._evicted[key]
+        array = array_ref()
+        if array is not None:
+            return array._array, array._unit
+        values = values_ref()
+        if values is None:
+            values = np.load(filename, mmap_mode="r")
+        return values, unit
+
+    def _discard_spill(self, key):
+        if key in self._evicted:
+            os.remove(self._evicted.pop(key)[0])
 
     def set_scale(self, scale):
         for key in ["x", "y", "z", "dx"]:
-            if key in self:
+            if key in self._container or key in self._evicted:
                 self[key].to(scale)
 
     def nbytes(self):
-        return np.sum([item._array.nbytes for item in self.values()])
+        return np.sum([item._array.nbytes for item in self._container.values()])
+
+    def print_size(self):
+        return bytes_to_human_readable(self.nbytes())
+
+
+class DatagroupView:
+    """
+    A lazy selection of the rows of a :class:`Datagroup`. Only a single composed
+    slice or array of indices is stored, and it is applied to a column when that
+    column is accessed. Selecting from a view returns a new view on the original
+    Datagroup. Use :meth:`materialize` to create a new Datagroup with copies of all
+    the selected columns.
+
+    The selected columns are cached, and selected again only when the column of
+    the original Datagroup is replaced or converted to another unit. As for
+    :class:`Datagroup`, changing the values of a column in place (e.g.
+    ``array.values *= 2``) is not detected.
+    """
+    def __init__(self, source, selection):
+        self._source = source
+        self._selection = selection
+        self._container = {}
+        # The selected columns, with the state of the source they were selected from
+        self._selected = {}
+        self._name = source.name
+        self.shape = _selection_size(selection, source.shape)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __contains__(self, key):
+        return key in self._container or key in self._source
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            if key in self._container:
+                return self._container[key]
+            array = self._cached(key)
+            if array is None:
+                column = self._source[key]
+                array = column[self._selection]
+                array.parent = self
+                self._selected[key] = (array,
+                                       self._source._version, weakref.ref(column),
+                                       id(column._array), column._unit)
+            return array
+        return self.__class__(source=self._source,
+                              selection=_compose_selection(self._selection, key,
+                                                           self._source.shape))
+
+    def __setitem__(self, key, value):
+        if isinstance(value, LazyArray):
+            value = value.compute()
+        if len(value.shape) > 0:
+            shape = value.shape[0]
+        else:
+            shape = 1
+        if self.shape != shape:
+            raise RuntimeError("Size mismatch on element insertion. Item "
+                               "shape is {} while container accepts shape {}.".format(
+                                   shape, self.shape))
+        if not isinstance(value, Array):
+            value = Array(values=value)
+        value.name = key
+        value.parent = self
+        self._container[key] = value
+
+    def __delitem__(self, key):
+        return self._container.__delitem__(key)
+
+    def __repr__(self):
+        return str(self)
+
+    def __str__(self):
+        output = "DatagroupView: {} ({} of {} elements)\n".format(
+            self.name, self.shape, self._source.shape)
+        for key in self.keys():
+            array = self._container.get(key, self._cached(key))
+            if array is None:
+                output += "'{}' Not selected yet\n".format(key)
+            else:
+                output += str(array) + "\n"
+        return output
+
+    def _cached(self, key):
+        """
+        The cached selection of a column of the source, if it is still up to date.
+        """
+        entry = self._selected.get(key)
+        if entry is None:
+            return None
+        array, version, column_ref, values_id, unit = entry
+        column = column_ref()
+        if (version != self._source._version or column is None
+                or id(column._array) != values_id or column._unit is not unit):
+            del self._selected[key]
+            return None
+        return array
+
+    @property
+    def parent(self):
+        return self._source.parent
+
+    @property
+    def name(self):
+        return self._name
+
+    @name.setter
+    def name(self, name_):
+        self._name = name_
+
+    @property
+    def selection(self):
+        return self._selection
+
+    def keys(self):
+        return list(self._source.keys()) + [
+            key for key in self._container if key not in self._source.keys()
+        ]
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def values(self):
+        return [self[key] for key in self.keys()]
+
+    def is_derived(self, key):
+        """
+        Return ``True`` if ``key`` is a derived field of the original Datagroup.
+        """
+        return key not in self._container and self._source.is_derived(key)
+
+    def _peek(self, key):
+        """
+        The selected values and unit of a column, without caching them in the view.
+        Evicted columns are not loaded back into the original Datagroup.
+        """
+        if key in self._container:
+            return self._container[key]._array, self._container[key]._unit
+        values, unit = self._source._peek(key)
+        return values[self._selection], unit
+
+    def materialize(self):
+        """
+        Return a new Datagroup with copies of the selected rows of the stored
+        columns. Evicted columns are read from their spill files without being
+        loaded back into the original Datagroup. Derived fields are not computed,
+        they are registered again on the new Datagroup. Derived fields which
+        depend on other groups of the Dataset are computed from the original
+        Datagroup on their first access.
+        """
+        group = Datagroup()
+        for key in self.keys():
+            if key in self._container:
+                group[key] = self._copy(key)
+            elif not self._source.is_derived(key):
+                values, unit = self._source._peek(key)
+                group[key] = Array(values=np.array(values[self._selection]), unit=unit)
+        for key, (func, dependencies) in self._source._derived.items():
+            if key in self._container:
+                continue
+            if all(isinstance(dep, str) and dep in group for dep in dependencies):
+                group._derived[key] = (func, list(dependencies))
+            else:
+                group._derived[key] = (lambda key=key: self._copy(key), [])
+        return group
+
+    def _copy(self, key):
+        array = self[key]
+        return Array(values=np.array(array._array), unit=array._unit)
+
+    def nbytes(self):
+        nbytes = np.sum([item._array.nbytes for item in self._container.values()])
+        if isinstance(self._selection, np.ndarray):
+            nbytes += self._selection.nbytes
+        return nbytes
 
     def print_size(self):
         return bytes_to_human_readable(self.nbytes())
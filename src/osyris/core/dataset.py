@@ -1,17 +1,37 @@
 # SPDX-License-Identifier: BSD-3-Clause
 # Copyright (c) 2022 Osyris contributors (https://github.com/nvaytet/osyris)
+from collections import OrderedDict
+import shutil
+import tempfile
+import weakref
 import numpy as np
 from .. import config
 from ..io import Loader
-from .datagroup import Datagroup
-from .tools import bytes_to_human_readable
+from ..io.hilbert import curve_keys
+from .array import Array, _values_in
+from .datagroup import Datagroup, DatagroupView
+from .spatial import CellIndex, resample
+from .tools import bytes_to_human_readable, human_readable_to_bytes
 
 
 class Dataset:
-    def __init__(self, nout=None, scale=None, path=""):
+    """
+    A collection of Datagroups, with the metadata of a simulation output.
+
+    If a ``memory_limit`` (e.g. ``"16GB"``) is given, the total size of the columns
+    held in memory is kept under that limit: the least recently used columns are
+    evicted to a spill file on disk, and are loaded back transparently when they are
+    accessed again. Derived fields are not spilled, they are computed again.
+    """
+    def __init__(self, nout=None, scale=None, path="", memory_limit=None):
         self.groups = {}
         self.meta = {}
         self.loader = None
+        self.memory_limit = None
+        if memory_limit is not None:
+            self.memory_limit = human_readable_to_bytes(memory_limit)
+        self._usage = OrderedDict()
+        self._spill_directory = None
         if scale is None:
             scale = config.parameters["scale"]
         if nout is not None:
@@ -28,14 +48,25 @@ class Dataset:
         return self.groups[key]
 
     def __setitem__(self, key, value):
+        if isinstance(value, DatagroupView):
+            # A selection of rows is stored as an independent copy
+            value = value.materialize()
         if not isinstance(value, Datagroup):
             raise TypeError("Only objects of type Datagroup can be inserted into a "
                             "Dataset.")
+        if key in self.groups:
+            # Discard derived fields computed from the group being replaced
+            for array_key in self.groups[key].keys():
+                self.groups[key]._invalidate(array_key)
+            self._forget(key)
         self.groups.__setitem__(key, value)
         value.name = key
         value.parent = self
+        for array_key in list(value._container):
+            self._touch(value, array_key)
 
     def __delitem__(self, key):
+        self._forget(key)
         return self.groups.__delitem__(key)
 
     def __repr__(self):
@@ -59,13 +90,222 @@ class Dataset:
     def values(self):
         return self.groups.values()
 
-    def load(self, *args, **kwargs):
+    def load(self, *args, sort=None, **kwargs):
+        """
+        Load the data from disk. If ``sort`` is set to ``'hilbert'`` or ``'morton'``,
+        the cells and particles are reordered along the corresponding space-filling
+        curve once loaded (see :meth:`reorder`).
+        """
         groups = self.loader.load(*args, meta=self.meta, **kwargs)
         for name, group in groups.items():
             self[name] = group
+        if sort is not None:
+            self.reorder(kind=sort)
         config.additional_variables(self)
         return self
 
+    def reorder(self, kind="hilbert"):
+        """
+        Permute the columns of every Datagroup so that elements are sorted along a
+        space-filling curve (``'hilbert'`` or ``'morton'``). Elements which are
+        close in space then also end up close in memory. Cell-based groups all
+        follow the ordering of the ``amr`` cell positions, while groups that carry
+        their own positions (``xyz`` or ``position``, e.g. particles) are sorted
+        independently.
+        """
+        cell_order = None
+        if "amr" in self.groups and "xyz" in self.groups["amr"]:
+            half_sizes = None
+            if "dx" in self.groups["amr"]:
+                half_sizes = 0.5 * self.groups["amr"]["dx"].values
+            cell_order = np.argsort(curve_keys(self.groups["amr"]["xyz"].values,
+                                               kind=kind,
+                                               half_sizes=half_sizes),
+                                    kind="stable")
+        for name, group in self.groups.items():
+            order = None
+            for key in ["xyz", "position"]:
+                if key in group and name != "amr":
+                    order = np.argsort(curve_keys(group[key].values, kind=kind),
+                                       kind="stable")
+                    break
+            if order is None and cell_order is not None:
+                if group.shape == len(cell_order):
+                    order = cell_order
+            if order is not None:
+                # The columns are permuted one at a time, so that evicted columns
+                # are loaded back within the memory limit. Derived fields which
+                # have not been computed yet are left alone.
+                for key in list(group._container) + list(group._evicted):
+                    if key in group._container or key in group._evicted:
+                        array = group[key]
+                        array.values = array.values[order]
+                group._version += 1
+        return self
+
+    def covering_grid(self,
+                      fields,
+                      region=None,
+                      level=None,
+                      shape=None,
+                      method="nearest",
+                      out=None,
+                      filename=None,
+                      chunk=None):
+        """
+        Resample AMR fields onto a uniform grid covering a region, e.g. for FFTs
+        or external tools. The resampling is done by a multi-threaded kernel, one
+        slab of ``chunk`` planes (along ``x``) at a time, writing directly into
+        the output array, which can be memory-mapped to a file for grids which do
+        not fit in memory.
+
+        :param fields: The Array, or list of Arrays, to be resampled. They must
+            belong to a group of cells, like ``hydro``.
+
+        :param region: The lower and upper corners of the region, as Arrays,
+            Quantities or lists of numbers (in the unit of the cell positions).
+            Default is ``None``, in which case the region covered by all the cells
+            is used.
+
+        :param level: The refinement level whose cell size is used as the voxel
+            size. The region is expanded to align with the cells of that level.
+            Requires the ``level`` of the cells in the ``amr`` group.
+
+        :param shape: The number of voxels along each dimension, as an integer or
+            a tuple. Only one of ``level`` and ``shape`` can be given.
+
+        :param method: ``'nearest'``, where each voxel takes the value of the cell
+            at its center, or ``'conservative'``, where each voxel takes the
+            volume-weighted average of the cells it overlaps. Default is
+            ``'nearest'``.
+
+        :param out: A preallocated output array. Default is ``None``.
+
+        :param filename: If ``out`` is not given, the output array is created as a
+            memory-mapped ``.npy`` file with this name. Default is ``None``, in
+            which case it is created in memory.
+
+        :param chunk: The number of planes resampled at a time. Default is
+            ``None``, which selects slabs of about 4 million voxels.
+
+        :return: An array with shape ``(ncomponents, nx, ny, nz)``, where the
+            components of all the fields are stacked in order (1 for a scalar
+            field, 3 for a vector field). Voxels outside of all cells are NaN.
+        """
+        if method not in ["nearest", "conservative"]:
+            raise ValueError("Unknown resampling method '{}', possible choices are "
+                             "['nearest', 'conservative'].".format(method))
+        if (level is None) == (shape is None):
+            raise ValueError("Exactly one of 'level' and 'shape' must be given.")
+        if isinstance(fields, Array):
+            fields = [fields]
+        amr = self.groups["amr"]
+        xyz = amr["xyz"]
+        ncells = len(xyz)
+        positions = np.asarray(xyz.values, dtype=np.float64).reshape(ncells, -1)
+        ndim = positions.shape[1]
+        half_sizes = 0.5 * np.asarray(amr["dx"].values, dtype=np.float64)
+
+        if region is None:
+            lower = (positions - half_sizes.reshape(-1, 1)).min(axis=0)
+            upper = (positions + half_sizes.reshape(-1, 1)).max(axis=0)
+        else:
+            lower, upper = [
+                np.asarray(_values_in(corner, xyz._unit) / xyz._unit.magnitude,
+                           dtype=np.float64).reshape(ndim) for corner in region
+            ]
+        if level is not None:
+            if "level" not in amr:
+                raise ValueError("The 'level' of the cells is required to select "
+                                 "the grid by level, use 'shape' instead.")
+            size = 2.0 * half_sizes[0] * 2.0**(amr["level"].values[0] - level)
+            lower = np.floor(lower / size + 1.0e-9) * size
+            upper = np.ceil(upper / size - 1.0e-9) * size
+            shape = np.round((upper - lower) / size).astype(np.int64)
+        shape = tuple(np.broadcast_to(np.asarray(shape, dtype=np.int64), (ndim, )))
+        spacing = (upper - lower) / np.array(shape)
+
+        ncomponents = [int(np.prod(field.shape[1:])) for field in fields]
+        full_shape = (sum(ncomponents), ) + shape
+        if out is None:
+            if filename is not None:
+                out = np.lib.format.open_memmap(filename,
+                                                mode="w+",
+                                                dtype=np.float64,
+                                                shape=full_shape)
+            else:
+                out = np.empty(full_shape)
+        elif out.shape != full_shape:
+            raise ValueError("The output array has shape {}, expected {}.".format(
+                out.shape, full_shape))
+        if chunk is None:
+            chunk = max(2**22 // max(int(np.prod(shape[1:])), 1), 1)
+
+        index = CellIndex(positions=positions, half_sizes=half_sizes)
+        # Convert the fields once, not for every slab
+        values = [
+            np.asarray(field.values, dtype=np.float64).reshape(ncells, ncomp)
+            for field, ncomp in zip(fields, ncomponents)
+        ]
+        for start in range(0, shape[0], chunk):
+            stop = min(start + chunk, shape[0])
+            offset = 0
+            for field_values, ncomp in zip(values, ncomponents):
+                slab = np.asarray(out[offset:offset + ncomp, start:stop]).view()
+                # Raises an error instead of making a copy
+                slab.shape = (ncomp, -1)
+                resample(values=field_values,
+                         half_sizes=half_sizes,
+                         index=index,
+                         lower=lower,
+                         spacing=spacing,
+                         shape=shape,
+                         start=start,
+                         method=method,
+                         out=slab)
+                offset += ncomp
+        if isinstance(out, np.memmap):
+            out.flush()
+        return out
+
+    def _touch(self, group, key):
+        """
+        Mark a column as the most recently used, and evict the least recently used
+        columns if the memory limit is exceeded.
+        """
+        if self.memory_limit is None:
+            return
+        item = (group.name, key)
+        self._usage[item] = group._container[key]._array.nbytes
+        self._usage.move_to_end(item)
+        total = sum(self._usage.values())
+        while total > self.memory_limit:
+            oldest, nbytes = next(iter(self._usage.items()))
+            if oldest == item:
+                # Never evict the column that is being used
+                break
+            del self._usage[oldest]
+            total -= nbytes
+            name, array_key = oldest
+            if name in self.groups and array_key in self.groups[name]._container:
+                self.groups[name]._evict(array_key, self._spill_path())
+
+    def _forget(self, group_name):
+        """
+        Stop tracking the columns of a group which is removed from the Dataset.
+        """
+        for item in [item for item in self._usage if item[0] == group_name]:
+            del self._usage[item]
+
+    def _spill_path(self):
+        if self._spill_directory is None:
+            self._spill_directory = tempfile.mkdtemp(prefix="osyris-")
+            weakref.finalize(self,
+                             shutil.rmtree,
+                             self._spill_directory,
+                             ignore_errors=True)
+        return self._spill_directory
+
     def nbytes(self):
         return np.sum([item.nbytes() for item in self.groups.values()])
 
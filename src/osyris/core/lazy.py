@@ -0,0 +1,348 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (c) 2022 Osyris contributors (https://github.com/nvaytet/osyris)
+
+import math
+import numpy as np
+from numba import njit, prange
+from pint.quantity import Quantity
+from .array import Array
+from .unit import (from_pint, conversion_factor, multiply_units, divide_units,
+                   power_unit, inverse_unit)
+
+# Numpy ufuncs which can be used inside a lazy expression, with the function they
+# become inside the compiled kernel
+_FUNCTIONS = {
+    "sqrt": "np.sqrt",
+    "exp": "np.exp",
+    "log": "np.log",
+    "log10": "np.log10",
+    "sin": "np.sin",
+    "cos": "np.cos",
+    "tan": "np.tan",
+    "arcsin": "np.arcsin",
+    "arccos": "np.arccos",
+    "arctan": "np.arctan",
+    "sinh": "np.sinh",
+    "cosh": "np.cosh",
+    "tanh": "np.tanh",
+    "absolute": "abs"
+}
+_OPERATORS = {"add": "+", "sub": "-", "mul": "*", "div": "/"}
+
+# Compiled kernels, looked up by the source of the expression they evaluate
+_KERNELS = {}
+
+
+def _leaf(array):
+    return ("leaf", array)
+
+
+def _scale(node, factor):
+    """
+    Multiply a node by a constant, merging consecutive constant factors.
+    """
+    if factor == 1.0:
+        return node
+    if node[0] == "scale":
+        return _scale(node[1], node[2] * factor)
+    return ("scale", node, factor)
+
+
+def _reshape_leaves(node, shape, new_shape):
+    """
+    Reshape all the leaves of a graph which have the shape of the whole graph.
+    This reproduces the broadcasting rules of Array arithmetic, where an (N,) array
+    is combined with an (N, 3) array.
+    """
+    if node[0] == "leaf":
+        if node[1].shape == shape:
+            return _leaf(node[1].reshape(new_shape))
+        return node
+    return tuple(
+        _reshape_leaves(item, shape, new_shape) if isinstance(item, tuple) else item
+        for item in node)
+
+
+class LazyArray:
+    """
+    A deferred computation on Arrays. Operations on a LazyArray build an expression
+    graph instead of allocating a new array at every step. Units are resolved, and
+    the corresponding conversion factors folded into the graph, at build time.
+    The expression is evaluated in a single fused, multi-threaded pass when
+    :meth:`compute` is called. The compiled kernels are cached by expression
+    signature, so that they are re-used for every output with the same expression.
+
+    A LazyArray is created with :meth:`Array.lazy`.
+    """
+    def __init__(self, node, unit, shape, name=""):
+        self._node = node
+        self._unit = unit
+        self._shape = shape
+        self._name = name
+
+    @classmethod
+    def from_array(cls, array):
+        return cls(node=_leaf(array._array),
+                   unit=array._unit,
+                   shape=array.shape,
+                   name=array.name)
+
+    def __str__(self):
+        return "'{}' Lazy [{:~}] {}".format(self._name, self._unit.units, self._shape)
+
+    def __repr__(self):
+        return str(self)
+
+    @property
+    def unit(self):
+        return self._unit.quantity
+
+    @property
+    def shape(self):
+        return self._shape
+
+    @property
+    def ndim(self):
+        if self._shape:
+            return self._shape[-1]
+        return 0
+
+    @property
+    def name(self):
+        return self._name
+
+    @name.setter
+    def name(self, name_):
+        self._name = name_
+
+    @property
+    def is_lazy(self):
+        return True
+
+    def _operand(self, other, op):
+        """
+        Convert the other operand of a binary operation to a LazyArray.
+        """
+        if isinstance(other, LazyArray):
+            return other
+        if isinstance(other, Array):
+            return self.from_array(other)
+        if isinstance(other, Quantity):
+            return self.__class__(node=_leaf(np.asarray(other.magnitude)),
+                                  unit=from_pint(other.units),
+                                  shape=np.shape(other.magnitude))
+        if op in ["mul", "div"]:
+            return self.__class__(node=_leaf(np.asarray(other)),
+                                  unit=from_pint("dimensionless"),
+                                  shape=np.shape(other))
+        raise TypeError("Could not {} types {} and {}.".format(op, self, other))
+
+    def _binary(self, other, op):
+        lhs = self
+        rhs = self._operand(other, op)
+        lhs_node, rhs_node = lhs._node, rhs._node
+        if op in ["add", "sub"]:
+            unit = lhs._unit
+            rhs_node = _scale(rhs_node, conversion_factor(rhs._unit, lhs._unit))
+        elif isinstance(other, (LazyArray, Array, Quantity)):
+            combine = multiply_units if op == "mul" else divide_units
+            unit = combine(lhs._unit, rhs._unit)
+            factor = lhs._unit.scale * rhs._unit.scale if op == "mul" else (
+                lhs._unit.scale / rhs._unit.scale)
+        else:
+            # Multiplication or division by a plain number or ndarray
+            unit = lhs._unit
+            factor = 1.0
+            if np.ndim(other) == 0:
+                factor = float(other) if op == "mul" else 1.0 / float(other)
+                rhs_node = None
+
+        lhs_shape, rhs_shape = lhs._shape, rhs._shape
+        if len(lhs_shape) != len(rhs_shape) and lhs_shape and rhs_shape and (
+                rhs_node is not None):
+            if len(lhs_shape) > len(rhs_shape):
+                new_shape = rhs_shape + (1, ) if lhs_shape[0] == rhs_shape[0] else (
+                    1, ) + rhs_shape
+                rhs_node = _reshape_leaves(rhs_node, rhs_shape, new_shape)
+                rhs_shape = new_shape
+            else:
+                new_shape = lhs_shape + (1, ) if rhs_shape[0] == lhs_shape[0] else (
+                    1, ) + lhs_shape
+                lhs_node = _reshape_leaves(lhs_node, lhs_shape, new_shape)
+                lhs_shape = new_shape
+
+        if rhs_node is None:
+            node = lhs_node
+            shape = lhs_shape
+        else:
+            node = (op, lhs_node, rhs_node)
+            shape = np.broadcast_shapes(lhs_shape, rhs_shape)
+        if op in ["mul", "div"]:
+            node = _scale(node, factor)
+        return self.__class__(node=node, unit=unit, shape=shape)
+
+    def __add__(self, other):
+        return self._binary(other, "add")
+
+    def __radd__(self, other):
+        return self._operand(other, "add")._binary(self, "add")
+
+    def __sub__(self, other):
+        return self._binary(other, "sub")
+
+    def __rsub__(self, other):
+        return self._operand(other, "subtract")._binary(self, "sub")
+
+    def __mul__(self, other):
+        return self._binary(other, "mul")
+
+    def __rmul__(self, other):
+        return self._binary(other, "mul")
+
+    def __truediv__(self, other):
+        return self._binary(other, "div")
+
+    def __rtruediv__(self, other):
+        if isinstance(other, (LazyArray, Array, Quantity)):
+            return self._operand(other, "div")._binary(self, "div")
+        if np.ndim(other) > 0:
+            raise TypeError("Could not divide types {} and {}.".format(other, self))
+        return self.__class__(node=_scale(("inv", self._node), float(other)),
+                              unit=inverse_unit(self._unit),
+                              shape=self._shape)
+
+    def __neg__(self):
+        return self.__class__(node=_scale(self._node, -1.0),
+                              unit=self._unit,
+                              shape=self._shape)
+
+    def __abs__(self):
+        return self._function("absolute")
+
+    def __pow__(self, exponent):
+        if isinstance(exponent, (Array, Quantity, LazyArray)) or np.ndim(exponent) > 0:
+            raise TypeError("The exponent of a lazy power must be a scalar number.")
+        return self.__class__(node=("pow", self._node, float(exponent)),
+                              unit=power_unit(self._unit, exponent),
+                              shape=self._shape)
+
+    def _function(self, name):
+        unit = power_unit(self._unit, 0.5) if name == "sqrt" else self._unit
+        return self.__class__(node=("func", name, self._node),
+                              unit=unit,
+                              shape=self._shape)
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        """
+        Numpy array_ufunc protocol, to allow the use of some numpy ufuncs inside
+        lazy expressions.
+        """
+        if method != "__call__" or kwargs:
+            return NotImplemented
+        name = ufunc.__name__
+        if name in _FUNCTIONS:
+            return self._function(name)
+        if name == "negative":
+            return -self
+        if name == "square":
+            return self**2
+        if name == "power":
+            return inputs[0]**inputs[1]
+        operators = {
+            "add": "__add__",
+            "subtract": "__sub__",
+            "multiply": "__mul__",
+            "true_divide": "__truediv__",
+            "divide": "__truediv__"
+        }
+        if name in operators:
+            lhs, rhs = inputs
+            if isinstance(lhs, LazyArray):
+                return getattr(lhs, operators[name])(rhs)
+            return getattr(rhs, operators[name].replace("__", "__r", 1))(lhs)
+        return NotImplemented
+
+    def to(self, unit):
+        """
+        Convert the result of the expression to a different unit. The conversion is
+        folded into the expression, and is applied during the evaluation.
+        """
+        new_unit = from_pint(unit)
+        ratio = conversion_factor(self._unit, new_unit) / new_unit.magnitude
+        return self.__class__(node=_scale(self._node, ratio),
+                              unit=new_unit.with_magnitude(1.0 * new_unit.magnitude),
+                              shape=self._shape,
+                              name=self._name)
+
+    def compute(self, unit=None):
+        """
+        Evaluate the expression, and return the result as an Array. The result can
+        be converted to a different ``unit`` as part of the evaluation.
+        """
+        expression = self.to(unit) if unit is not None else self
+        leaves = []
+        constants = []
+        source = _codegen(expression._node, leaves, constants)
+        dtype = np.result_type(*[leaf.dtype for leaf in leaves], np.float64)
+        shape = expression._shape if expression._shape else (1, )
+        out = np.empty(shape, dtype=dtype)
+        kernel = _get_kernel(source, len(leaves), len(shape))
+        kernel(out, *[np.broadcast_to(leaf, shape) for leaf in leaves],
+               np.array(constants, dtype=np.float64))
+        if not expression._shape:
+            out = out.reshape(())
+        return Array(values=out, unit=expression._unit, name=self._name)
+
+
+def _codegen(node, leaves, constants):
+    """
+    Generate the source code evaluating one element of the expression. The input
+    arrays and the constants are collected in ``leaves`` and ``constants``, so that
+    the source only depends on the structure of the expression.
+    """
+    kind = node[0]
+    if kind == "leaf":
+        for i, leaf in enumerate(leaves):
+            if leaf is node[1]:
+                break
+        else:
+            i = len(leaves)
+            leaves.append(node[1])
+        return "x{}[{{index}}]".format(i)
+    if kind in ["scale", "pow"]:
+        constants.append(node[2])
+        index = len(constants) - 1
+        operator = "*" if kind == "scale" else "**"
+        return "({} {} c[{}])".format(_codegen(node[1], leaves, constants), operator,
+                                      index)
+    if kind == "inv":
+        return "(1.0 / {})".format(_codegen(node[1], leaves, constants))
+    if kind == "func":
+        return "{}({})".format(_FUNCTIONS[node[1]], _codegen(node[2], leaves,
+                                                             constants))
+    return "({} {} {})".format(_codegen(node[1], leaves, constants), _OPERATORS[kind],
+                               _codegen(node[2], leaves, constants))
+
+
+def _get_kernel(source, ninputs, ndim):
+    """
+    Compile (or retrieve from the cache) the kernel evaluating an expression over
+    arrays with ``ndim`` dimensions. The outermost loop is run in parallel.
+    """
+    key = (source, ninputs, ndim)
+    kernel = _KERNELS.get(key)
+    if kernel is None:
+        inputs = "".join("x{}, ".format(i) for i in range(ninputs))
+        index = ", ".join("i{}".format(d) for d in range(ndim))
+        lines = ["def kernel(out, {}c):".format(inputs)]
+        for d in range(ndim):
+            loop = "prange" if d == 0 else "range"
+            lines.append("{}for i{} in {}(out.shape[{}]):".format(
+                "    " * (d + 1), d, loop, d))
+        lines.append("{}out[{}] = {}".format("    " * (ndim + 1), index,
+                                             source.format(index=index)))
+        namespace = {"np": np, "math": math, "prange": prange}
+        exec("\n".join(lines), namespace)
+        kernel = njit(parallel=True)(namespace["kernel"])
+        _KERNELS[key] = kernel
+    return kernel
@@ -0,0 +1,472 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (c) 2022 Osyris contributors (https://github.com/nvaytet/osyris)
+
+from copy import copy
+import numpy as np
+from numba import njit, prange
+
+
+class CellIndex:
+    """
+    Spatial index of AMR cells, used to find the finest cell which contains a given
+    point.
+
+    Cells are grouped by size (i.e. by refinement level). On each level, the
+    integer coordinates of the cells on the grid of that level are combined into a
+    single key, and the keys are sorted. A point is then located with a binary
+    search on each level, from the finest to the coarsest, so that a lookup costs
+    ``O(nlevels * log(ncells))``.
+
+    :param positions: The positions of the cell centers, with shape
+        ``(ncells, ndim)``.
+
+    :param half_sizes: The half-sizes of the cells.
+    """
+    def __init__(self, positions, half_sizes):
+        positions = np.asarray(positions, dtype=np.float64)
+        if positions.ndim == 1:
+            positions = positions.reshape(-1, 1)
+        half_sizes = np.broadcast_to(np.asarray(half_sizes, dtype=np.float64),
+                                     positions.shape[:1])
+        self.ndim = positions.shape[1]
+        self.ncells = positions.shape[0]
+
+        sizes = 2.0 * half_sizes
+        levels = np.zeros(self.ncells, dtype=np.int64)
+        if self.ncells > 0:
+            levels = np.round(np.log2(sizes.max() / sizes)).astype(np.int64)
+        # Finest levels first
+        unique_levels = np.unique(levels)[::-1]
+
+        nlevels = len(unique_levels)
+        self.sizes = np.zeros(nlevels)
+        self.origins = np.zeros((nlevels, self.ndim))
+        self.extents = np.zeros((nlevels, self.ndim), dtype=np.int64)
+        self.offsets = np.zeros(nlevels + 1, dtype=np.int64)
+        keys = []
+        cells = []
+        for i, level in enumerate(unique_levels):
+            selection = np.flatnonzero(levels == level)
+            size = sizes[selection].max()
+            corners = positions[selection] - 0.5 * size
+            # Integer coordinates relative to a corner of a cell of that level, so
+            # that they are exact even if the region does not start on a coarse
+            # cell boundary
+            coords = np.round((corners - corners[0]) / size).astype(np.int64)
+            lower = coords.min(axis=0)
+            coords -= lower
+            self.sizes[i] = size
+            self.origins[i] = corners[0] + lower * size
+            self.extents[i] = coords.max(axis=0) + 1
+            level_keys = _ravel_keys(coords, self.extents[i])
+            order = np.argsort(level_keys, kind="stable")
+            keys.append(level_keys[order])
+            cells.append(selection[order])
+            self.offsets[i + 1] = self.offsets[i] + len(selection)
+        self.keys = np.concatenate(keys) if keys else np.zeros(0, dtype=np.int64)
+        self.cells = np.concatenate(cells) if cells else np.zeros(0, dtype=np.int64)
+
+    @property
+    def arrays(self):
+        """
+        The arrays describing the index, in the order expected by
+        :func:`find_cell`.
+        """
+        return (self.keys, self.cells, self.offsets, self.sizes, self.origins,
+                self.extents)
+
+    def shifted(self, offset):
+        """
+        A view of the index where the positions of the cells are moved by
+        ``-offset``, e.g. to express them relative to a different origin. Only the
+        origins of the levels are copied.
+        """
+        index = copy(self)
+        index.origins = self.origins - np.asarray(offset, dtype=np.float64).reshape(
+            1, self.ndim)
+        return index
+
+    def find(self, points):
+        """
+        Find the indices of the finest cells containing each of the ``points``.
+        The index is -1 for points which are not inside any cell.
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, self.ndim)
+        return _find_cells(points, *self.arrays)
+
+
+def _ravel_keys(coords, extents):
+    keys = np.zeros(len(coords), dtype=np.int64)
+    for d in range(coords.shape[1] - 1, -1, -1):
+        keys = keys * extents[d] + coords[:, d]
+    return keys
+
+
+@njit
+def find_cell(point, keys, cells, offsets, sizes, origins, extents):
+    """
+    Find the index of the finest cell containing ``point``, or -1.
+    """
+    ndim = origins.shape[1]
+    for level in range(len(sizes)):
+        key = 0
+        inside = True
+        for d in range(ndim - 1, -1, -1):
+            coord = int(np.floor((point[d] - origins[level, d]) / sizes[level]))
+            if coord < 0 or coord >= extents[level, d]:
+                inside = False
+                break
+            key = key * extents[level, d] + coord
+        if not inside:
+            continue
+        start = offsets[level]
+        end = offsets[level + 1]
+        pos = start + np.searchsorted(keys[start:end], key)
+        if pos < end and keys[pos] == key:
+            return cells[pos]
+    return -1
+
+
+@njit(parallel=True)
+def _find_cells(points, keys, cells, offsets, sizes, origins, extents):
+    out = np.empty(points.shape[0], dtype=np.int64)
+    for i in prange(points.shape[0]):
+        out[i] = find_cell(points[i], keys, cells, offsets, sizes, origins, extents)
+    return out
+
+
+def resample(values, half_sizes, index, lower, spacing, shape, start, method, out):
+    """
+    Resample cell ``values`` (with shape ``(ncells, ncomponents)``) onto a slab
+    of planes of a uniform grid with the given ``shape``, whose lower corner is
+    ``lower`` and whose voxels have sizes ``spacing``. The slab starts at the plane
+    ``start`` along the first axis. The result is written to ``out``, with shape
+    ``(ncomponents, nvoxels)``, where ``nvoxels`` is the number of voxels in the
+    slab.
+
+    With ``method='nearest'``, each voxel takes the value of the finest cell which
+    contains its center. With ``method='conservative'``, each voxel takes the
+    volume-weighted average of the cells it overlaps: the voxels are cut along the
+    faces of the cells, until each part is inside a single cell, so that the
+    overlap volumes are exact. Voxels outside of all cells are NaN.
+    """
+    _resample(values, half_sizes, np.asarray(lower, dtype=np.float64),
+              np.asarray(spacing, dtype=np.float64), np.asarray(shape, dtype=np.int64),
+              start, method == "conservative", out, *index.arrays)
+
+
+@njit
+def _cell_bounds(point, half_size, sizes, origins, lower, upper):
+    """
+    Find the bounds of the cell of size ``2 * half_size`` which contains ``point``,
+    using the same arithmetic as :func:`find_cell`.
+    """
+    level = 0
+    for i in range(len(sizes)):
+        if abs(sizes[i] - 2.0 * half_size) < abs(sizes[level] - 2.0 * half_size):
+            level = i
+    for d in range(len(point)):
+        coord = np.floor((point[d] - origins[level, d]) / sizes[level])
+        lower[d] = origins[level, d] + coord * sizes[level]
+        upper[d] = lower[d] + sizes[level]
+
+
+@njit(parallel=True)
+def _resample(values, half_sizes, lower, spacing, shape, start, conservative, out, keys,
+              cells, offsets, sizes, origins, extents):
+
+    ndim = len(shape)
+    ncomp = values.shape[1]
+    nvoxels = out.shape[1]
+    # Parts thinner than this fraction of a voxel are ignored
+    tolerance = 1.0e-10
+
+    for q in prange(nvoxels):
+        point = np.empty(ndim)
+        for d in range(ndim - 1, -1, -1):
+            # Unravel the index of the voxel, the slab starting at plane `start`
+            i = q
+            for e in range(d + 1, ndim):
+                i = i // shape[e]
+            if d > 0:
+                i = i % shape[d]
+            else:
+                i += start
+            point[d] = lower[d] + (i + 0.5) * spacing[d]
+
+        if not conservative:
+            n = find_cell(point, keys, cells, offsets, sizes, origins, extents)
+            for c in range(ncomp):
+                out[c, q] = values[n, c] if n >= 0 else np.nan
+            continue
+
+        total = np.zeros(ncomp)
+        volume = 0.0
+        # The lower and upper corners of the parts of the voxel left to process
+        parts = np.empty((16, 2, ndim))
+        parts[0, 0] = point - 0.5 * spacing
+        parts[0, 1] = point + 0.5 * spacing
+        top = 1
+        center = np.empty(ndim)
+        cell_lower = np.empty(ndim)
+        cell_upper = np.empty(ndim)
+        while top > 0:
+            top -= 1
+            part_lower = parts[top, 0].copy()
+            part_upper = parts[top, 1].copy()
+            for d in range(ndim):
+                center[d] = 0.5 * (part_lower[d] + part_upper[d])
+            n = find_cell(center, keys, cells, offsets, sizes, origins, extents)
+            if n < 0:
+                continue
+            _cell_bounds(center, half_sizes[n], sizes, origins, cell_lower, cell_upper)
+            # The overlap of the part with the cell
+            weight = 1.0
+            for d in range(ndim):
+                width = min(part_upper[d], cell_upper[d]) - max(
+                    part_lower[d], cell_lower[d])
+                weight *= max(width, 0.0) / spacing[d]
+            volume += weight
+            for c in range(ncomp):
+                total[c] += values[n, c] * weight
+            # Cut the rest of the part along the faces of the cell: the slabs below
+            # and above the cell along each dimension, the following dimensions
+            # being restricted to the cell
+            for d in range(ndim):
+                for side in range(2):
+                    if side == 0:
+                        edge_lower = part_lower[d]
+                        edge_upper = min(cell_lower[d], part_upper[d])
+                    else:
+                        edge_lower = max(cell_upper[d], part_lower[d])
+                        edge_upper = part_upper[d]
+                    if edge_upper - edge_lower <= tolerance * spacing[d]:
+                        continue
+                    if top == len(parts):
+                        grown = np.empty((2 * len(parts), 2, ndim))
+                        grown[:top] = parts
+                        parts = grown
+                    parts[top, 0] = part_lower
+                    parts[top, 1] = part_upper
+                    parts[top, 0, d] = edge_lower
+                    parts[top, 1, d] = edge_upper
+                    top += 1
+                part_lower[d] = max(part_lower[d], cell_lower[d])
+                part_upper[d] = min(part_upper[d], cell_upper[d])
+        for c in range(ncomp):
+            out[c, q] = total[c] / volume if volume > 0 else np.nan
+
+
+class KDTree:
+    """
+    A balanced kd-tree of points, used to find the nearest neighbours of points
+    (e.g. to compute the smoothing lengths of particles).
+
+    The tree is implicit: node ``i`` has children ``2i + 1`` and ``2i + 2``, and
+    the points of a node are split at their median along the dimension where
+    their bounding box is the widest. The nodes of each depth are built in
+    parallel, and only the permutation of the points and the bounding boxes of
+    the nodes are stored.
+
+    :param positions: The positions of the points, with shape ``(npoints, ndim)``.
+
+    :param leafsize: The maximum number of points in the leaves. Default is
+        ``16``.
+    """
+    def __init__(self, positions, leafsize=16):
+        positions = np.asarray(positions, dtype=np.float64)
+        if positions.ndim == 1:
+            positions = positions.reshape(-1, 1)
+        self.positions = np.ascontiguousarray(positions)
+        self.npoints, self.ndim = self.positions.shape
+        self.depth = 0
+        if self.npoints > leafsize:
+            self.depth = int(np.ceil(np.log2(self.npoints / leafsize)))
+        self.perm, self.lower, self.upper = _build_tree(self.positions, self.depth)
+        # The points of each leaf are contiguous in memory
+        self.sorted_positions = self.positions[self.perm]
+
+    def query(self, points, k=1):
+        """
+        Find the ``k`` nearest neighbours of each of the ``points``. Returns their
+        distances and indices, both with shape ``(npoints, k)`` and sorted by
+        increasing distance. If the tree has fewer than ``k`` points, the missing
+        neighbours have an infinite distance and an index of -1.
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, self.ndim)
+        return _query_tree(points, k, self.sorted_positions, self.perm, self.lower,
+                           self.upper, self.depth)
+
+
+@njit
+def _node_range(node, npoints):
+    """
+    The range of the points of a node in the permutation of the tree.
+    """
+    # Follow the path from the root, given by the binary digits of node + 1
+    start = 0
+    end = npoints
+    path = node + 1
+    depth = 0
+    while (path >> (depth + 1)) > 0:
+        depth += 1
+    for level in range(depth - 1, -1, -1):
+        middle = (start + end) // 2
+        if (path >> level) & 1:
+            start = middle
+        else:
+            end = middle
+    return start, end
+
+
+@njit(parallel=True)
+def _build_tree(positions, depth):
+
+    npoints, ndim = positions.shape
+    nnodes = 2**(depth + 1) - 1
+    perm = np.arange(npoints)
+    lower = np.full((nnodes, ndim), np.inf)
+    upper = np.full((nnodes, ndim), -np.inf)
+
+    # Split the nodes level by level: the nodes of a level are independent
+    for level in range(depth):
+        first = 2**level - 1
+        for node in prange(first, 2 * first + 1):
+            start, end = _node_range(node, npoints)
+            if end - start < 2:
+                continue
+            widest = 0
+            width = -1.0
+            for d in range(ndim):
+                low = np.inf
+                high = -np.inf
+                for i in range(start, end):
+                    x = positions[perm[i], d]
+                    low = min(low, x)
+                    high = max(high, x)
+                if high - low > width:
+                    width = high - low
+                    widest = d
+            _select(positions[:, widest], perm, start, end, (start + end) // 2)
+
+    # Bounding boxes of the leaves, then of their parents
+    first = 2**depth - 1
+    for node in prange(first, nnodes):
+        start, end = _node_range(node, npoints)
+        for i in range(start, end):
+            for d in range(ndim):
+                lower[node, d] = min(lower[node, d], positions[perm[i], d])
+                upper[node, d] = max(upper[node, d], positions[perm[i], d])
+    for level in range(depth - 1, -1, -1):
+        first = 2**level - 1
+        for node in prange(first, 2 * first + 1):
+            for d in range(ndim):
+                lower[node, d] = min(lower[2 * node + 1, d], lower[2 * node + 2, d])
+                upper[node, d] = max(upper[2 * node + 1, d], upper[2 * node + 2, d])
+
+    return perm, lower, upper
+
+
+@njit
+def _select(x, perm, start, end, kth):
+    """
+    Reorder ``perm[start:end]`` so that ``x[perm[kth]]`` is the value it would have
+    if the range were sorted by ``x``, with smaller values before and larger
+    values after it (quickselect, in linear time on average).
+    """
+    end -= 1
+    while end > start:
+        # Median of three pivot
+        middle = (start + end) // 2
+        a = x[perm[start]]
+        b = x[perm[middle]]
+        c = x[perm[end]]
+        pivot = max(min(a, b), min(max(a, b), c))
+        i = start
+        j = end
+        while i <= j:
+            while x[perm[i]] < pivot:
+                i += 1
+            while x[perm[j]] > pivot:
+                j -= 1
+            if i <= j:
+                perm[i], perm[j] = perm[j], perm[i]
+                i += 1
+                j -= 1
+        if kth <= j:
+            end = j
+        elif kth >= i:
+            start = i
+        else:
+            return
+
+
+@njit
+def _box_distance2(point, lower, upper, node):
+    """
+    The squared distance between a point and the bounding box of a node.
+    """
+    r2 = 0.0
+    for d in range(len(point)):
+        if point[d] < lower[node, d]:
+            r2 += (lower[node, d] - point[d])**2
+        elif point[d] > upper[node, d]:
+            r2 += (point[d] - upper[node, d])**2
+    return r2
+
+
+@njit(parallel=True)
+def _query_tree(points, k, sorted_positions, perm, lower, upper, depth):
+
+    npoints, ndim = points.shape
+    first_leaf = 2**depth - 1
+    distances = np.full((npoints, k), np.inf)
+    indices = np.full((npoints, k), -1, dtype=np.int64)
+
+    for q in prange(npoints):
+        point = points[q]
+        best = distances[q]
+        found = indices[q]
+        # Depth-first traversal, visiting the closest child first. The distances
+        # to the boxes of the nodes are stored with them on the stack.
+        stack = np.empty(depth + 2, dtype=np.int64)
+        stack_distances = np.empty(depth + 2)
+        stack[0] = 0
+        stack_distances[0] = 0.0
+        top = 1
+        while top > 0:
+            top -= 1
+            node = stack[top]
+            if stack_distances[top] >= best[k - 1]:
+                continue
+            if node >= first_leaf:
+                start, end = _node_range(node, len(perm))
+                for i in range(start, end):
+                    r2 = 0.0
+                    for d in range(ndim):
+                        r2 += (sorted_positions[i, d] - point[d])**2
+                    if r2 >= best[k - 1]:
+                        continue
+                    # Insert into the sorted list of the k nearest neighbours
+                    j = k - 1
+                    while j > 0 and best[j - 1] > r2:
+                        best[j] = best[j - 1]
+                        found[j] = found[j - 1]
+                        j -= 1
+                    best[j] = r2
+                    found[j] = perm[i]
+                continue
+            near = 2 * node + 1
+            far = 2 * node + 2
+            near_distance = _box_distance2(point, lower, upper, near)
+            far_distance = _box_distance2(point, lower, upper, far)
+            if far_distance < near_distance:
+                near, far = far, near
+                near_distance, far_distance = far_distance, near_distance
+            stack[top] = far
+            stack_distances[top] = far_distance
+            stack[top + 1] = near
+            stack_distances[top + 1] = near_distance
+            top += 2
+
+    return np.sqrt(distances), indices
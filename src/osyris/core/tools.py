@@ -105,3 +105,20 @@ def bytes_to_human_readable(size):
         if size >= mult:
             return "{:.2f} {}B".format(size / mult, m)
     return "0B"
+
+
+def human_readable_to_bytes(size):
+    """
+    Convert a size such as ``"16GB"`` or ``"500 MB"`` to a number of bytes.
+    Plain numbers are interpreted as a number of bytes.
+    """
+    if not isinstance(size, str):
+        return int(size)
+    multipliers = {"T": 1.0e12, "G": 1.0e9, "M": 1.0e6, "K": 1.0e3}
+    text = size.strip().upper()
+    if text.endswith("B"):
+        text = text[:-1]
+    for m, mult in multipliers.items():
+        if text.endswith(m):
+            return int(float(text[:-1]) * mult)
+    return int(float(text))
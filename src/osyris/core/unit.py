@@ -0,0 +1,231 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (c) 2022 Osyris contributors (https://github.com/nvaytet/osyris)
+
+from itertools import count, zip_longest
+from pint.errors import DimensionalityError
+from pint.quantity import Quantity
+from pint.unit import Unit
+from .. import units
+
+# Names of the base dimensions, in the order used by the exponent vectors.
+# Dimensions unknown at startup are appended when first encountered.
+_DIMENSIONS = [
+    "[length]", "[mass]", "[time]", "[temperature]", "[current]", "[substance]",
+    "[luminosity]"
+]
+
+# Interned units, looked up by pint Unit, and by the strings they were parsed from
+_INTERNED = {}
+_STRINGS = {}
+# Units made of base units only, looked up by dimension exponent vector
+_BASE = {}
+# Memoized conversion factors between two units, looked up by unit ids
+_CONVERSIONS = {}
+_UIDS = count()
+
+
+class CompactUnit:
+    """
+    Lightweight unit used internally by :class:`Array`. It is made of a vector of
+    exponents of the base dimensions, the factor which converts the unit to the
+    base units of the registry, and a magnitude (the unit of an Array is a pint
+    Quantity, which can have a magnitude different from 1).
+
+    Common units are interned, so that arithmetic on Arrays only combines exponent
+    vectors and floats. The equivalent pint objects are created only when needed,
+    e.g. for labels.
+    """
+    __slots__ = [
+        "uid", "dims", "factor", "magnitude", "_units", "_quantity", "_derived"
+    ]
+
+    def __init__(self, uid, dims, factor=1.0, magnitude=1.0, units=None):
+        self.uid = uid
+        self.dims = dims
+        self.factor = factor
+        self.magnitude = magnitude
+        self._units = units
+        self._quantity = None
+        self._derived = {}
+
+    def __repr__(self):
+        return "CompactUnit({} {:~})".format(self.magnitude, self.units)
+
+    def __reduce__(self):
+        return (_unpickle, ("{}".format(self.units), self.magnitude))
+
+    @property
+    def scale(self):
+        """
+        The conversion factor to base units, including the magnitude.
+        """
+        return self.magnitude * self.factor
+
+    @property
+    def units(self):
+        """
+        The equivalent pint Unit.
+        """
+        return self._units
+
+    @property
+    def quantity(self):
+        """
+        The equivalent pint Quantity.
+        """
+        if self._quantity is None:
+            self._quantity = self.magnitude * self._units
+        return self._quantity
+
+    @property
+    def dimensionless(self):
+        return len(self.dims) == 0
+
+    def with_magnitude(self, magnitude):
+        if magnitude == self.magnitude and type(magnitude) is type(self.magnitude):
+            return self
+        unit = CompactUnit(uid=self.uid,
+                           dims=self.dims,
+                           factor=self.factor,
+                           magnitude=magnitude,
+                           units=self._units)
+        unit._derived = self._derived
+        return unit
+
+
+def _unpickle(unit_string, magnitude):
+    return from_pint(unit_string).with_magnitude(magnitude)
+
+
+def _strip(dims):
+    dims = list(dims)
+    while dims and dims[-1] == 0:
+        dims.pop()
+    return tuple(dims)
+
+
+def _dims_vector(dimensionality):
+    dims = [0] * len(_DIMENSIONS)
+    for name, exponent in dimensionality.items():
+        if name not in _DIMENSIONS:
+            _DIMENSIONS.append(name)
+            dims.append(0)
+        dims[_DIMENSIONS.index(name)] = exponent
+    return _strip(dims)
+
+
+def _base_unit(dims, make_units):
+    unit = _BASE.get(dims)
+    if unit is None:
+        unit = CompactUnit(uid=next(_UIDS), dims=dims, units=make_units())
+        _BASE[dims] = unit
+    return unit
+
+
+def _intern(pint_unit):
+    """
+    Create the CompactUnit for a pint Unit. This is where pint is used to find the
+    dimensionality and the conversion factor to base units.
+    """
+    unit = _INTERNED.get(pint_unit)
+    if unit is None:
+        base = (1.0 * pint_unit).to_base_units()
+        dims = _dims_vector(pint_unit.dimensionality)
+        unit = CompactUnit(uid=next(_UIDS),
+                           dims=dims,
+                           factor=base.magnitude,
+                           units=pint_unit)
+        _base_unit(dims, lambda: base.units)
+        _INTERNED[pint_unit] = unit
+    return unit
+
+
+def from_pint(unit):
+    """
+    Convert a string, a pint Unit or a pint Quantity to a CompactUnit.
+    """
+    if isinstance(unit, CompactUnit):
+        return unit
+    if isinstance(unit, str):
+        compact = _STRINGS.get(unit)
+        if compact is None:
+            compact = from_pint(units(unit))
+            _STRINGS[unit] = compact
+        return compact
+    if isinstance(unit, Quantity):
+        return _intern(unit.units).with_magnitude(unit.magnitude)
+    if isinstance(unit, Unit):
+        return _intern(unit)
+    raise TypeError("Unsupported unit type {}".format(type(unit)))
+
+
+def base_units(unit):
+    """
+    The unit, in base units, with the same dimensions as ``unit``.
+    """
+    return _BASE[unit.dims]
+
+
+def multiply_units(lhs, rhs):
+    """
+    The base unit resulting from the product of two units.
+    """
+    dims = _strip(a + b for a, b in zip_longest(lhs.dims, rhs.dims, fillvalue=0))
+    return _base_unit(dims, lambda: base_units(lhs).units * base_units(rhs).units)
+
+
+def divide_units(lhs, rhs):
+    """
+    The base unit resulting from the ratio of two units.
+    """
+    dims = _strip(a - b for a, b in zip_longest(lhs.dims, rhs.dims, fillvalue=0))
+    return _base_unit(dims, lambda: base_units(lhs).units / base_units(rhs).units)
+
+
+def power_unit(unit, exponent):
+    """
+    Raise a unit to a power. The underlying pint Unit is kept (as pint would do),
+    and the result is memoized on the original unit.
+    """
+    key = ("power", exponent)
+    result = unit._derived.get(key)
+    if result is None:
+        result = _intern(unit.units**exponent)
+        unit._derived[key] = result
+    return result.with_magnitude(unit.magnitude**exponent)
+
+
+def inverse_unit(unit):
+    """
+    The inverse of a unit, keeping the underlying pint Unit.
+    """
+    key = "inverse"
+    result = unit._derived.get(key)
+    if result is None:
+        result = _intern(unit.units**-1)
+        unit._derived[key] = result
+    return result.with_magnitude(1.0 / unit.magnitude)
+
+
+def conversion_factor(src, dst):
+    """
+    The factor to multiply values in unit ``src`` with, to convert them to the
+    unit ``dst`` (ignoring the magnitude of ``dst``). Raises a
+    ``DimensionalityError`` if the units are not compatible.
+    """
+    key = (src.uid, dst.uid)
+    factor = _CONVERSIONS.get(key)
+    if factor is None:
+        if src.dims != dst.dims:
+            raise DimensionalityError(src.units, dst.units, src.units.dimensionality,
+                                      dst.units.dimensionality)
+        factor = (1.0 * src.units).to(dst.units).magnitude
+        _CONVERSIONS[key] = factor
+    return src.magnitude * factor
+
+
+def equivalent_units(lhs, rhs):
+    """
+    Check whether two units are the same, once converted to base units.
+    """
+    return lhs.dims == rhs.dims and lhs.scale == rhs.scale
@@ -2,8 +2,19 @@
 # Copyright (c) 2022 Osyris contributors (https://github.com/nvaytet/osyris)
 
 import numpy as np
+from numba import njit, prange
 from ..core import Array
 
+_STATE_DIAGRAM = np.array([
+    1, 2, 3, 2, 4, 5, 3, 5, 0, 1, 3, 2, 7, 6, 4, 5, 2, 6, 0, 7, 8, 8, 0, 7, 0, 7, 1, 6,
+    3, 4, 2, 5, 0, 9, 10, 9, 1, 1, 11, 11, 0, 3, 7, 4, 1, 2, 6, 5, 6, 0, 6, 11, 9, 0, 9,
+    8, 2, 3, 1, 0, 5, 4, 6, 7, 11, 11, 0, 7, 5, 9, 0, 7, 4, 3, 5, 2, 7, 0, 6, 1, 4, 4,
+    8, 8, 0, 6, 10, 6, 6, 5, 1, 2, 7, 4, 0, 3, 5, 7, 5, 3, 1, 1, 11, 11, 4, 7, 3, 0, 5,
+    6, 2, 1, 6, 1, 6, 10, 9, 4, 9, 10, 6, 7, 5, 4, 1, 0, 2, 3, 10, 3, 1, 1, 10, 3, 5, 9,
+    2, 5, 3, 4, 1, 6, 0, 7, 4, 4, 8, 8, 2, 7, 2, 3, 2, 1, 5, 6, 3, 0, 4, 7, 7, 2, 11, 2,
+    7, 5, 8, 5, 4, 5, 7, 6, 3, 2, 0, 1, 10, 3, 2, 6, 10, 3, 4, 4, 6, 1, 7, 0, 5, 2, 4, 3
+]).reshape((8, 2, 12), order='F')
+
 
 def _read_bound_key(infofile, ncpu):
     with open(infofile) as f:
@@ -33,16 +44,7 @@ def _hilbert3d(x, y, z, bit_length):
     y_bit_mask = np.zeros_like(x_bit_mask)
     z_bit_mask = np.zeros_like(x_bit_mask)
 
-    state_diagram = np.array([
-        1, 2, 3, 2, 4, 5, 3, 5, 0, 1, 3, 2, 7, 6, 4, 5, 2, 6, 0, 7, 8, 8, 0, 7, 0, 7, 1,
-        6, 3, 4, 2, 5, 0, 9, 10, 9, 1, 1, 11, 11, 0, 3, 7, 4, 1, 2, 6, 5, 6, 0, 6, 11,
-        9, 0, 9, 8, 2, 3, 1, 0, 5, 4, 6, 7, 11, 11, 0, 7, 5, 9, 0, 7, 4, 3, 5, 2, 7, 0,
-        6, 1, 4, 4, 8, 8, 0, 6, 10, 6, 6, 5, 1, 2, 7, 4, 0, 3, 5, 7, 5, 3, 1, 1, 11, 11,
-        4, 7, 3, 0, 5, 6, 2, 1, 6, 1, 6, 10, 9, 4, 9, 10, 6, 7, 5, 4, 1, 0, 2, 3, 10, 3,
-        1, 1, 10, 3, 5, 9, 2, 5, 3, 4, 1, 6, 0, 7, 4, 4, 8, 8, 2, 7, 2, 3, 2, 1, 5, 6,
-        3, 0, 4, 7, 7, 2, 11, 2, 7, 5, 8, 5, 4, 5, 7, 6, 3, 2, 0, 1, 10, 3, 2, 6, 10, 3,
-        4, 4, 6, 1, 7, 0, 5, 2, 4, 3
-    ]).reshape((8, 2, 12), order='F')
+    state_diagram = _STATE_DIAGRAM
 
     # Convert to binary
     for i in range(bit_length):
@@ -188,3 +190,95 @@ def hilbert_cpu_list(meta, scaling, select, infofile):
                              infofile=infofile,
                              ncpu=meta["ncpu"],
                              ndim=meta["ndim"])
+
+
+@njit(parallel=True)
+def _hilbert3d_keys(coords, bit_length, state_diagram):
+    keys = np.zeros(coords.shape[0], dtype=np.int64)
+    for n in prange(coords.shape[0]):
+        cstate = 0
+        order = 0
+        for i in range(bit_length - 1, -1, -1):
+            sdigit = (((coords[n, 0] >> i) & 1) * 4 + ((coords[n, 1] >> i) & 1) * 2 +
+                      ((coords[n, 2] >> i) & 1))
+            hdigit = state_diagram[sdigit, 1, cstate]
+            cstate = state_diagram[sdigit, 0, cstate]
+            order = (order << 3) | hdigit
+        keys[n] = order
+    return keys
+
+
+@njit(parallel=True)
+def _hilbert2d_keys(coords, bit_length):
+    keys = np.zeros(coords.shape[0], dtype=np.int64)
+    side = 1 << bit_length
+    for n in prange(coords.shape[0]):
+        x = coords[n, 0]
+        y = coords[n, 1]
+        order = 0
+        s = side >> 1
+        while s > 0:
+            rx = 1 if (x & s) > 0 else 0
+            ry = 1 if (y & s) > 0 else 0
+            order += s * s * ((3 * rx) ^ ry)
+            # Rotate the quadrant
+            if ry == 0:
+                if rx == 1:
+                    x = side - 1 - x
+                    y = side - 1 - y
+                x, y = y, x
+            s >>= 1
+        keys[n] = order
+    return keys
+
+
+@njit(parallel=True)
+def _morton_keys(coords, bit_length):
+    ndim = coords.shape[1]
+    keys = np.zeros(coords.shape[0], dtype=np.int64)
+    for n in prange(coords.shape[0]):
+        order = 0
+        for i in range(bit_length - 1, -1, -1):
+            for d in range(ndim):
+                order = (order << 1) | ((coords[n, d] >> i) & 1)
+        keys[n] = order
+    return keys
+
+
+def curve_keys(positions, kind="hilbert", half_sizes=None):
+    """
+    Compute the index of each position along a space-filling curve that covers the
+    bounding box of all the positions (extended by the half sizes if the positions
+    are cell centers). Possible values for ``kind`` are ``'hilbert'`` and
+    ``'morton'``.
+    """
+    if kind not in ["hilbert", "morton"]:
+        raise ValueError("Unknown space-filling curve {}. Possible values are "
+                         "'hilbert' and 'morton'.".format(kind))
+    positions = np.asarray(positions, dtype=np.float64)
+    if positions.ndim < 2:
+        positions = positions.reshape(-1, 1)
+    ndim = positions.shape[1]
+    if len(positions) == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    lower = positions.min(axis=0)
+    upper = positions.max(axis=0)
+    if half_sizes is not None:
+        lower -= np.max(half_sizes)
+        upper += np.max(half_sizes)
+    extent = np.max(upper - lower)
+    if extent <= 0:
+        extent = 1.0
+
+    # Use as many bits per dimension as fit in a 64-bit integer key
+    bit_length = 62 // ndim
+    nmax = 2**bit_length
+    coords = np.clip(((positions - lower) * (nmax / extent)).astype(np.int64), 0,
+                     nmax - 1)
+
+    if kind == "morton" or ndim == 1:
+        return _morton_keys(coords, bit_length)
+    if ndim == 2:
+        return _hilbert2d_keys(coords, bit_length)
+    return _hilbert3d_keys(coords, bit_length, _STATE_DIAGRAM)
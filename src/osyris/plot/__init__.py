@@ -3,10 +3,16 @@
 
 # flake8: noqa
 
+from .accumulator import Histogram1D, Histogram2D
+from .animate import animate, CameraPath
+from .cache import map_cache
 from .histogram1d import histogram1d
 from .histogram2d import histogram2d
-from .map import map
+from .map import map, map_many
 from .render import render
 from .plane import plane
 from .plot import plot
+from .raster import rasterize, write_image
 from .scatter import scatter
+from .timeseries import timeseries
+from .volume import Camera, TransferFunction, volume_render
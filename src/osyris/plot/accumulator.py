@@ -0,0 +1,448 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (c) 2022 Osyris contributors (https://github.com/nvaytet/osyris)
+
+import numpy as np
+from pint.quantity import Quantity
+from ..core import Array, Plot
+from ..core.tools import make_label, to_bin_centers
+from ..core.unit import conversion_factor, from_pint
+from .parser import get_norm
+from .render import render
+from .utils import hist1d, hist2d
+
+
+def _edges(lower, upper, nbins, log):
+    if log:
+        return np.logspace(np.log10(lower), np.log10(upper), nbins + 1)
+    return np.linspace(lower, upper, nbins + 1)
+
+
+def _limits(lower, upper):
+    """
+    The magnitudes of the limits of an axis, and their unit if they are
+    Quantities.
+    """
+    unit = None
+    if isinstance(upper, Quantity):
+        unit = from_pint(upper.units)
+        upper = upper.magnitude
+    if isinstance(lower, Quantity):
+        if unit is None:
+            unit = from_pint(lower.units)
+        lower = lower.to(unit.units).magnitude
+    return float(lower), float(upper), unit
+
+
+def _values(array, unit):
+    """
+    The values of an Array (the norm for vectors) in the given unit, and the unit.
+    Plain ndarrays are assumed to already be in that unit.
+    """
+    if not isinstance(array, Array):
+        return np.asarray(array, dtype=np.float64), unit
+    array = array.norm
+    if unit is None:
+        return array.values, array._unit
+    factor = conversion_factor(array._unit, unit) / unit.magnitude
+    return (array.values if factor == 1.0 else array.values * factor), unit
+
+
+def _combine(stats, other):
+    """
+    Merge the statistics of ``other`` into ``stats``, using the parallel
+    formulas of Chan et al. for the means and the variances.
+    """
+    na = stats["count"]
+    nb = other["count"]
+    n = na + nb
+    with np.errstate(invalid="ignore", divide="ignore"):
+        delta = other["mean"] - stats["mean"]
+        stats["mean"] = np.where(n > 0, stats["mean"] + delta * nb / n, 0.0)
+        stats["m2"] = np.where(n > 0,
+                               stats["m2"] + other["m2"] + delta * delta * na * nb / n,
+                               0.0)
+    stats["sum"] = stats["sum"] + other["sum"]
+    if "min" in stats:
+        stats["min"] = np.minimum(stats["min"], other["min"])
+        stats["max"] = np.maximum(stats["max"], other["max"])
+    stats["count"] = n
+
+
+class _Accumulator:
+    """
+    Shared logic of the histogram accumulators. The statistics of the bins are
+    stored as counts, sums, means and sums of squared deviations from the means
+    (and minima and maxima in 2D), which can be merged exactly.
+    """
+    def _fill(self, stats, weighted, wunit):
+        if self._weighted is None:
+            self._weighted = weighted
+        elif self._weighted != weighted:
+            raise ValueError("An accumulator cannot be filled both with and without "
+                             "weights.")
+        if self._wunit is None:
+            self._wunit = wunit
+        # Restore the neutral values of the statistics in the empty bins
+        empty = stats["count"] == 0
+        for key, value in {
+                "mean": 0.0,
+                "m2": 0.0,
+                "min": np.inf,
+                "max": -np.inf
+        }.items():
+            if key in stats:
+                stats[key] = np.where(empty, value, stats[key])
+        _combine(self._stats, stats)
+
+    def merge(self, other):
+        """
+        Add the statistics of another accumulator with the same bins to this one.
+        Returns this accumulator.
+        """
+        if type(other) is not type(self) or self._geometry() != other._geometry():
+            raise ValueError("Only accumulators with the same bins can be merged.")
+        # The bins must be in the same units, the weights only need to be compatible
+        units = zip(self._units() + [self._wunit], other._units() + [other._wunit])
+        for i, (mine, theirs) in enumerate(units):
+            if mine is None or theirs is None:
+                continue
+            if mine.dims != theirs.dims or (
+                    i < len(self._units())
+                    and conversion_factor(theirs, mine) != mine.magnitude):
+                raise ValueError("Accumulators with different units cannot be "
+                                 "merged.")
+        if other._weighted is None:
+            return self
+        if self._weighted is not None and self._weighted != other._weighted:
+            raise ValueError("Accumulators filled with and without weights cannot be "
+                             "merged.")
+        stats = {key: value.copy() for key, value in other._stats.items()}
+        if self._wunit is not None and other._wunit is not None:
+            # Convert the weights of the other accumulator to our unit
+            factor = conversion_factor(other._wunit,
+                                       self._wunit) / self._wunit.magnitude
+            for key in ["sum", "mean", "min", "max"]:
+                if key in stats:
+                    stats[key] = stats[key] * factor
+            stats["m2"] = stats["m2"] * factor**2
+        self._fill(stats, weighted=other._weighted, wunit=other._wunit)
+        for name in ["_xunit", "_yunit"]:
+            if hasattr(self, name) and getattr(self, name) is None:
+                setattr(self, name, getattr(other, name))
+        for key, value in other._labels.items():
+            self._labels.setdefault(key, value)
+        return self
+
+    def statistic(self, operation: str = "sum") -> np.ndarray:
+        """
+        The values of a statistic in the bins: ``'sum'``, ``'count'``, ``'mean'``,
+        ``'std'`` or ``'var'`` (and ``'min'`` or ``'max'`` in 2D). The statistics
+        of the weights are computed (or of ones if there are no weights). Empty
+        bins are NaN, except for the sum and count.
+        """
+        stats = self._stats
+        operations = ["sum", "count", "mean", "std", "var"]
+        if "min" in stats:
+            operations += ["min", "max"]
+        if operation not in operations:
+            raise ValueError("Unknown operation '{}', possible choices are {}.".format(
+                operation, operations))
+        if operation in ["sum", "count"]:
+            return stats[operation].astype(np.float64)
+        empty = stats["count"] == 0
+        if operation in ["std", "var"]:
+            with np.errstate(invalid="ignore", divide="ignore"):
+                values = stats["m2"] / stats["count"]
+            if operation == "std":
+                values = np.sqrt(values)
+        else:
+            values = stats[operation].copy()
+        values[empty] = np.nan
+        return values
+
+    def _unit_of(self, operation):
+        if operation == "count" or self._wunit is None:
+            return None
+        if operation == "var":
+            return self._wunit.units**2
+        return self._wunit.units
+
+
+class Histogram1D(_Accumulator):
+    """
+    A 1D histogram with fixed bins, which can be filled incrementally, merged
+    with other histograms and pickled, e.g. to accumulate statistics over many
+    outputs, or over chunks of data processed in parallel, without keeping the
+    data in memory.
+
+    :param xmin: The lower edge of the bins, as a number or a Quantity.
+
+    :param xmax: The upper edge of the bins, as a number or a Quantity.
+
+    :param bins: The number of bins. Default is ``50``.
+
+    :param logx: If ``True``, the bins are logarithmically spaced. Default is
+        ``False``.
+    """
+    def __init__(self, xmin, xmax, bins: int = 50, logx: bool = False):
+        xmin, xmax, self._xunit = _limits(xmin, xmax)
+        self.logx = logx
+        self.edges = _edges(xmin, xmax, bins, logx)
+        self._weighted = None
+        self._wunit = None
+        self._labels = {}
+        self._stats = {
+            "count": np.zeros(bins, dtype=np.int64),
+            "sum": np.zeros(bins),
+            "mean": np.zeros(bins),
+            "m2": np.zeros(bins)
+        }
+
+    def _geometry(self):
+        return (self.edges.tobytes(), self.logx)
+
+    def _units(self):
+        return [self._xunit]
+
+    @property
+    def centers(self):
+        return to_bin_centers(self.edges)
+
+    def fill(self, x, weights=None):
+        """
+        Add data to the histogram.
+
+        :param x: The Array (or array) to be histogrammed. The norm is used for
+            vectors.
+
+        :param weights: The weights of the data. Default is ``None``.
+        """
+        xvals, self._xunit = _values(x, self._xunit)
+        wunit = None
+        wvals = None
+        if weights is not None:
+            wvals, wunit = _values(weights, self._wunit)
+        if isinstance(x, Array):
+            self._labels.setdefault("x", x.name)
+        if isinstance(weights, Array):
+            self._labels.setdefault("weights", weights.name)
+        binned = hist1d(x=xvals,
+                        edges=self.edges,
+                        weights=wvals,
+                        log=self.logx,
+                        uniform=True)
+        self._fill(
+            {
+                "count": binned["count"],
+                "sum": binned["sum"],
+                "mean": binned["mean"],
+                "m2": binned["std"]**2 * binned["count"]
+            },
+            weighted=weights is not None,
+            wunit=wunit)
+        return self
+
+    def plot(self,
+             operation: str = "sum",
+             logy: bool = False,
+             filename: str = None,
+             ymin: float = None,
+             ymax: float = None,
+             plot: bool = True,
+             ax: object = None,
+             **kwargs) -> Plot:
+        """
+        Plot the histogram, as :func:`histogram1d` does.
+
+        :param operation: The statistic to plot, see :meth:`statistic`. Default is
+            ``'sum'``.
+
+        The other arguments are the same as for :func:`histogram1d`.
+        """
+        ydata = self.statistic(operation)
+        figure = {"fig": None, "ax": None}
+        if plot:
+            figure = render(logx=self.logx, logy=logy, ax=ax)
+            figure["ax"].hist(self.centers, bins=self.edges, weights=ydata, **kwargs)
+            figure["ax"].set_xlabel(
+                make_label(name=self._labels.get("x"),
+                           unit=self._xunit.units if self._xunit else None))
+            figure["ax"].set_ylim(ymin, ymax)
+        return Plot(x=self.centers,
+                    y=ydata,
+                    layers=[{
+                        "data": ydata,
+                        "name": self._labels.get("weights", ""),
+                        "unit": self._unit_of(operation)
+                    }],
+                    fig=figure["fig"],
+                    ax=figure["ax"],
+                    filename=filename)
+
+
+class Histogram2D(_Accumulator):
+    """
+    A 2D histogram with fixed bins, which can be filled incrementally, merged
+    with other histograms and pickled, e.g. to build a phase diagram stacked over
+    many outputs, or over chunks of data processed in parallel, without keeping
+    the data in memory. All the statistics of :func:`histogram2d` are
+    accumulated.
+
+    :param xmin: The lower edge of the horizontal bins, as a number or a Quantity.
+
+    :param xmax: The upper edge of the horizontal bins.
+
+    :param ymin: The lower edge of the vertical bins.
+
+    :param ymax: The upper edge of the vertical bins.
+
+    :param resolution: The number of bins along each axis, as an integer or a dict
+        ``{'x': 128, 'y': 192}``. Default is ``256``.
+
+    :param logx: If ``True``, the horizontal bins are logarithmically spaced.
+        Default is ``False``.
+
+    :param logy: If ``True``, the vertical bins are logarithmically spaced.
+        Default is ``False``.
+    """
+    def __init__(self,
+                 xmin,
+                 xmax,
+                 ymin,
+                 ymax,
+                 resolution=256,
+                 logx: bool = False,
+                 logy: bool = False):
+        if isinstance(resolution, int):
+            resolution = {"x": resolution, "y": resolution}
+        nx = resolution["x"]
+        ny = resolution["y"]
+        xmin, xmax, self._xunit = _limits(xmin, xmax)
+        ymin, ymax, self._yunit = _limits(ymin, ymax)
+        self.logx = logx
+        self.logy = logy
+        self.xedges = _edges(xmin, xmax, nx, logx)
+        self.yedges = _edges(ymin, ymax, ny, logy)
+        self._weighted = None
+        self._wunit = None
+        self._labels = {}
+        self._stats = {
+            "count": np.zeros((ny, nx), dtype=np.int64),
+            "sum": np.zeros((ny, nx)),
+            "mean": np.zeros((ny, nx)),
+            "m2": np.zeros((ny, nx)),
+            "min": np.full((ny, nx), np.inf),
+            "max": np.full((ny, nx), -np.inf)
+        }
+
+    def _geometry(self):
+        return (self.xedges.tobytes(), self.yedges.tobytes(), self.logx, self.logy)
+
+    def _units(self):
+        return [self._xunit, self._yunit]
+
+    def fill(self, x, y, weights=None):
+        """
+        Add data to the histogram.
+
+        :param x: The horizontal Array (or array). The norm is used for vectors.
+
+        :param y: The vertical Array (or array).
+
+        :param weights: The weights of the data, whose statistics are accumulated.
+            Default is ``None``.
+        """
+        xvals, self._xunit = _values(x, self._xunit)
+        yvals, self._yunit = _values(y, self._yunit)
+        wunit = None
+        if weights is not None:
+            wvals, wunit = _values(weights, self._wunit)
+        else:
+            wvals = np.ones_like(xvals, dtype=np.float64)
+        for key, array in [("x", x), ("y", y), ("weights", weights)]:
+            if isinstance(array, Array):
+                self._labels.setdefault(key, array.name)
+
+        def limit(edges, log):
+            return np.log10(edges) if log else edges
+
+        xlim = limit(self.xedges[[0, -1]], self.logx)
+        ylim = limit(self.yedges[[0, -1]], self.logy)
+        binned = hist2d(x=xvals,
+                        y=yvals,
+                        values=wvals.reshape(1, -1),
+                        xmin=xlim[0],
+                        xmax=xlim[1],
+                        nx=len(self.xedges) - 1,
+                        ymin=ylim[0],
+                        ymax=ylim[1],
+                        ny=len(self.yedges) - 1,
+                        logx=self.logx,
+                        logy=self.logy)
+        self._fill(
+            {
+                "count": binned["count"],
+                "sum": binned["sum"][0],
+                "mean": binned["mean"][0],
+                "m2": binned["var"][0] * binned["count"],
+                "min": binned["min"][0],
+                "max": binned["max"][0]
+            },
+            weighted=weights is not None,
+            wunit=wunit)
+        return self
+
+    def plot(self,
+             operation: str = "sum",
+             mode: str = None,
+             norm: str = None,
+             vmin: float = None,
+             vmax: float = None,
+             title: str = None,
+             filename: str = None,
+             plot: bool = True,
+             ax: object = None,
+             **kwargs) -> Plot:
+        """
+        Plot the histogram, as :func:`histogram2d` does.
+
+        :param operation: The statistic to plot, see :meth:`statistic`. Default is
+            ``'sum'``.
+
+        The other arguments are the same as for :func:`histogram2d`.
+        """
+        data = np.ma.masked_where(self._stats["count"] == 0, self.statistic(operation))
+        to_render = [{
+            "data": data,
+            "mode": mode,
+            "params": {
+                "norm": get_norm(norm=norm, vmin=vmin, vmax=vmax),
+                **kwargs
+            },
+            "unit": self._unit_of(operation),
+            "name": self._labels.get("weights", "counts")
+        }]
+        xcenters = to_bin_centers(self.xedges)
+        ycenters = to_bin_centers(self.yedges)
+        to_return = {
+            "x": xcenters,
+            "y": ycenters,
+            "layers": to_render,
+            "filename": filename
+        }
+        if plot:
+            figure = render(x=xcenters,
+                            y=ycenters,
+                            data=to_render,
+                            logx=self.logx,
+                            logy=self.logy,
+                            ax=ax)
+            for name, unit, setter in [("x", self._xunit, figure["ax"].set_xlabel),
+                                       ("y", self._yunit, figure["ax"].set_ylabel)]:
+                setter(
+                    make_label(name=self._labels.get(name),
+                               unit=unit.units if unit else None))
+            if title is not None:
+                figure["ax"].set_title(title)
+            to_return.update({"fig": figure["fig"], "ax": figure["ax"]})
+        return Plot(**to_return)
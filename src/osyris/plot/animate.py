@@ -0,0 +1,525 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (c) 2022 Osyris contributors (https://github.com/nvaytet/osyris)
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from pint.quantity import Quantity
+from typing import Union
+from .. import config
+from ..core import Array
+from ..core.tools import make_label
+from .map import _check_method, _make_plot, _parse_layers, _project, _select_region
+
+_AXES = {
+    "x": ([1, 0, 0], [0, 1, 0]),
+    "y": ([0, 1, 0], [0, 0, 1]),
+    "z": ([0, 0, 1], [1, 0, 0])
+}
+
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float64)
+    return vectors / np.linalg.norm(vectors, axis=-1, keepdims=True)
+
+
+class CameraPath:
+    """
+    A sequence of camera positions, used by :func:`animate`. Each frame is defined
+    by the vector normal to the map, the horizontal axis of the map, the position
+    of the center of the map and the size of the region.
+
+    Paths are usually made with :meth:`orbit` and :meth:`zoom`, and can be
+    concatenated with ``+``.
+
+    :param normals: The vectors normal to the maps, with shape ``(nframes, 3)``.
+
+    :param horizontals: The horizontal axes of the maps, with shape
+        ``(nframes, 3)``. They must be perpendicular to the ``normals``.
+
+    :param dx: The horizontal size of the maps. This can be a single Quantity,
+        or a Quantity with one value per frame.
+
+    :param dy: The vertical size of the maps. Default is ``None``, in which case
+        ``dy = dx``.
+
+    :param origin: The position of the center of the maps. This can be an Array
+        of shape ``(1, ndim)`` or ``(nframes, ndim)``. Default is ``None``, in
+        which case the maps are centered on the origin of the coordinates.
+    """
+    def __init__(self,
+                 normals,
+                 horizontals,
+                 dx: Quantity,
+                 dy: Quantity = None,
+                 origin: Array = None):
+        self.normals = _normalize(normals)
+        self.horizontals = _normalize(horizontals)
+        if self.normals.shape != self.horizontals.shape:
+            raise ValueError("The normals and horizontals must have the same shape.")
+        nframes = len(self.normals)
+        if dy is None:
+            dy = dx
+        self.unit = dx.units
+        self.dx = np.broadcast_to(dx.magnitude, nframes).astype(np.float64)
+        self.dy = np.broadcast_to(dy.to(self.unit).magnitude,
+                                  nframes).astype(np.float64)
+        self.origin = origin
+        if origin is not None:
+            # Convert a copy, as Array.to would change the unit of the caller's Array
+            values = (origin.values * origin.unit).to(self.unit).magnitude.reshape(
+                -1, origin.shape[-1])
+            self.origin = np.broadcast_to(values, (nframes, values.shape[1]))
+
+    def __len__(self):
+        return len(self.normals)
+
+    def __getitem__(self, i):
+        """
+        The parameters of frame ``i``, as arguments to :func:`map`.
+        """
+        origin = None
+        if self.origin is not None:
+            origin = Array(values=self.origin[i:i + 1].copy(), unit=self.unit)
+        return {
+            "direction": [self.normals[i], self.horizontals[i]],
+            "dx": self.dx[i] * self.unit,
+            "dy": self.dy[i] * self.unit,
+            "origin": origin
+        }
+
+    def __add__(self, other):
+        def convert(values):
+            return (values * other.unit).to(self.unit).magnitude
+
+        origin = None
+        if self.origin is not None or other.origin is not None:
+            ndim = (self.origin if self.origin is not None else other.origin).shape[1]
+            first = self.origin if self.origin is not None else np.zeros(
+                (len(self), ndim))
+            second = convert(other.origin) if other.origin is not None else np.zeros(
+                (len(other), ndim))
+            origin = Array(values=np.concatenate([first, second]), unit=self.unit)
+        return self.__class__(
+            normals=np.concatenate([self.normals, other.normals]),
+            horizontals=np.concatenate([self.horizontals, other.horizontals]),
+            dx=np.concatenate([self.dx, convert(other.dx)]) * self.unit,
+            dy=np.concatenate([self.dy, convert(other.dy)]) * self.unit,
+            origin=origin)
+
+    @classmethod
+    def orbit(cls,
+              nframes: int,
+              dx: Quantity,
+              dy: Quantity = None,
+              origin: Array = None,
+              axis: Union[str, list] = "z",
+              start: Union[str, list] = "x",
+              angle: float = 360.0):
+        """
+        Rotate the camera around an ``axis``, which points up in the maps.
+
+        :param nframes: The number of frames.
+
+        :param axis: The axis of rotation, ``'x'``, ``'y'``, ``'z'`` or a vector.
+            Default is ``'z'``.
+
+        :param start: The direction of the first view, which is made perpendicular
+            to the ``axis``. Default is ``'x'``.
+
+        :param angle: The angle of the rotation, in degrees. Default is ``360``.
+        """
+        axis = _normalize(_AXES[axis][0] if isinstance(axis, str) else axis)
+        start = np.asarray(_AXES[start][0] if isinstance(start, str) else start,
+                           dtype=np.float64)
+        start = _normalize(start - np.dot(start, axis) * axis)
+        side = np.cross(axis, start)
+        # Do not repeat the first frame at the end of a full turn
+        endpoint = not np.isclose(angle % 360.0, 0.0)
+        angles = np.radians(np.linspace(0.0, angle, nframes, endpoint=endpoint))
+        normals = np.outer(np.cos(angles), start) + np.outer(np.sin(angles), side)
+        # Choose the horizontal axis so that the rotation axis points up
+        horizontals = np.cross(axis, normals)
+        return cls(normals=normals,
+                   horizontals=horizontals,
+                   dx=dx,
+                   dy=dy,
+                   origin=origin)
+
+    @classmethod
+    def zoom(cls,
+             nframes: int,
+             dx_start: Quantity,
+             dx_end: Quantity,
+             aspect: float = 1.0,
+             origin: Array = None,
+             direction: Union[str, list] = "z"):
+        """
+        Zoom the camera in or out, with a constant zoom factor between frames.
+
+        :param nframes: The number of frames.
+
+        :param dx_start: The horizontal size of the first map.
+
+        :param dx_end: The horizontal size of the last map.
+
+        :param aspect: The ratio ``dy / dx`` of the maps. Default is ``1``.
+
+        :param direction: The vector normal to the maps, ``'x'``, ``'y'``, ``'z'``
+            or a pair of vectors (the normal and the horizontal axis). Default
+            is ``'z'``.
+        """
+        if isinstance(direction, str):
+            normal, horizontal = _AXES[direction]
+        else:
+            normal, horizontal = direction
+        dx_end = dx_end.to(dx_start.units)
+        dx = np.geomspace(dx_start.magnitude, dx_end.magnitude,
+                          nframes) * dx_start.units
+        return cls(normals=np.tile(normal, (nframes, 1)),
+                   horizontals=np.tile(horizontal, (nframes, 1)),
+                   dx=dx,
+                   dy=dx * aspect,
+                   origin=origin)
+
+
+class _FrameRenderer:
+    """
+    Render frames with a single figure, updating the data of the artists in place
+    when possible.
+    """
+    def __init__(self, specs, xlabel, ylabel, figsize, dpi):
+        self.specs = specs
+        self.dpi = dpi
+        self.fig = Figure(figsize=figsize, dpi=dpi)
+        FigureCanvasAgg(self.fig)
+        self.ax = self.fig.add_subplot()
+        self.ax.set_xlabel(xlabel)
+        self.ax.set_ylabel(ylabel)
+        self.ax.set_aspect("equal")
+        self.artists = None
+        self._skip = None
+
+    def _arrows(self, spec, frame, data):
+        """
+        The positions and components of the arrows of a vector layer, skipping
+        pixels in the same way as the ``quiver`` wrapper of :func:`map`.
+        """
+        if self._skip is None:
+            skips = np.around(
+                np.array(data.shape[:2]) * 4.0 / 128.0 /
+                spec["params"].get("density", 1)).astype(int)
+            skips = np.maximum(skips, 1)
+            self._skip = (slice(None, None, skips[0]), slice(None, None, skips[1]))
+        x, y = np.meshgrid(frame["x"], frame["y"])
+        return (x[self._skip], y[self._skip], data[self._skip][...,
+                                                               0], data[self._skip][...,
+                                                                                    1])
+
+    def _create(self, frame):
+        self.artists = []
+        for spec, data in zip(self.specs, frame["layers"]):
+            params = dict(spec["params"])
+            if spec["mode"] == "image":
+                params.setdefault("cmap", config.parameters["cmap"])
+                artist = self.ax.imshow(data,
+                                        origin="lower",
+                                        extent=frame["extent"],
+                                        interpolation="nearest",
+                                        **params)
+            elif spec["mode"] == "vec":
+                color = params.pop("color", "w")
+                params.pop("density", None)
+                params.update({"angles": "xy", "pivot": "mid"})
+                args = list(self._arrows(spec, frame, data))
+                if color is None:
+                    args.append(data[self._skip][..., 2])
+                else:
+                    params["color"] = color
+                artist = self.ax.quiver(*args, **params)
+            else:
+                artist = getattr(self.ax, spec["mode"])(frame["x"], frame["y"], data,
+                                                        **params)
+            if spec["cbar"] and (spec["mode"] != "vec"
+                                 or spec["params"].get("color", "w") is None):
+                colorbar = self.fig.colorbar(artist, ax=self.ax)
+                colorbar.set_label(spec["label"])
+            self.artists.append(artist)
+
+    def _update(self, frame):
+        for i, (spec, data) in enumerate(zip(self.specs, frame["layers"])):
+            artist = self.artists[i]
+            if spec["mode"] == "image":
+                artist.set_data(data)
+                artist.set_extent(frame["extent"])
+            elif spec["mode"] == "vec":
+                x, y, u, v = self._arrows(spec, frame, data)
+                artist.set_offsets(np.array([x.ravel(), y.ravel()]).T)
+                if spec["params"].get("color", "w") is None:
+                    artist.set_UVC(u, v, data[self._skip][..., 2])
+                else:
+                    artist.set_UVC(u, v)
+            else:
+                # Contours cannot be updated in place, so they are re-drawn
+                params = dict(spec["params"])
+                params["norm"] = artist.norm
+                artist.remove()
+                self.artists[i] = getattr(self.ax, spec["mode"])(frame["x"], frame["y"],
+                                                                 data, **params)
+
+    def draw(self, frame):
+        if self.artists is None:
+            self._create(frame)
+        else:
+            self._update(frame)
+        self.ax.set_xlim(frame["extent"][0], frame["extent"][1])
+        self.ax.set_ylim(frame["extent"][2], frame["extent"][3])
+        self.fig.savefig(frame["filename"], dpi=self.dpi)
+        return frame["filename"]
+
+
+# The renderer of a worker process
+_RENDERER = None
+
+
+def _init_worker(*args):
+    global _RENDERER
+    _RENDERER = _FrameRenderer(*args)
+
+
+def _draw(frame):
+    return _RENDERER.draw(frame)
+
+
+class _FrameWriter:
+    """
+    Write frames, either in the calling process if ``workers <= 1``, or with a
+    pool of worker processes. At most ``2 * workers`` frames are in flight.
+    """
+    def __init__(self, renderer_args, workers):
+        self.workers = workers
+        self.pending = deque()
+        self.renderer = None
+        self.executor = None
+        if workers > 1:
+            self.executor = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=renderer_args)
+        else:
+            self.renderer = _FrameRenderer(*renderer_args)
+
+    def write(self, frame):
+        if self.executor is None:
+            self.renderer.draw(frame)
+            return
+        if len(self.pending) >= 2 * self.workers:
+            self.pending.popleft().result()
+        self.pending.append(self.executor.submit(_draw, frame))
+
+    def finish(self):
+        """
+        Wait for all the frames to be written.
+        """
+        while self.pending:
+            self.pending.popleft().result()
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+
+
+def _frame(maps, projection, filename):
+    """
+    The data sent to a :class:`_FrameRenderer` to draw a frame.
+    """
+    return {
+        "filename": filename,
+        "x": maps.x,
+        "y": maps.y,
+        "extent": projection["extent"],
+        "layers": [layer["data"] for layer in maps.layers]
+    }
+
+
+def _render_spec(layer):
+    """
+    The description of a layer needed to create its artist.
+    """
+    mode = layer["mode"]
+    if mode is None:
+        mode = config.parameters["render_mode"]
+    if mode in ["image", "imshow", "pcolormesh"]:
+        mode = "image"
+    elif mode in ["vector"]:
+        mode = "vec"
+    if mode not in ["image", "vec", "contour", "contourf"]:
+        raise ValueError("Rendering mode '{}' is not supported by animate(). Use one "
+                         "of 'image', 'contour', 'contourf' or 'vec'.".format(mode))
+    params = dict(layer["params"])
+    cbar = params.pop("cbar", True)
+    data = layer["data"]
+    if mode == "vec":
+        if isinstance(params.get("color", "w"), str):
+            params.pop("norm", None)
+        else:
+            # The colors are the third component of the binned vectors
+            params["color"] = None
+            data = data[..., 2]
+    if params.get("norm") is not None and np.ma.count(data) > 0:
+        # Fix the color range from the first frame, so that it does not depend on
+        # which frame each worker renders first
+        params["norm"].autoscale_None(data)
+    return {
+        "mode": mode,
+        "params": params,
+        "cbar": cbar,
+        "label": make_label(name=layer.get("name", ""), unit=layer.get("unit", ""))
+    }
+
+
+def animate(*layers,
+            path: CameraPath,
+            filename: str = "frame_{:05d}.png",
+            dz: Quantity = None,
+            resolution: Union[int, dict] = None,
+            mode: str = None,
+            norm: str = None,
+            vmin: float = None,
+            vmax: float = None,
+            operation: str = "sum",
+            method: str = "sample",
+            weights: Array = None,
+            workers: int = 1,
+            figsize: tuple = None,
+            dpi: float = 100,
+            **kwargs) -> list:
+    """
+    Render a sequence of maps along a :class:`CameraPath`, and write them to an
+    image sequence. The cells covered by the whole path are selected once, and the
+    spatial index used to sample the cells is shared between all the frames.
+    The maps are projected one after the other in the calling process, by the
+    multi-threaded kernels of :func:`map`, and the frames are drawn and encoded by
+    ``workers`` processes, each of which re-uses a single figure and updates the
+    data of its artists in place. At most ``2 * workers`` frames are held in
+    memory at any time.
+
+    Note that unless ``vmin`` and ``vmax`` are given, the color ranges are set by
+    the first frame. As for any use of ``multiprocessing`` with the ``spawn``
+    start method, scripts using ``workers > 1`` must protect their entry point
+    with ``if __name__ == '__main__':``.
+
+    :param layers: Dicts or Arrays representing the quantities to be mapped onto the
+        generated images, as for :func:`map`. Only the ``'image'``, ``'contour'``,
+        ``'contourf'`` and ``'vec'`` modes are supported.
+
+    :param path: The :class:`CameraPath` describing the views.
+
+    :param filename: The file names of the frames, formatted with the frame number.
+        Default is ``'frame_{:05d}.png'``.
+
+    :param dz: The depth range over which the maps are integrated. Default is
+        ``None``, in which case planes with no thickness are plotted.
+
+    :param resolution: Resolution of the generated maps, see :func:`map`.
+        Default is ``256``.
+
+    :param workers: The number of processes rendering the frames. Default is
+        ``1``, in which case the frames are rendered by the calling process.
+
+    :param figsize: The size of the figure, in inches. Default is ``None``, which
+        uses the matplotlib default.
+
+    :param dpi: The resolution of the figure, in dots per inch. Default is
+        ``100``.
+
+    The other arguments are the same as for :func:`map`.
+
+    :return: The list of the file names of the frames.
+    """
+    to_process, _, to_scatter = _parse_layers(layers,
+                                              mode=mode,
+                                              norm=norm,
+                                              vmin=vmin,
+                                              vmax=vmax,
+                                              **kwargs)
+    if len(to_scatter) > 0:
+        raise ValueError("Scatter layers are not supported by animate().")
+    dataset = to_process[0].parent.parent
+    _check_method(method=method, dataset=dataset, thick=dz is not None)
+    ndim = dataset.meta["ndim"]
+    xyz_unit = dataset["amr"]["xyz"].unit
+
+    # Select the cells covered by all the frames once, in a sphere containing the
+    # regions of all the frames
+    origins = np.zeros((len(path), ndim))
+    if path.origin is not None:
+        origins = (path.origin * path.unit).to(xyz_unit.units).magnitude
+    center = origins.mean(axis=0)
+    windows = np.maximum((path.dx * path.unit).to(xyz_unit.units).magnitude,
+                         (path.dy * path.unit).to(xyz_unit.units).magnitude)
+    if dz is not None:
+        windows = np.maximum(windows, dz.to(xyz_unit.units).magnitude)
+    radius = np.max(
+        np.linalg.norm(origins - center, axis=1) + windows * 0.6 * np.sqrt(ndim))
+    candidates, index = _select_region(dataset=dataset,
+                                       center=Array(values=center.reshape(1, ndim),
+                                                    unit=xyz_unit),
+                                       radius=radius,
+                                       method=method)
+
+    writer = None
+    filenames = []
+    try:
+        for i in range(len(path)):
+            frame = path[i]
+            origin = Array(values=origins[i:i + 1], unit=xyz_unit)
+            to_process, to_render, _ = _parse_layers(layers,
+                                                     mode=mode,
+                                                     norm=norm,
+                                                     vmin=vmin,
+                                                     vmax=vmax,
+                                                     **kwargs)
+            frame_index = None
+            if index is not None:
+                frame_index = index.shifted(origins[i] - center)
+            projection = _project(to_process=to_process,
+                                  to_render=to_render,
+                                  dataset=dataset,
+                                  directions=[frame["direction"]],
+                                  dx=frame["dx"],
+                                  dy=frame["dy"],
+                                  dz=dz,
+                                  origin=origin,
+                                  resolution=resolution,
+                                  operation=operation,
+                                  method=method,
+                                  weights=weights,
+                                  candidates=candidates,
+                                  index=frame_index)[0]
+            maps = _make_plot(projection=projection,
+                              to_render=to_render,
+                              to_scatter=[],
+                              dataset=dataset,
+                              filename=None,
+                              plot=False,
+                              ax=None)
+            data = _frame(maps=maps, projection=projection, filename=filename.format(i))
+            filenames.append(data["filename"])
+            if writer is None:
+                specs = [_render_spec(layer) for layer in maps.layers]
+                writer = _FrameWriter(
+                    renderer_args=(specs, dataset["amr"]["xyz"].x.label,
+                                   dataset["amr"]["xyz"].y.label, figsize, dpi),
+                    workers=workers)
+            writer.write(data)
+        if writer is not None:
+            writer.finish()
+    finally:
+        if writer is not None:
+            writer.shutdown()
+    return filenames
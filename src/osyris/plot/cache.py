@@ -0,0 +1,118 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (c) 2022 Osyris contributors (https://github.com/nvaytet/osyris)
+
+from collections import OrderedDict
+import weakref
+import numpy as np
+from pint.quantity import Quantity
+from ..core import Array
+
+
+def _freeze(value):
+    """
+    Convert an argument of ``map()`` to something hashable.
+    """
+    if value is None or isinstance(value, (str, int, float)):
+        return value
+    if isinstance(value, Array):
+        return ("Array", value.values.tobytes(), value.values.shape,
+                "{}".format(value.unit))
+    if isinstance(value, Quantity):
+        return ("Quantity", _freeze(value.magnitude), "{}".format(value.units))
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, np.ndarray):
+        return ("ndarray", value.tobytes(), value.shape)
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    return ("id", id(value))
+
+
+def _array_key(array):
+    """
+    Identify an Array by identity, and by its current buffer and unit, so that
+    replacing the values or converting the unit invalidates the cached maps.
+    """
+    return (id(array), id(array._array), array._unit.uid, array._unit.magnitude)
+
+
+class MapCache:
+    """
+    A bounded, least-recently-used cache of the binned data computed by
+    ``map()``, so that calls which only differ by style parameters (``norm``,
+    ``vmin``, ``cmap``, ``mode``...) go straight to the rendering.
+
+    Entries are keyed on the identity and version of the dataset, the layer
+    Arrays and the geometry of the map. Weak references to the objects the key
+    was built from are kept, to make sure that a hit does not come from a new
+    object which re-uses the id of a deleted one. Note that modifying the values
+    of an Array in place (e.g. ``array.values *= 2``) is not detected, use
+    :meth:`clear` in this case.
+    """
+    def __init__(self, maxsize=8):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def make_key(self,
+                 dataset,
+                 layers,
+                 vectors,
+                 colors,
+                 direction,
+                 dx,
+                 dy,
+                 dz,
+                 origin,
+                 resolution,
+                 operation,
+                 method,
+                 weights,
+                 deposits=None,
+                 rows=None):
+        """
+        Build the key of a map, and the list of objects it refers to.
+        """
+        objects = [dataset] + list(layers)
+        for item in colors + [weights]:
+            if isinstance(item, Array):
+                objects.append(item)
+        version = tuple(
+            (name, id(group), group._version) for name, group in dataset.items())
+        layer_keys = tuple(_array_key(layer) for layer in layers)
+        color_keys = tuple(
+            _array_key(c) if isinstance(c, Array) else _freeze(c) for c in colors)
+        weights_key = _array_key(weights) if weights is not None else None
+        geometry = tuple(
+            _freeze(item) for item in [direction, dx, dy, dz, origin, resolution])
+        deposits_key = tuple(deposits) if deposits is not None else None
+        key = (id(dataset), version, layer_keys, tuple(vectors), color_keys, geometry,
+               operation, method, weights_key, deposits_key, _freeze(rows))
+        return key, objects
+
+    def get(self, key, objects):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        refs, value = entry
+        if any(ref() is not obj for ref, obj in zip(refs, objects)):
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key, objects, value):
+        if self.maxsize <= 0:
+            return
+        self._entries[key] = ([weakref.ref(obj) for obj in objects], value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+
+map_cache = MapCache()
@@ -5,12 +5,17 @@ import numpy as np
 from typing import Union, Iterable
 from ..core import Plot, Array
 from .render import render
-from ..core.tools import to_bin_centers, finmin, finmax
+from ..core.tools import to_bin_centers
+from .. import units
+from .utils import finite_range, hist1d
+
+_OPERATIONS = ["sum", "count", "mean", "std"]
 
 
 def histogram1d(*layers: Union[Iterable, Array],
                 bins: Union[int, Iterable] = 50,
                 weights: Array = None,
+                operation: str = "sum",
                 logx: bool = False,
                 logy: bool = False,
                 loglog: bool = False,
@@ -18,6 +23,7 @@ def histogram1d(*layers: Union[Iterable, Array],
                 title: str = None,
                 ymin: float = None,
                 ymax: float = None,
+                plot: bool = True,
                 ax: object = None,
                 **kwargs) -> Plot:
     """
@@ -30,9 +36,23 @@ def histogram1d(*layers: Union[Iterable, Array],
     For the documentation of any parameters that are not listed below, see
     https://matplotlib.org/stable/api/_as_gen/matplotlib.pyplot.hist.html.
 
+    The histograms are computed with a multi-threaded kernel, and only the
+    resulting bins are sent to matplotlib.
+
     :param layers: Dicts or Arrays representing the quantities to be mapped onto the
         colormap of the generated image.
 
+    :param bins: The number of bins, or the bin edges. When a number of bins is
+        given, the bins are equally spaced between the finite minimum and maximum
+        of the data (in log space if ``logx`` is ``True``). Default is ``50``.
+
+    :param weights: An Array of weights for the data. Default is ``None``.
+
+    :param operation: The quantity computed in each bin. Possible values are
+        ``'sum'`` (the sum of the weights, i.e. the number of values in the bin if
+        there are no weights), ``'count'``, and the ``'mean'`` and ``'std'``
+        (standard deviation) of the weights. Default is ``'sum'``.
+
     :param logx: If ``True``, use logarithmic scaling on the horizontal axis.
         Default is ``False``.
 
@@ -51,55 +71,89 @@ def histogram1d(*layers: Union[Iterable, Array],
 
     :param ymax: Maximum value for the vertical axis. Default is ``None``.
 
+    :param plot: Make a plot if ``True``. If not, just return the ``Plot`` object
+        containing the data that would be used to generate the plot.
+        Default is ``True``.
+
     :param ax: A matplotlib axes inside which the figure will be plotted.
         Default is ``None``, in which case some new axes a created.
     """
     if loglog:
         logx = logy = True
 
-    figure = render(logx=logx, logy=logy, ax=ax)
+    figure = {"fig": None, "ax": None}
+    if plot:
+        figure = render(logx=logx, logy=logy, ax=ax)
 
+    to_render = []
     for layer in layers:
         if isinstance(layer, dict):
             params = {}
             extra_args = {}
             for key, param in layer.items():
-                if key in ["data", "bins", "weights"]:
+                if key in ["data", "bins", "weights", "operation"]:
                     params[key] = param
                 else:
                     extra_args[key] = param
-            for key, arg in {'bins': bins, 'weights': weights}.items():
+            for key, arg in {
+                    'bins': bins,
+                    'weights': weights,
+                    'operation': operation
+            }.items():
                 if key not in params:
                     params[key] = arg
         else:
-            params = {'data': layer, 'bins': bins, 'weights': weights}
+            params = {
+                'data': layer,
+                'bins': bins,
+                'weights': weights,
+                'operation': operation
+            }
             extra_args = kwargs
+        if params['operation'] not in _OPERATIONS:
+            raise ValueError("Unknown operation '{}', possible choices are {}.".format(
+                params['operation'], _OPERATIONS))
 
         xvals = params['data'].norm.values
+        # The bins hold the number of values, or statistics of the weights
+        unit = units.dimensionless
         if params['weights'] is not None:
+            if params['operation'] != "count":
+                unit = params['weights'].unit.units
             params['weights'] = params['weights'].norm.values
 
         # Construct some bin edges
-        if isinstance(params['bins'], int):
-            xmin = finmin(xvals)
-            xmax = finmax(xvals)
+        uniform = isinstance(params['bins'], int)
+        if uniform:
+            xmin, xmax = finite_range(xvals, log=logx)
             if logx:
-                xedges = np.logspace(np.log10(xmin), np.log10(xmax), params['bins'] + 1)
+                xedges = np.logspace(xmin, xmax, params['bins'] + 1)
             else:
                 xedges = np.linspace(xmin, xmax, params['bins'] + 1)
         else:
-            xedges = params['bins']
-
-        ydata, _, _ = figure["ax"].hist(xvals,
-                                        bins=xedges,
-                                        weights=params['weights'],
-                                        **extra_args)
-
-        figure["ax"].set_xlabel(params['data'].label)
-
-    figure["ax"].set_ylim(ymin, ymax)
+            xedges = np.asarray(params['bins'], dtype=np.float64)
+
+        binned = hist1d(x=xvals,
+                        edges=xedges,
+                        weights=params['weights'],
+                        log=logx,
+                        uniform=uniform)
+        ydata = binned[params['operation']].astype(np.float64)
+        to_render.append({"data": ydata, "name": params['data'].name, "unit": unit})
+
+        if plot:
+            # Draw the computed bins, using one point per bin
+            figure["ax"].hist(to_bin_centers(xedges),
+                              bins=xedges,
+                              weights=ydata,
+                              **extra_args)
+            figure["ax"].set_xlabel(params['data'].label)
+
+    if plot:
+        figure["ax"].set_ylim(ymin, ymax)
     return Plot(x=to_bin_centers(xedges),
                 y=ydata,
+                layers=to_render,
                 fig=figure["fig"],
                 ax=figure["ax"],
                 filename=filename)
@@ -5,9 +5,10 @@ import numpy as np
 from typing import Union
 from ..core import Array, Plot
 from .render import render
-from ..core.tools import to_bin_centers, finmin, finmax
+from ..core.tools import to_bin_centers
+from .. import units
 from .parser import parse_layer
-from .utils import hist2d
+from .utils import STATISTICS, finite_range, hist2d
 
 
 def histogram2d(x: Array,
@@ -71,7 +72,9 @@ def histogram2d(x: Array,
         Default is ``256``.
 
     :param operation: The operation to apply inside the bins of the histogram.
-        Possible values are ``'sum'`` and ``'mean'``. Default is ``'sum'``.
+        Possible values are ``'sum'``, ``'mean'``, ``'min'``, ``'max'``, ``'var'``
+        (the variance) and ``'count'``. All the statistics are computed in a single
+        pass over the data. Default is ``'sum'``.
 
     :param title: The title of the figure. Default is ``None``.
 
@@ -100,12 +103,9 @@ def histogram2d(x: Array,
     nx = resolution
     ny = resolution
 
+    # The log of the coordinates is taken inside the histogramming kernel
     xvals = x.norm.values
     yvals = y.norm.values
-    if logx:
-        xvals = np.log10(xvals)
-    if logy:
-        yvals = np.log10(yvals)
 
     # Define plotting range
     autoxmin = False
@@ -113,23 +113,27 @@ def histogram2d(x: Array,
     autoymin = False
     autoymax = False
 
+    if xmin is None or xmax is None:
+        xrange = finite_range(xvals, log=logx)
+    if ymin is None or ymax is None:
+        yrange = finite_range(yvals, log=logy)
     if xmin is None:
-        xmin = finmin(xvals)
+        xmin = xrange[0]
         autoxmin = True
     else:
         xmin = np.log10(xmin)
     if xmax is None:
-        xmax = finmax(xvals)
+        xmax = xrange[1]
         autoxmax = True
     else:
         xmax = np.log10(xmax)
     if ymin is None:
-        ymin = finmin(yvals)
+        ymin = yrange[0]
         autoymin = True
     else:
         ymin = np.log10(ymin)
     if ymax is None:
-        ymax = finmax(yvals)
+        ymax = yrange[1]
         autoymax = True
     else:
         ymax = np.log10(ymax)
@@ -189,32 +193,44 @@ def histogram2d(x: Array,
                                              vmax=vmax,
                                              operation=operation,
                                              **kwargs)
+        if settings["operation"] not in STATISTICS:
+            raise ValueError("Unknown operation '{}', possible choices are {}.".format(
+                settings["operation"], STATISTICS))
+        unit = data.unit.units
+        if settings["operation"] == "var":
+            unit = unit**2
+        elif settings["operation"] == "count":
+            unit = units.dimensionless
         to_process.append(data.norm.values)
         to_render.append({
             "mode": settings["mode"],
             "params": params,
-            "unit": data.unit.units,
+            "unit": unit,
             "name": data.name
         })
         operations.append(settings["operation"])
 
     # Send to numba histogramming
-    binned, counts = hist2d(x=xvals,
-                            y=yvals,
-                            values=np.array(to_process),
-                            xmin=xmin,
-                            xmax=xmax,
-                            nx=nx,
-                            ymin=ymin,
-                            ymax=ymax,
-                            ny=ny)
-
-    mask = counts == 0
+    binned = hist2d(x=xvals,
+                    y=yvals,
+                    values=np.array(to_process),
+                    xmin=xmin,
+                    xmax=xmax,
+                    nx=nx,
+                    ymin=ymin,
+                    ymax=ymax,
+                    ny=ny,
+                    logx=logx,
+                    logy=logy,
+                    statistics=operations)
+
+    mask = binned["count"] == 0
     for ind in range(len(to_process)):
-        if operations[ind] == "mean":
-            with np.errstate(invalid="ignore"):
-                binned[ind, ...] /= counts
-        to_render[ind]["data"] = np.ma.masked_where(mask, binned[ind, ...])
+        if operations[ind] == "count":
+            data = binned["count"].astype(np.float64)
+        else:
+            data = binned[operations[ind]][ind, ...]
+        to_render[ind]["data"] = np.ma.masked_where(mask, data)
 
     to_return = {
         "x": xcenters,
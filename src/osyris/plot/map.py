@@ -9,12 +9,15 @@ from .slice import get_slice_direction
 from .render import render
 from .scatter import scatter
 from .parser import parse_layer
-from ..core import Plot, Array
+from ..core import Plot, Array, DatagroupView
+from ..core.spatial import CellIndex
 from ..core.tools import apply_mask
-from .utils import evaluate_on_grid
+from .cache import map_cache
+from .utils import deposit_on_grid, evaluate_on_grid, project_values
+from ..analysis.deposit import _group_smoothing, deposit_particles
 
 
-def _add_scatter(to_scatter, origin, dir_vecs, dx, dy, ax):
+def _add_scatter(to_scatter, origin, dir_vecs, dx, dy, extent, resolution, ax):
     xyz = to_scatter[0]["data"] - origin
     viewport = max(dx.magnitude, dy.magnitude)
     radius = None
@@ -48,121 +51,119 @@ def _add_scatter(to_scatter, origin, dir_vecs, dx, dy, ax):
             if isinstance(to_scatter[0]["params"]["c"], Array):
                 to_scatter[0]["params"]["c"] = to_scatter[0]["params"]["c"][
                     global_selection]
-        scatter(x=datax, y=datay, ax=ax, **to_scatter[0]["params"])
-
-
-def map(*layers,
-        direction: Union[str, list] = "z",
-        dx: Quantity = None,
-        dy: Quantity = None,
-        dz: Quantity = None,
-        filename: str = None,
-        title: str = None,
-        plot: bool = True,
-        mode: str = None,
-        norm: str = None,
-        vmin: float = None,
-        vmax: float = None,
-        origin: Array = None,
-        resolution: Union[int, dict] = None,
-        operation: str = "sum",
-        ax: object = None,
-        **kwargs) -> Plot:
+        density = {}
+        if to_scatter[0]["mode"] == "density":
+            # Aggregate the points onto the pixels of the map
+            density = {
+                "mode": "density",
+                "operation": to_scatter[0]["operation"],
+                "xmin": extent[0],
+                "xmax": extent[1],
+                "ymin": extent[2],
+                "ymax": extent[3],
+                "resolution": resolution
+            }
+        scatter(x=datax, y=datay, ax=ax, **density, **to_scatter[0]["params"])
+
+
+def _parse_layers(layers, **kwargs):
     """
-    Create a 2D spatial map of a region inside a simulation domain.
-    By default, the map represents a plane with zero thickness.
-    A thick slab or cube can also be computed by specifying a thickness via the
-    ``dz`` argument. In this case, the resulting 3D box is integrated along the ``z``
-    direction before being sent to the image rendering.
-
-    :param layers: Dicts or Arrays representing the quantities to be mapped onto the
-        generated image.
-
-    :param direction: The vector normal to the map. Possible choices are:
-
-       * ``'x'``, ``'y'``, or ``'z'`` representing the cartesian axes
-       * a list of 3 numbers representing the components of the vector,
-         e.g. ``[1, 0.5, 2]``
-       * ``'top'`` or ``'side'`` for automatic top or side view of a disk, according to
-         the angular momentum computed around the center of the plotted region
-
-    :param dx: The horizontal size of the plotted region. Default is ``None``,
-        in which case the entire horizontal range of the simulation domain is plotted.
-
-    :param dy: The vertical size of the plotted region. If not specified, it will
-        either be equal to ``dx`` if ``dx`` is not ``None``, or the entire vertical
-        range of the simulation domain if ``dx`` is ``None``. Default is ``None``.
-
-    :param dz: The depth range over which the ``z`` dimension is to be integrated.
-        Default is ``None``, in which case a plane with no thickness is plotted.
-
-    :param filename: If specified, the returned figure is also saved to file.
-        Default is ``None``.
-
-    :param title: The title of the figure. Default is ``None``.
-
-    :param plot: Make a plot if ``True``. If not, just return the ``Plot`` object
-        containing the data that would be used to generate the plot.
-        Default is ``True``.
-
-    :param mode: The rendering mode for the map. Possible choices are ``'image'``,
-        ``'contourf'``, and ``'contour'`` for scalar Arrays, ``'vec'`` and
-        ``'stream'`` for vector quantities. Default is ``None``, which selects the
-        ``render_mode`` set in the user configuration file (``'image'`` by default).
-
-    :param norm: The colormap normalization. Possible values are ``'linear'`` and
-        ``'log'``. Default is ``None`` (= ``'linear'``).
-
-    :param vmin: Minimum value for colorbar range. Default is ``None``.
-
-    :param vmax: Maximum value for colorbar range. Default is ``None``.
-
-    :param origin: An Array describing the position of the center of the map
-        (with 2 or 3 components depending on the dimensionality of the simulation).
-
-    :param resolution: Resolution of the generated map. This can either be an
-        integer or a dict. In the case of an integer, it represents the number of
-        pixels used for the horizontal and vertical dimensions. For a dictionary,
-        the following syntax should be used: ``resolution={'x': 128, 'y': 192}``.
-        Default is ``256``.
-
-    :param operation: The operation to apply along the ``z`` dimension if ``dz`` is
-        not ``None``. Possible values are ``'sum'``, ``'mean'``, ``'min'``, and
-        ``'max'``. Default is ``'sum'``.
-
-    :param ax: A matplotlib axes inside which the figure will be plotted.
-        Default is ``None``, in which case some new axes a created.
+    Split the layers into the ones to be binned onto the map, and the scatter
+    layers (drawn as markers, or aggregated onto pixels in ``'density'`` mode).
     """
-
-    if isinstance(layers, Array):
-        layers = [layers]
-
     to_process = []
     to_render = []
     to_scatter = []
     for layer in layers:
-        data, settings, params = parse_layer(layer=layer,
-                                             mode=mode,
-                                             norm=norm,
-                                             vmin=vmin,
-                                             vmax=vmax,
-                                             **kwargs)
-        if settings["mode"] == "scatter":
-            to_scatter.append({"data": data, "params": params})
+        data, settings, params = parse_layer(layer=layer, **kwargs)
+        if settings["mode"] in ["scatter", "density"]:
+            # The operation of the map does not apply to the scatter points
+            operation = None
+            if isinstance(layer, dict):
+                operation = layer.get("operation")
+            to_scatter.append({
+                "data": data,
+                "params": params,
+                "mode": settings["mode"],
+                "operation": operation
+            })
         else:
             to_process.append(data)
             to_render.append({
                 "mode": settings["mode"],
                 "params": params,
                 "unit": data.unit.units,
-                "name": data.name
+                "name": data.name,
+                "deposit": settings["deposit"]
             })
+    return to_process, to_render, to_scatter
 
-    dataset = to_process[0].parent.parent
-
-    thick = dz is not None
 
-    # Set window size
+def _source_column(array, ncells):
+    """
+    The column of all the cells for an Array selected from a
+    :class:`DatagroupView`, and the indices of the selected cells (``None`` for
+    Arrays which do not come from a view). Columns which were added to the view
+    only are expanded to all the cells, with NaNs in the cells which are not
+    selected.
+    """
+    view = array.parent
+    if not isinstance(view, DatagroupView):
+        return array, None
+    rows = np.arange(ncells)[view.selection]
+    if array.name in view._container:
+        values = np.full((ncells, ) + array.shape[1:], np.nan)
+        values[rows] = array.values
+        return Array(values=values, unit=array._unit, name=array.name), rows
+    return view._source[array.name], rows
+
+
+def _select_rows(to_process, to_render, weights, ncells):
+    """
+    Layers selected from a :class:`DatagroupView` (e.g.
+    ``data['hydro'][data['hydro']['density'] > rho]``) are mapped using only the
+    selected cells. Replace these layers (and their colors) by the columns of all
+    the cells, and return the indices of the selected cells, or ``None`` if there
+    is no selection. All the cell layers must come from the same selection.
+    """
+    rows = []
+    for ind, layer in enumerate(to_render):
+        if layer.get("deposit") is not None:
+            # Particle views carry their own positions
+            continue
+        to_process[ind], selection = _source_column(to_process[ind], ncells)
+        rows.append(selection)
+        color = layer["params"].get("color")
+        if isinstance(color, Array):
+            layer["params"]["color"], selection = _source_column(color, ncells)
+            rows.append(selection)
+    if weights is not None:
+        weights, selection = _source_column(weights, ncells)
+        rows.append(selection)
+    if len(rows) == 0:
+        return None, weights
+    for selection in rows[1:]:
+        if (selection is None) != (rows[0] is None) or (
+                selection is not None and not np.array_equal(selection, rows[0])):
+            raise ValueError("All the cell layers of a map must be selected with "
+                             "the same rows.")
+    return rows[0], weights
+
+
+def _check_method(method, dataset, thick):
+    if method not in ["sample", "deposit"]:
+        raise ValueError("Unknown method '{}', possible choices are 'sample' and "
+                         "'deposit'.".format(method))
+    if method == "deposit" and (not thick or dataset.meta["ndim"] < 3):
+        raise ValueError("The 'deposit' method can only be used for thick maps "
+                         "(with dz) of 3D simulations.")
+
+
+def _window(dataset, dx, dy, dz):
+    """
+    Set the window size, converting numbers to Quantities in the unit of the cell
+    positions.
+    """
     if dy is None:
         dy = dx
     if dz is None:
@@ -173,96 +174,214 @@ def map(*layers,
         dy *= dataset["amr"]["xyz"].unit
     if dz is not None and not isinstance(dz, Quantity):
         dz *= dataset["amr"]["xyz"].unit
+    return dx, dy, dz
+
 
-    dir_vecs, origin = get_slice_direction(direction=direction,
-                                           dataset=dataset,
-                                           dx=dx,
-                                           dy=dy,
-                                           origin=origin)
+def _gather(to_process, to_render, indices):
+    """
+    Gather the values of the layers in the selected cells. Vector layers are
+    gathered with all their components, followed by their color (if any), so that
+    the same values can be projected onto the planes of several maps. Returns the
+    gathered values, the layout of the projected rows (see :func:`project_values`)
+    and whether each layer is a scalar.
+    """
+    scalar_layer = []
+    to_binning = []
+    layout = []
+    for ind in range(len(to_process)):
+        if to_render[ind]["mode"] in ["vec", "stream", "lic"]:
+            vectors = to_process[ind].array.take(indices, axis=0)
+            start = len(to_binning)
+            for component in range(vectors.shape[1]):
+                to_binning.append(apply_mask(vectors[:, component]))
+            w = None
+            if "color" in to_render[ind]["params"]:
+                if isinstance(to_render[ind]["params"]["color"], Array):
+                    w = to_render[ind]["params"]["color"].norm.values
+                elif isinstance(to_render[ind]["params"]["color"], np.ndarray):
+                    w = to_render[ind]["params"]["color"]
+            color = -1
+            if w is not None:
+                color = len(to_binning)
+                to_binning.append(w.take(indices, axis=0))
+            layout += [(kind, start, vectors.shape[1], color) for kind in (1, 2, 3)]
+            scalar_layer.append(False)
+        else:
+            layout.append((0, len(to_binning), 1, -1))
+            to_binning.append(apply_mask(to_process[ind].norm.values[indices]))
+            scalar_layer.append(True)
+    return np.array(to_binning), np.array(layout, dtype=np.int64), scalar_layer
 
+
+def _select_region(dataset, center, radius, method, rows=None):
+    """
+    Select the cells within ``radius`` of ``center``, padded by the cell sizes so
+    that the selections made by :func:`_project` for maps inside the sphere are
+    all contained in it. For the sample method, a :class:`CellIndex` of the
+    selected cells, with positions relative to ``center``, is also built. If
+    ``radius`` is ``None``, all the cells are used. The cells can be restricted to
+    the indices ``rows``.
+    """
+    ndim = dataset.meta["ndim"]
+    candidates = rows
+    xyz = dataset["amr"]["xyz"] - center
+    half_sizes = 0.5 * dataset["amr"]["dx"].values
+    if rows is not None:
+        xyz = xyz[rows]
+        half_sizes = half_sizes[rows]
+    if radius is not None:
+        inside = np.flatnonzero(xyz.norm.values <= radius + half_sizes * ndim)
+        candidates = inside if rows is None else rows[inside]
+        xyz = xyz[inside]
+        half_sizes = half_sizes[inside]
+    index = None
+    if method == "sample":
+        index = CellIndex(positions=xyz.values, half_sizes=half_sizes)
+    return candidates, index
+
+
+def _particle_coordinates(layers, origin, dir_vecs, unit):
+    """
+    The coordinates along the axes of the map (in the unit of the cell positions)
+    of the particles of the groups the deposited layers belong to, keyed on the
+    ids of the groups.
+    """
+    particles = {}
+    for data in layers:
+        group = data.parent
+        if group is None or "position" not in group:
+            raise ValueError("Deposited layers must belong to a group of particles "
+                             "with a 'position', such as 'part'.")
+        if id(group) in particles:
+            continue
+        position = group["position"]
+        coords = (position - origin).to(unit.units).values / unit.magnitude
+        particles[id(group)] = {
+            "group": group,
+            "x": np.inner(coords, dir_vecs[1]),
+            "y": np.inner(coords, dir_vecs[2]),
+            "z": np.inner(coords, dir_vecs[0]),
+            # The ratio of the units of the particle and cell positions
+            "scale": (1.0 * position.unit).to(unit.units).magnitude / unit.magnitude
+        }
+    return particles
+
+
+def _particle_extent(particles):
+    """
+    The extent of the particles along the axes of the map.
+    """
+    extent = []
+    for axis in "xyz":
+        values = np.concatenate([coords[axis] for coords in particles.values()])
+        extent += [np.nanmin(values), np.nanmax(values)]
+    return extent
+
+
+def _deposit_layer(data, layer, particles, dir_vecs, extent, resolution, operation,
+                   weights, unit):
+    """
+    Deposit a particle layer onto the pixels of the map, with the kernel given by
+    its ``deposit`` setting. Only the particles within the depth of the map are
+    used. With the ``'sum'`` operation, the result is the sum of the values per
+    unit area of the pixels (e.g. the surface density for the mass). With
+    ``'mean'``, it is the mean of the values, weighted by the kernel and the
+    ``weights`` (if they belong to the same group as the particles).
+    """
+    if operation not in ["sum", "mean"]:
+        raise ValueError("Only the 'sum' and 'mean' operations are supported for "
+                         "deposited layers.")
+    xmin, xmax, ymin, ymax, zmin, zmax = extent
+    xspacing = (xmax - xmin) / resolution['x']
+    yspacing = (ymax - ymin) / resolution['y']
+    selection = np.flatnonzero((particles["z"] >= zmin) & (particles["z"] <= zmax))
+    values, layout, scalar_layer = _gather(to_process=[data],
+                                           to_render=[layer],
+                                           indices=selection)
+    values = project_values(cell_values=values, layout=layout, dir_vecs=dir_vecs)
+    smoothing = None
+    if layer["deposit"] == "sph":
+        group = particles["group"]
+        smoothing = _group_smoothing(group, group["position"],
+                                     neighbours=32)[selection] * particles["scale"]
+    particle_weights = None
+    if operation == "mean" and weights is not None and weights.parent is data.parent:
+        particle_weights = weights.norm.values[selection]
+    positions = np.array([particles["y"][selection], particles["x"][selection]]).T
+    grid = deposit_particles(positions=positions,
+                             values=values,
+                             lower=[ymin, xmin],
+                             spacing=[yspacing, xspacing],
+                             shape=(resolution['y'], resolution['x']),
+                             kernel=layer["deposit"],
+                             weights=particle_weights,
+                             smoothing=smoothing,
+                             projected=len(dir_vecs[0]) > 2)
+    if operation == "sum":
+        return grid[:-1] / (xspacing * yspacing), scalar_layer[0]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return grid[:-1] / grid[-1], scalar_layer[0]
+
+
+def _plane_cells(dataset, dir_vecs, origin, dx, dy, dz, thick, candidates):
+    """
+    Select the cells close to the plane of a map, among the ``candidates`` (all the
+    cells if ``None``). Returns the indices of the selected cells, and their
+    positions relative to the ``origin``, coordinates along the axes of the map and
+    half sizes.
+    """
     # Distance to the plane
     diagonal = np.sqrt(dataset.meta["ndim"])
-    xyz = dataset["amr"]["xyz"] - origin
-    selection_distance = 0.5 * diagonal * (dz if thick else dataset["amr"]["dx"])
+    if candidates is None:
+        candidates = np.arange(len(dataset["amr"]["dx"]))
+        xyz = dataset["amr"]["xyz"] - origin
+        cell_dx = dataset["amr"]["dx"]
+    else:
+        xyz = dataset["amr"]["xyz"][candidates] - origin
+        cell_dx = dataset["amr"]["dx"][candidates]
+    selection_distance = 0.5 * diagonal * (dz if thick else cell_dx)
     dist_to_plane = np.sum(xyz * dir_vecs[0], axis=1)
-    # Create an array of indices to allow further narrowing of the selection below
-    global_indices = np.arange(len(dataset["amr"]["dx"]))
     # Select cells close to the plane, including factor of sqrt(ndim)
     close_to_plane = np.ravel(np.where(np.abs(dist_to_plane) <= selection_distance))
-    indices_close_to_plane = global_indices[close_to_plane]
 
-    if len(indices_close_to_plane) == 0:
-        raise RuntimeError("No cells were selected to construct the column density. "
-                           "The resulting figure would be empty.")
+    if len(close_to_plane) == 0:
+        raise RuntimeError("No cells were selected to construct the column "
+                           "density. The resulting figure would be empty.")
 
-    xmin = None
     if dx is not None:
-        xmin = -0.5 * dx.magnitude
-        xmax = xmin + dx.magnitude
-        ymin = -0.5 * dy.magnitude
-        ymax = ymin + dy.magnitude
-        zmin = -0.5 * dz.magnitude
-        zmax = zmin + dz.magnitude
         # Limit selection further by using distance from center
-        radial_distance = xyz[indices_close_to_plane] - 0.5 * dataset["amr"]["dx"][
-            indices_close_to_plane] * diagonal
+        radial_distance = xyz[close_to_plane] - 0.5 * cell_dx[close_to_plane] * diagonal
         radial_selection = np.ravel(
             np.where(
                 np.abs(radial_distance.norm.values) <=
                 max(dx.magnitude, dy.magnitude, dz.magnitude) * 0.6 * diagonal))
-        indices_close_to_plane = indices_close_to_plane[radial_selection]
+        close_to_plane = close_to_plane[radial_selection]
 
     # Project coordinates onto the plane by taking dot product with axes vectors
-    coords = xyz[indices_close_to_plane]
-    datax = np.inner(coords, dir_vecs[1])
-    datay = np.inner(coords, dir_vecs[2])
-    dataz = np.inner(coords, dir_vecs[0])
-    datadx = dataset["amr"]["dx"][indices_close_to_plane] * 0.5
-
-    if xmin is None:
-        xmin = (datax - datadx).min().values
-        xmax = (datax + datadx).max().values
-        ymin = (datay - datadx).min().values
-        ymax = (datay + datadx).max().values
-        zmin = (dataz - datadx).min().values
-        zmax = (dataz + datadx).max().values
+    coords = xyz[close_to_plane]
+    return {
+        "indices": candidates[close_to_plane],
+        "coords": coords,
+        "x": np.inner(coords, dir_vecs[1]),
+        "y": np.inner(coords, dir_vecs[2]),
+        "z": np.inner(coords, dir_vecs[0]),
+        "dx": cell_dx[close_to_plane] * 0.5
+    }
 
-    scalar_layer = []
-    to_binning = []  # contains the variables in cells close to the plane
-    for ind in range(len(to_process)):
-        if to_render[ind]["mode"] in ["vec", "stream", "lic"]:
-            if to_process[ind].ndim < 3:
-                uv = to_process[ind].array[indices_close_to_plane]
-            else:
-                uv = np.inner(
-                    to_process[ind].array.take(indices_close_to_plane, axis=0),
-                    dir_vecs[1:])
-            w = None
-            if "color" in to_render[ind]["params"]:
-                if isinstance(to_render[ind]["params"]["color"], Array):
-                    w = to_render[ind]["params"]["color"].norm.values
-                elif isinstance(to_render[ind]["params"]["color"], np.ndarray):
-                    w = to_render[ind]["params"]["color"]
-            if w is None:
-                w = np.linalg.norm(uv, axis=1)
-            else:
-                w = w.take(indices_close_to_plane, axis=0)
-            to_binning.append(apply_mask(uv[:, 0]))
-            to_binning.append(apply_mask(uv[:, 1]))
-            to_binning.append(w)
-            scalar_layer.append(False)
-        else:
-            to_binning.append(
-                apply_mask(to_process[ind].norm.values[indices_close_to_plane]))
-            scalar_layer.append(True)
 
-    # Create a grid of pixel centers
+def _pixel_centers(extent, resolution, thick):
+    """
+    The centers of the pixels of a map along its axes, and the spacing along the
+    depth.
+    """
+    xmin, xmax, ymin, ymax, zmin, zmax = extent
     default_resolution = 256
     if resolution is None:
         resolution = default_resolution
     if isinstance(resolution, int):
         resolution = {'x': resolution, 'y': resolution}
     else:
+        resolution = dict(resolution)
         for xy in 'xy':
             if xy not in resolution:
                 resolution[xy] = default_resolution
@@ -277,52 +396,255 @@ def map(*layers,
             resolution['z'] = round((zmax - zmin) / (0.5 * (xspacing + yspacing)))
     zspacing = (zmax - zmin) / resolution['z']
 
-    xcenters = np.linspace(xmin + 0.5 * xspacing, xmax - 0.5 * xspacing,
-                           resolution['x'])
-    ycenters = np.linspace(ymin + 0.5 * yspacing, ymax - 0.5 * yspacing,
-                           resolution['y'])
-    zcenters = np.linspace(zmin + 0.5 * zspacing, zmax - 0.5 * zspacing,
-                           resolution['z'])
-
-    xg, yg, zg = np.meshgrid(xcenters, ycenters, zcenters, indexing='ij')
-    xgrid = xg.T
-    ygrid = yg.T
-    zgrid = zg.T
-    pixel_positions = xgrid.reshape(xgrid.shape + (1, )) * dir_vecs[1] + ygrid.reshape(
-        ygrid.shape + (1, )) * dir_vecs[2] + zgrid.reshape(zgrid.shape +
-                                                           (1, )) * dir_vecs[0]
-
-    # Evaluate the values of the data layers at the grid positions
-    binned = evaluate_on_grid(cell_positions_in_new_basis=np.array(
-        [apply_mask(datax.array),
-         apply_mask(datay.array),
-         apply_mask(dataz.array)]).T,
-                              cell_positions_in_original_basis=coords.array,
-                              cell_values=np.array(to_binning),
-                              cell_sizes=datadx.array,
-                              grid_lower_edge_in_new_basis=np.array([xmin, ymin, zmin]),
-                              grid_spacing_in_new_basis=np.array(
-                                  [xspacing, yspacing, zspacing]),
-                              grid_positions_in_original_basis=pixel_positions,
-                              ndim=dataset.meta["ndim"])
-
-    # Apply operation along depth
-    binned = getattr(binned, operation)(axis=1)
-
-    # Handle thick maps
-    if thick:
-        binned *= zspacing
-        for layer in to_render:
-            layer["unit"] = (Array(values=1, unit=layer["unit"]) *
-                             dataz.unit).unit.units
-
-    # Mask NaN values
-    mask = np.isnan(binned[-1, ...])
-    mask_vec = np.broadcast_to(mask.reshape(*mask.shape, 1), mask.shape + (3, ))
+    return {
+        "resolution":
+        resolution,
+        "xcenters":
+        np.linspace(xmin + 0.5 * xspacing, xmax - 0.5 * xspacing, resolution['x']),
+        "ycenters":
+        np.linspace(ymin + 0.5 * yspacing, ymax - 0.5 * yspacing, resolution['y']),
+        "zcenters":
+        np.linspace(zmin + 0.5 * zspacing, zmax - 0.5 * zspacing, resolution['z']),
+        "zspacing":
+        zspacing
+    }
+
+
+def _project(to_process,
+             to_render,
+             dataset,
+             directions,
+             dx,
+             dy,
+             dz,
+             origin,
+             resolution,
+             operation,
+             method,
+             weights,
+             candidates=None,
+             index=None):
+    """
+    Select the cells around the map planes and bin the layers onto the pixels of
+    the maps, one for each of the ``directions``. This is the expensive part of
+    ``map()``, whose result is cached. Particle layers with a ``deposit`` kernel
+    are deposited onto the pixels instead (see :func:`_deposit_layer`).
+    Returns a list with the projection of each map.
+
+    The cells can be restricted to a set of ``candidates`` (indices of cells), and
+    a :class:`CellIndex` built on these candidates (relative to the ``origin``) can
+    be supplied. In this case, the values of the layers are gathered once from the
+    candidates for all the maps, and the ``'sample'`` method bins all the maps in a
+    single pass over their pixels. Otherwise, the index is built on the cells
+    close to the plane of each map.
+    """
+    thick = dz is not None
+    dx, dy, dz = _window(dataset=dataset, dx=dx, dy=dy, dz=dz)
+
+    deposited = [layer.get("deposit") is not None for layer in to_render]
+    cell_layers = [ind for ind, dep in enumerate(deposited) if not dep]
+    particle_layers = [ind for ind, dep in enumerate(deposited) if dep]
+    to_process_cells = [to_process[ind] for ind in cell_layers]
+    to_render_cells = [to_render[ind] for ind in cell_layers]
+
+    views = []
+    for direction in directions:
+        dir_vecs, view_origin = get_slice_direction(direction=direction,
+                                                    dataset=dataset,
+                                                    dx=dx,
+                                                    dy=dy,
+                                                    origin=origin)
+        view = {"dir_vecs": dir_vecs, "origin": view_origin}
+        extent = None
+        if dx is not None:
+            extent = (-0.5 * dx.magnitude, 0.5 * dx.magnitude, -0.5 * dy.magnitude,
+                      0.5 * dy.magnitude, -0.5 * dz.magnitude, 0.5 * dz.magnitude)
+        if len(cell_layers) > 0 and (index is None or method == "deposit"
+                                     or extent is None):
+            cells = _plane_cells(dataset=dataset,
+                                 dir_vecs=dir_vecs,
+                                 origin=view_origin,
+                                 dx=dx,
+                                 dy=dy,
+                                 dz=dz,
+                                 thick=thick,
+                                 candidates=candidates)
+            view["cells"] = cells
+            if extent is None:
+                extent = ((cells["x"] - cells["dx"]).min().values,
+                          (cells["x"] + cells["dx"]).max().values,
+                          (cells["y"] - cells["dx"]).min().values,
+                          (cells["y"] + cells["dx"]).max().values,
+                          (cells["z"] - cells["dx"]).min().values,
+                          (cells["z"] + cells["dx"]).max().values)
+        if len(particle_layers) > 0:
+            view["particles"] = _particle_coordinates(
+                layers=[to_process[ind] for ind in particle_layers],
+                origin=view_origin,
+                dir_vecs=dir_vecs,
+                unit=dataset["amr"]["xyz"].unit)
+            if extent is None:
+                extent = _particle_extent(view["particles"])
+        view["extent"] = extent
+        view.update(_pixel_centers(extent=extent, resolution=resolution, thick=thick))
+        view["blocks"] = [None] * len(to_render)
+        view["scalar_layer"] = [None] * len(to_render)
+        views.append(view)
+
+    if len(cell_layers) > 0:
+        # The values of the layers are gathered from all the candidates when they
+        # are shared between several maps, and from the cells close to the plane
+        # otherwise
+        shared = None
+        if index is not None or (method == "deposit" and len(views) > 1):
+            if candidates is None:
+                candidates = np.arange(len(dataset["amr"]["dx"]))
+            shared = _gather(to_process=to_process_cells,
+                             to_render=to_render_cells,
+                             indices=candidates)
+            if method == "deposit":
+                # Positions of the selected cells among the candidates
+                lookup = np.full(len(dataset["amr"]["dx"]), -1, dtype=np.int64)
+                lookup[candidates] = np.arange(len(candidates))
+        if method == "deposit":
+            for view in views:
+                cells = view["cells"]
+                if shared is None:
+                    to_binning, layout, cell_scalar = _gather(
+                        to_process=to_process_cells,
+                        to_render=to_render_cells,
+                        indices=cells["indices"])
+                else:
+                    to_binning, layout, cell_scalar = shared
+                    to_binning = to_binning[:, lookup[cells["indices"]]]
+                cell_weights = np.ones(len(cells["indices"]))
+                if weights is not None:
+                    cell_weights = weights.norm.values[cells["indices"]]
+                xmin, xmax, ymin, ymax, zmin, zmax = view["extent"]
+                view["binned"] = deposit_on_grid(
+                    cell_values=project_values(cell_values=to_binning,
+                                               layout=layout,
+                                               dir_vecs=view["dir_vecs"]),
+                    cell_weights=cell_weights,
+                    cell_positions_in_new_basis=np.array([
+                        apply_mask(cells["x"].array),
+                        apply_mask(cells["y"].array),
+                        apply_mask(cells["z"].array)
+                    ]).T,
+                    cell_sizes=cells["dx"].array,
+                    dir_vecs=view["dir_vecs"],
+                    grid_lower_edge_in_new_basis=[xmin, ymin, zmin],
+                    grid_upper_edge_in_new_basis=[xmax, ymax, zmax],
+                    nx=view["resolution"]['x'],
+                    ny=view["resolution"]['y'],
+                    operation=operation)
+        else:
+            # Evaluate the values of the data layers at the grid positions, and
+            # apply operation along depth. The maps sharing an index are all
+            # evaluated in one call.
+            if shared is None:
+                groups = []
+                for view in views:
+                    cells = view["cells"]
+                    groups.append(([view],
+                                   _gather(to_process=to_process_cells,
+                                           to_render=to_render_cells,
+                                           indices=cells["indices"]),
+                                   CellIndex(positions=cells["coords"].array,
+                                             half_sizes=cells["dx"].array)))
+            else:
+                groups = [(views, shared, index)]
+            for group, (to_binning, layout, cell_scalar), cell_index in groups:
+                binned = evaluate_on_grid(cell_values=to_binning,
+                                          layout=layout,
+                                          dir_vecs=[view["dir_vecs"] for view in group],
+                                          xcenters=[view["xcenters"] for view in group],
+                                          ycenters=[view["ycenters"] for view in group],
+                                          zcenters=[view["zcenters"] for view in group],
+                                          operation=operation,
+                                          index=cell_index)
+                for view, view_binned in zip(group, binned):
+                    view["binned"] = view_binned
+                    # Handle thick maps
+                    if thick:
+                        view["binned"] *= view["zspacing"]
+
+        if (method == "deposit" and operation == "sum") or (method == "sample"
+                                                            and thick):
+            for layer in to_render_cells:
+                layer["unit"] = (Array(values=1, unit=layer["unit"]) *
+                                 dataset["amr"]["xyz"].unit).unit.units
+
+        # Split the binned data of the cell layers
+        for view in views:
+            counter = 0
+            for ind, scalar in zip(cell_layers, cell_scalar):
+                nrows = 1 if scalar else 3
+                view["blocks"][ind] = view["binned"][counter:counter + nrows]
+                view["scalar_layer"][ind] = scalar
+                counter += nrows
+
+    if operation == "sum":
+        for ind in particle_layers:
+            to_render[ind][
+                "unit"] = to_render[ind]["unit"] / dataset["amr"]["xyz"].unit.units**2
+
+    projections = []
+    for view in views:
+        for ind in particle_layers:
+            view["blocks"][ind], view["scalar_layer"][ind] = _deposit_layer(
+                data=to_process[ind],
+                layer=to_render[ind],
+                particles=view["particles"][id(to_process[ind].parent)],
+                dir_vecs=view["dir_vecs"],
+                extent=view["extent"],
+                resolution=view["resolution"],
+                operation=operation,
+                weights=weights,
+                unit=dataset["amr"]["xyz"].unit)
+        projections.append({
+            "binned": np.concatenate(view["blocks"]),
+            "scalar_layer": view["scalar_layer"],
+            "deposited": deposited,
+            "xcenters": view["xcenters"],
+            "ycenters": view["ycenters"],
+            "extent": view["extent"][:4],
+            "units": [layer["unit"] for layer in to_render],
+            "dir_vecs": view["dir_vecs"],
+            "origin": view["origin"],
+            "dx": dx,
+            "dy": dy
+        })
+    return projections
+
+
+def _make_plot(projection, to_render, to_scatter, dataset, filename, plot, ax):
+    """
+    Fill the layers to be sent to the renderer from the binned data, and render
+    the map.
+    """
+    binned = projection["binned"].copy()
+    scalar_layer = projection["scalar_layer"]
+    xcenters = projection["xcenters"]
+    ycenters = projection["ycenters"]
+    xmin, xmax, ymin, ymax = projection["extent"]
+    for layer, unit in zip(to_render, projection["units"]):
+        layer["unit"] = unit
+
+    # Mask NaN values: the pixels outside of the cells are found from the last
+    # cell layer, and the deposited layers are masked where they are NaN
+    deposited = projection["deposited"]
+    ends = np.cumsum([1 if scalar else 3 for scalar in scalar_layer])
+    cell_ends = [end for end, dep in zip(ends, deposited) if not dep]
+    cell_mask = np.zeros(binned.shape[1:], dtype=bool)
+    if len(cell_ends) > 0:
+        cell_mask = np.isnan(binned[cell_ends[-1] - 1, ...])
 
     # Now we fill the arrays to be sent to the renderer, also constructing vectors
     counter = 0
     for ind in range(len(to_render)):
+        mask = np.isnan(binned[ends[ind] - 1, ...]) if deposited[ind] else cell_mask
+        mask_vec = np.broadcast_to(mask.reshape(*mask.shape, 1), mask.shape + (3, ))
         if scalar_layer[ind]:
             to_render[ind]["data"] = ma.masked_where(mask,
                                                      binned[counter, ...],
@@ -355,10 +677,15 @@ def map(*layers,
         # Add scatter layer
         if len(to_scatter) > 0:
             _add_scatter(to_scatter=to_scatter,
-                         origin=origin,
-                         dir_vecs=dir_vecs,
-                         dx=dx,
-                         dy=dy,
+                         origin=projection["origin"],
+                         dir_vecs=projection["dir_vecs"],
+                         dx=projection["dx"],
+                         dy=projection["dy"],
+                         extent=projection["extent"],
+                         resolution={
+                             "x": len(xcenters),
+                             "y": len(ycenters)
+                         },
                          ax=figure["ax"])
 
         figure["ax"].set_xlim(xmin, xmax)
@@ -367,3 +694,275 @@ def map(*layers,
         to_return.update({"fig": figure["fig"], "ax": figure["ax"]})
 
     return Plot(**to_return)
+
+
+def map(*layers,
+        direction: Union[str, list] = "z",
+        dx: Quantity = None,
+        dy: Quantity = None,
+        dz: Quantity = None,
+        filename: str = None,
+        title: str = None,
+        plot: bool = True,
+        mode: str = None,
+        norm: str = None,
+        vmin: float = None,
+        vmax: float = None,
+        origin: Array = None,
+        resolution: Union[int, dict] = None,
+        operation: str = "sum",
+        method: str = "sample",
+        weights: Array = None,
+        ax: object = None,
+        **kwargs) -> Plot:
+    """
+    Create a 2D spatial map of a region inside a simulation domain.
+    By default, the map represents a plane with zero thickness.
+    A thick slab or cube can also be computed by specifying a thickness via the
+    ``dz`` argument. In this case, the resulting 3D box is integrated along the ``z``
+    direction before being sent to the image rendering.
+
+    :param layers: Dicts or Arrays representing the quantities to be mapped onto the
+        generated image. Layers selected from a subset of the rows of a group (e.g.
+        ``data['hydro'][data['hydro']['density'] > rho]['density']``) are mapped
+        using only the selected cells.
+
+    :param direction: The vector normal to the map. Possible choices are:
+
+       * ``'x'``, ``'y'``, or ``'z'`` representing the cartesian axes
+       * a list of 3 numbers representing the components of the vector,
+         e.g. ``[1, 0.5, 2]``
+       * ``'top'`` or ``'side'`` for automatic top or side view of a disk, according to
+         the angular momentum computed around the center of the plotted region
+
+    :param dx: The horizontal size of the plotted region. Default is ``None``,
+        in which case the entire horizontal range of the simulation domain is plotted.
+
+    :param dy: The vertical size of the plotted region. If not specified, it will
+        either be equal to ``dx`` if ``dx`` is not ``None``, or the entire vertical
+        range of the simulation domain if ``dx`` is ``None``. Default is ``None``.
+
+    :param dz: The depth range over which the ``z`` dimension is to be integrated.
+        Default is ``None``, in which case a plane with no thickness is plotted.
+
+    :param filename: If specified, the returned figure is also saved to file.
+        Default is ``None``.
+
+    :param title: The title of the figure. Default is ``None``.
+
+    :param plot: Make a plot if ``True``. If not, just return the ``Plot`` object
+        containing the data that would be used to generate the plot.
+        Default is ``True``.
+
+    :param mode: The rendering mode for the map. Possible choices are ``'image'``,
+        ``'contourf'``, and ``'contour'`` for scalar Arrays, ``'vec'`` and
+        ``'stream'`` for vector quantities. Default is ``None``, which selects the
+        ``render_mode`` set in the user configuration file (``'image'`` by default).
+        Layers of positions (e.g. particles) are drawn as markers with
+        ``'scatter'``, or aggregated onto the pixels of the map with ``'density'``
+        (see :func:`scatter`). Particle fields (e.g. ``data['part']['mass']``) can
+        be deposited onto the pixels of the map with a layer dict containing a
+        ``'deposit'`` kernel, e.g. ``{'data': data['part']['mass'],
+        'deposit': 'cic'}``, see :func:`deposit` for the possible kernels.
+        Only the particles within the depth of the map are deposited. With the
+        ``'sum'`` operation, the values are divided by the area of the pixels
+        (e.g. the surface density for the mass). With ``'mean'``, the values are
+        averaged with the weights of the kernel.
+
+    :param norm: The colormap normalization. Possible values are ``'linear'`` and
+        ``'log'``. Default is ``None`` (= ``'linear'``).
+
+    :param vmin: Minimum value for colorbar range. Default is ``None``.
+
+    :param vmax: Maximum value for colorbar range. Default is ``None``.
+
+    :param origin: An Array describing the position of the center of the map
+        (with 2 or 3 components depending on the dimensionality of the simulation).
+
+    :param resolution: Resolution of the generated map. This can either be an
+        integer or a dict. In the case of an integer, it represents the number of
+        pixels used for the horizontal and vertical dimensions. For a dictionary,
+        the following syntax should be used: ``resolution={'x': 128, 'y': 192}``.
+        Default is ``256``.
+
+    :param operation: The operation to apply along the ``z`` dimension if ``dz`` is
+        not ``None``. Possible values are ``'sum'``, ``'mean'``, ``'min'``, and
+        ``'max'``. Default is ``'sum'``.
+
+    :param method: The method used to compute thick maps. With ``'sample'``, the
+        cells are sampled at ``resolution['z']`` depths along the ``z`` direction
+        of each pixel. With ``'deposit'``, every cell adds its exact contribution
+        (path length times overlap) to the pixels it covers, so that the accuracy
+        does not depend on a ``z`` resolution. In this case, possible operations are
+        ``'sum'``, ``'mean'`` and ``'max'``, and only ``'sum'`` changes the unit
+        of the layers. Default is ``'sample'``.
+
+    :param weights: The weights used for the average along the ``z`` dimension
+        when ``method='deposit'`` and ``operation='mean'``, e.g. the density for a
+        mass-weighted average. Default is ``None``, in which case the average is
+        weighted by volume.
+
+    :param ax: A matplotlib axes inside which the figure will be plotted.
+        Default is ``None``, in which case some new axes a created.
+    """
+
+    if isinstance(layers, Array):
+        layers = [layers]
+
+    to_process, to_render, to_scatter = _parse_layers(layers,
+                                                      mode=mode,
+                                                      norm=norm,
+                                                      vmin=vmin,
+                                                      vmax=vmax,
+                                                      **kwargs)
+
+    dataset = to_process[0].parent.parent
+
+    _check_method(method=method, dataset=dataset, thick=dz is not None)
+    rows, weights = _select_rows(to_process=to_process,
+                                 to_render=to_render,
+                                 weights=weights,
+                                 ncells=len(dataset["amr"]["dx"]))
+
+    # Re-use the binned data if the same map was computed recently
+    key, objects = map_cache.make_key(
+        dataset=dataset,
+        layers=to_process,
+        vectors=[layer["mode"] in ["vec", "stream", "lic"] for layer in to_render],
+        colors=[layer["params"].get("color") for layer in to_render],
+        direction=direction,
+        dx=dx,
+        dy=dy,
+        dz=dz,
+        origin=origin,
+        resolution=resolution,
+        operation=operation,
+        method=method,
+        weights=weights,
+        deposits=[layer["deposit"] for layer in to_render],
+        rows=rows)
+    projection = map_cache.get(key, objects)
+    if projection is None:
+        projection = _project(to_process=to_process,
+                              to_render=to_render,
+                              dataset=dataset,
+                              directions=[direction],
+                              dx=dx,
+                              dy=dy,
+                              dz=dz,
+                              origin=origin,
+                              resolution=resolution,
+                              operation=operation,
+                              method=method,
+                              weights=weights,
+                              candidates=rows)[0]
+        map_cache.put(key, objects, projection)
+
+    return _make_plot(projection=projection,
+                      to_render=to_render,
+                      to_scatter=to_scatter,
+                      dataset=dataset,
+                      filename=filename,
+                      plot=plot,
+                      ax=ax)
+
+
+def map_many(*layers,
+             directions: list = ("x", "y", "z"),
+             dx: Quantity = None,
+             dy: Quantity = None,
+             dz: Quantity = None,
+             filename: list = None,
+             plot: bool = True,
+             mode: str = None,
+             norm: str = None,
+             vmin: float = None,
+             vmax: float = None,
+             origin: Array = None,
+             resolution: Union[int, dict] = None,
+             operation: str = "sum",
+             method: str = "sample",
+             weights: Array = None,
+             ax: list = None,
+             **kwargs) -> list:
+    """
+    Create several 2D spatial maps of the same region, one for each of the
+    ``directions``. The selection of the cells around the region, the spatial
+    index used to find the cells at the pixel positions, and the values of the
+    layers in these cells are computed once and shared between all the views.
+    With the ``'sample'`` method, the pixels of all the views are then evaluated
+    in a single call. With ``'deposit'``, the cells close to each plane are
+    deposited onto the pixels of each view.
+    The arguments are the same as for :func:`map`, except for:
+
+    :param directions: A list of the vectors normal to the maps, see the
+        ``direction`` argument of :func:`map`. Default is ``('x', 'y', 'z')``.
+
+    :param filename: A list of file names, one per direction, to save the figures
+        to. Default is ``None``.
+
+    :param ax: A list of matplotlib axes, one per direction, inside which the
+        figures will be plotted. Default is ``None``, in which case new axes are
+        created for each figure.
+
+    :return: A list containing one ``Plot`` per direction.
+    """
+    to_process, to_render, to_scatter = _parse_layers(layers,
+                                                      mode=mode,
+                                                      norm=norm,
+                                                      vmin=vmin,
+                                                      vmax=vmax,
+                                                      **kwargs)
+    dataset = to_process[0].parent.parent
+    _check_method(method=method, dataset=dataset, thick=dz is not None)
+    rows, weights = _select_rows(to_process=to_process,
+                                 to_render=to_render,
+                                 weights=weights,
+                                 ncells=len(dataset["amr"]["dx"]))
+    ndim = dataset.meta["ndim"]
+    if origin is None:
+        origin = Array(values=np.zeros([1, ndim]), unit=dataset["amr"]["xyz"].unit)
+
+    radius = None
+    if dx is not None:
+        window = _window(dataset=dataset, dx=dx, dy=dy, dz=dz)
+        radius = max(w.magnitude for w in window) * 0.6 * np.sqrt(ndim)
+    candidates, index = _select_region(dataset=dataset,
+                                       center=origin,
+                                       radius=radius,
+                                       method=method,
+                                       rows=rows)
+    projections = _project(to_process=to_process,
+                           to_render=to_render,
+                           dataset=dataset,
+                           directions=directions,
+                           dx=dx,
+                           dy=dy,
+                           dz=dz,
+                           origin=origin,
+                           resolution=resolution,
+                           operation=operation,
+                           method=method,
+                           weights=weights,
+                           candidates=candidates,
+                           index=index)
+
+    plots = []
+    for i, projection in enumerate(projections):
+        # The layers are parsed again for each figure, so that the views do not
+        # share their norms and scatter parameters
+        _, to_render, to_scatter = _parse_layers(layers,
+                                                 mode=mode,
+                                                 norm=norm,
+                                                 vmin=vmin,
+                                                 vmax=vmax,
+                                                 **kwargs)
+        plots.append(
+            _make_plot(projection=projection,
+                       to_render=to_render,
+                       to_scatter=to_scatter,
+                       dataset=dataset,
+                       filename=filename[i] if filename is not None else None,
+                       plot=plot,
+                       ax=ax[i] if ax is not None else None))
+    return plots
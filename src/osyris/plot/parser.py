@@ -22,7 +22,7 @@ def parse_layer(layer,
     if isinstance(layer, dict):
         params = {
             key: layer[key]
-            for key in set(layer.keys()) - set(["data", "mode", "operation"])
+            for key in set(layer.keys()) - set(["data", "mode", "operation", "deposit"])
         }
         if "norm" not in params:
             params["norm"] = norm
@@ -42,9 +42,10 @@ def parse_layer(layer,
         settings = {}
         for key in ["mode", "operation"]:
             settings[key] = layer[key] if key in layer else eval(key)
+        settings["deposit"] = layer.get("deposit")
         return layer["data"], settings, params
     else:
         params = {"norm": get_norm(norm=norm, vmin=vmin, vmax=vmax)}
-        settings = {"mode": mode, "operation": operation}
+        settings = {"mode": mode, "operation": operation, "deposit": None}
         params.update(kwargs)
         return layer, settings, params
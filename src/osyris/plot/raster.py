@@ -0,0 +1,258 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (c) 2022 Osyris contributors (https://github.com/nvaytet/osyris)
+
+import struct
+import zlib
+import numpy as np
+from matplotlib.cm import ScalarMappable
+from matplotlib.colors import LogNorm, to_rgba
+from .. import config
+from ..core import Plot
+
+# Number of entries in the colormap lookup tables
+_LUT_SIZE = 256
+
+
+def _lookup_table(cmap):
+    """
+    The colors of a colormap, as an array of ``_LUT_SIZE`` RGBA bytes.
+    """
+    if cmap is None:
+        cmap = config.parameters["cmap"]
+    colors = ScalarMappable(cmap=cmap).get_cmap()(np.linspace(0.0, 1.0, _LUT_SIZE))
+    return np.round(colors * 255).astype(np.uint8)
+
+
+def _normalize(data, norm):
+    """
+    Scale the data to the [0, 1] range, with the equivalent of a matplotlib
+    ``Normalize`` or ``LogNorm``. Returns the scaled values and the mask of the
+    pixels which have no color.
+    """
+    values = np.ma.getdata(data).astype(np.float64)
+    mask = np.ma.getmaskarray(data) | ~np.isfinite(values)
+    log = isinstance(norm, LogNorm)
+    if log:
+        mask |= values <= 0
+    valid = values[~mask]
+    vmin = getattr(norm, "vmin", None)
+    vmax = getattr(norm, "vmax", None)
+    if vmin is None:
+        vmin = valid.min() if len(valid) > 0 else 1.0
+    if vmax is None:
+        vmax = valid.max() if len(valid) > 0 else 1.0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if log:
+            values = np.log10(values)
+            vmin, vmax = np.log10(vmin), np.log10(vmax)
+        if vmax > vmin:
+            scaled = (values - vmin) / (vmax - vmin)
+        else:
+            scaled = np.zeros_like(values)
+    return np.clip(np.nan_to_num(scaled), 0.0, 1.0), mask
+
+
+def _colorize(scaled, lut):
+    return lut[np.minimum((scaled * _LUT_SIZE).astype(np.intp), _LUT_SIZE - 1)]
+
+
+def _levels(scaled, levels):
+    """
+    The index of the contour level of each pixel.
+    """
+    nlevels = levels if isinstance(levels, int) else len(levels)
+    return np.minimum((scaled * nlevels).astype(np.intp), nlevels - 1), nlevels
+
+
+def _scalar_layer(layer, scale):
+    """
+    Rasterize a scalar layer as an RGBA image.
+    """
+    params = layer["params"]
+    mode = layer.get("mode")
+    if mode is None:
+        mode = config.parameters["render_mode"]
+    data = layer["data"]
+    if scale > 1:
+        data = np.ma.repeat(np.ma.repeat(data, scale, axis=0), scale, axis=1)
+    scaled, mask = _normalize(data, params.get("norm"))
+    lut = _lookup_table(params.get("cmap"))
+    if mode in ["contour", "contourf"]:
+        index, nlevels = _levels(scaled, params.get("levels", 10))
+        if mode == "contourf":
+            rgba = _colorize((index + 0.5) / nlevels, lut)
+        else:
+            # Draw the pixels where the level changes
+            edges = np.zeros_like(mask)
+            edges[:-1, :] |= index[:-1, :] != index[1:, :]
+            edges[:, :-1] |= index[:, :-1] != index[:, 1:]
+            rgba = _colorize(index / max(nlevels - 1, 1), lut)
+            mask = mask | ~edges
+    elif mode in ["image", "imshow", "pcolormesh"]:
+        rgba = _colorize(scaled, lut)
+    else:
+        raise ValueError("Rendering mode '{}' is not supported by the raster "
+                         "output.".format(mode))
+    rgba[mask, 3] = 0
+    return rgba
+
+
+def _vector_layer(layer, shape, scale):
+    """
+    Rasterize a vector layer as simple arrows, drawn with the same density as the
+    ``quiver`` used by :func:`map`.
+    """
+    params = layer["params"]
+    data = layer["data"]
+    ny, nx = data.shape[:2]
+    rgba = np.zeros(shape + (4, ), dtype=np.uint8)
+    skips = np.maximum(
+        np.around(np.array([ny, nx]) * 4.0 / 128.0 /
+                  params.get("density", 1)).astype(int), 1)
+    iy, ix = np.meshgrid(np.arange(skips[0] // 2, ny, skips[0]),
+                         np.arange(skips[1] // 2, nx, skips[1]),
+                         indexing="ij")
+    iy, ix = iy.ravel(), ix.ravel()
+    mask = np.ma.getmaskarray(data)[iy, ix].any(axis=-1)
+    iy, ix = iy[~mask], ix[~mask]
+    vectors = np.ma.getdata(data)[iy, ix]
+    lengths = np.linalg.norm(vectors[:, :2], axis=1)
+    if len(lengths) == 0 or lengths.max() == 0:
+        return rgba
+
+    # The longest arrow spans 90% of the spacing between arrows
+    spacing = min(skips) * scale
+    uv = vectors[:, :2] * (0.9 * spacing / lengths.max())
+    centers = (np.array([ix, iy]).T + 0.5) * scale
+    tips = centers + 0.5 * uv
+    tails = centers - 0.5 * uv
+    # Two strokes for the head of the arrow, at +/- 30 degrees
+    cos, sin = np.cos(np.pi / 6), np.sin(np.pi / 6)
+    back = -0.3 * uv
+    heads = [
+        tips + np.array(
+            [cos * back[:, 0] - s * back[:, 1], s * back[:, 0] + cos * back[:, 1]]).T
+        for s in [sin, -sin]
+    ]
+    starts = np.concatenate([tails, tips, tips])
+    ends = np.concatenate([tips] + heads)
+
+    color = params.get("color", "w")
+    if isinstance(color, str):
+        colors = np.broadcast_to(
+            np.round(np.array(to_rgba(color)) * 255).astype(np.uint8), (len(starts), 4))
+    else:
+        scaled, _ = _normalize(vectors[:, 2], params.get("norm"))
+        colors = np.tile(_colorize(scaled, _lookup_table(params.get("cmap"))), (3, 1))
+
+    # Sample the segments finely enough to draw connected lines
+    nsamples = int(np.ceil(np.linalg.norm(ends - starts, axis=1).max())) + 1
+    t = np.linspace(0.0, 1.0, nsamples).reshape(1, -1, 1)
+    points = starts[:, None, :] + t * (ends - starts)[:, None, :]
+    px = np.floor(points[..., 0]).astype(np.intp).ravel()
+    py = np.floor(points[..., 1]).astype(np.intp).ravel()
+    colors = np.repeat(colors, nsamples, axis=0)
+    inside = (px >= 0) & (px < shape[1]) & (py >= 0) & (py < shape[0])
+    rgba[py[inside], px[inside]] = colors[inside]
+    return rgba
+
+
+def _blend(background, foreground):
+    """
+    Composite ``foreground`` over ``background`` (both RGBA bytes).
+    """
+    alpha = foreground[..., 3:4].astype(np.float64) / 255.0
+    base_alpha = background[..., 3:4].astype(np.float64) / 255.0
+    out_alpha = alpha + base_alpha * (1.0 - alpha)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rgb = (foreground[..., :3] * alpha + background[..., :3] * base_alpha *
+               (1.0 - alpha)) / out_alpha
+    out = np.empty_like(background)
+    out[..., :3] = np.round(np.nan_to_num(rgb))
+    out[..., 3:] = np.round(out_alpha * 255)
+    return out
+
+
+def rasterize(plot: Plot, scale: int = 1, background=None) -> np.ndarray:
+    """
+    Convert the layers of a ``Plot`` (returned by e.g. :func:`map` or
+    :func:`histogram2d`) to an RGBA image, without creating a matplotlib figure.
+    Scalar layers are colored with lookup tables of their colormaps, with linear or
+    logarithmic normalization. Vector layers are drawn as simple arrows. Masked
+    pixels are transparent.
+
+    :param plot: The ``Plot`` to be rasterized. Its layers must be 2D.
+
+    :param scale: The number of pixels of the image for each pixel of the data,
+        along each dimension. Default is ``1``.
+
+    :param background: The color of the background, e.g. ``'white'``. Default is
+        ``None``, in which case the background is transparent.
+
+    :return: An array of bytes with shape ``(ny * scale, nx * scale, 4)``, whose
+        first row is the top of the image.
+    """
+    shape = None
+    for layer in plot.layers:
+        if np.ndim(layer["data"]) < 2:
+            raise ValueError("Only 2D layers can be rasterized.")
+        shape = tuple(np.array(np.shape(layer["data"])[:2]) * scale)
+    if shape is None:
+        raise ValueError("The Plot has no layers to rasterize.")
+    image = np.zeros(shape + (4, ), dtype=np.uint8)
+    if background is not None:
+        image[...] = np.round(np.array(to_rgba(background)) * 255).astype(np.uint8)
+    for layer in plot.layers:
+        if np.ndim(layer["data"]) == 3:
+            rgba = _vector_layer(layer, shape=shape, scale=scale)
+        else:
+            rgba = _scalar_layer(layer, scale=scale)
+        image = _blend(image, rgba)
+    # The data has the origin at the bottom
+    return np.ascontiguousarray(image[::-1])
+
+
+def _png_chunk(tag, data):
+    return struct.pack(">I", len(data)) + tag + data + struct.pack(
+        ">I",
+        zlib.crc32(tag + data) & 0xffffffff)
+
+
+def write_png(filename: str, image: np.ndarray, compression: int = 6):
+    """
+    Write an RGBA image (an array of bytes with shape ``(height, width, 4)``) to a
+    PNG file.
+    """
+    height, width = image.shape[:2]
+    # Every row starts with the filter type (0 = none)
+    rows = np.zeros((height, width * 4 + 1), dtype=np.uint8)
+    rows[:, 1:] = image.reshape(height, width * 4)
+    header = struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)
+    with open(filename, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        f.write(_png_chunk(b"IHDR", header))
+        f.write(_png_chunk(b"IDAT", zlib.compress(rows.tobytes(), compression)))
+        f.write(_png_chunk(b"IEND", b""))
+
+
+def write_image(plot: Plot,
+                filename: str,
+                scale: int = 1,
+                background=None,
+                compression: int = 6):
+    """
+    Rasterize a ``Plot`` (see :func:`rasterize`) and write it to file, as a PNG
+    image if the ``filename`` ends with ``.png``, or as a NumPy array of RGBA bytes
+    if it ends with ``.npy``.
+
+    :param compression: The zlib compression level of PNG files, from ``0``
+        (fastest) to ``9`` (smallest). Default is ``6``.
+    """
+    image = rasterize(plot, scale=scale, background=background)
+    if filename.endswith(".png"):
+        write_png(filename, image, compression=compression)
+    elif filename.endswith(".npy"):
+        np.save(filename, image)
+    else:
+        raise ValueError("Unsupported file format for {}, use either .png or "
+                         ".npy.".format(filename))
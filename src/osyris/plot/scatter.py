@@ -1,11 +1,101 @@
 # SPDX-License-Identifier: BSD-3-Clause
 # Copyright (c) 2022 Osyris contributors (https://github.com/nvaytet/osyris)
 
+import numpy as np
 from pint.quantity import Quantity
+from typing import Union
 from ..core import Plot, Array
+from ..core.tools import to_bin_centers
 from .. import units
 from .render import render
 from .parser import parse_layer
+from .utils import finite_range, hist2d
+
+
+def _limits(values, lower, upper, log):
+    """
+    The limits of the pixel grid along one axis (in log space if ``log`` is
+    ``True``), using the finite range of the values if they are not given.
+    """
+    if lower is None or upper is None:
+        auto = finite_range(values, log=log)
+        lower = auto[0] if lower is None else lower
+        upper = auto[1] if upper is None else upper
+    elif log:
+        lower, upper = np.log10(lower), np.log10(upper)
+    if lower == upper:
+        lower, upper = lower - 0.5, upper + 0.5
+    return lower, upper
+
+
+def aggregate(xvals,
+              yvals,
+              params,
+              logx=False,
+              logy=False,
+              xmin=None,
+              xmax=None,
+              ymin=None,
+              ymax=None,
+              resolution=256,
+              operation=None):
+    """
+    Aggregate scatter points into a pixel grid, with the multi-threaded
+    histogramming kernel. The reduction is the ``count`` of points in each pixel,
+    or the ``sum`` or ``mean`` of the colors ``params['c']``. Returns the
+    centers of the pixels, and the layer to be rendered as an image (where empty
+    pixels are masked).
+    """
+    if isinstance(resolution, int):
+        resolution = {"x": resolution, "y": resolution}
+    color = params.pop("c", None)
+    if isinstance(color, str):
+        color = None
+    for key in ["s", "edgecolors", "marker"]:
+        params.pop(key, None)
+    if operation is None:
+        operation = "count" if color is None else "mean"
+    if operation not in ["count", "sum", "mean"]:
+        raise ValueError("Unknown operation '{}' for density scatter plots, possible "
+                         "choices are ['count', 'sum', 'mean'].".format(operation))
+    if operation != "count" and color is None:
+        raise ValueError(
+            "The '{}' operation requires a color array 'c'.".format(operation))
+    layer = {"mode": "image", "params": params, "unit": None, "name": "counts"}
+    if operation == "count":
+        values = np.zeros((0, len(xvals)))
+    else:
+        if isinstance(color, Array):
+            layer.update({"unit": color.unit.units, "name": color.name})
+            color = color.norm.values
+        values = np.asarray(color, dtype=np.float64).reshape(1, -1)
+
+    xmin, xmax = _limits(xvals, xmin, xmax, logx)
+    ymin, ymax = _limits(yvals, ymin, ymax, logy)
+    binned = hist2d(x=xvals,
+                    y=yvals,
+                    values=values,
+                    xmin=xmin,
+                    xmax=xmax,
+                    nx=resolution["x"],
+                    ymin=ymin,
+                    ymax=ymax,
+                    ny=resolution["y"],
+                    logx=logx,
+                    logy=logy,
+                    statistics=[operation])
+    if operation == "count":
+        data = binned["count"].astype(np.float64)
+    else:
+        data = binned[operation][0]
+    layer["data"] = np.ma.masked_where(binned["count"] == 0, data)
+
+    centers = []
+    for lower, upper, n, log in [(xmin, xmax, resolution["x"], logx),
+                                 (ymin, ymax, resolution["y"], logy)]:
+        edges = np.linspace(lower, upper, n + 1)
+        centers.append(to_bin_centers(10.0**edges if log else edges))
+    return centers[0], centers[1], layer
 
 
 def scatter(x: Array,
@@ -22,6 +112,9 @@ def scatter(x: Array,
             ymax: float = None,
             vmin: float = None,
             vmax: float = None,
+            mode: str = None,
+            resolution: Union[int, dict] = 256,
+            operation: str = None,
             ax: object = None,
             **kwargs) -> Plot:
     """
@@ -64,6 +157,19 @@ def scatter(x: Array,
 
     :param vmax: Maximum value for colorbar range. Default is ``None``.
 
+    :param mode: If ``'density'``, the points are aggregated into a grid of
+        pixels by a multi-threaded kernel, and rendered as an image instead of
+        individual markers. This is much faster for large numbers of points.
+        Default is ``None``.
+
+    :param resolution: The number of pixels of the grid in ``'density'`` mode,
+        as an integer or a dict ``{'x': 128, 'y': 192}``. Default is ``256``.
+
+    :param operation: The reduction inside the pixels in ``'density'`` mode:
+        ``'count'``, or the ``'sum'`` or ``'mean'`` of the colors ``c``.
+        Default is ``None``, which selects ``'mean'`` if ``c`` is an array, and
+        ``'count'`` otherwise.
+
     :param ax: A matplotlib axes inside which the figure will be plotted.
         Default is ``None``, in which case some new axes a created.
     """
@@ -74,6 +180,35 @@ def scatter(x: Array,
     yvals = y.norm.values
 
     _, _, params = parse_layer(layer=None, norm=norm, vmin=vmin, vmax=vmax, **kwargs)
+    if mode == "density":
+        xcenters, ycenters, layer = aggregate(xvals=xvals,
+                                              yvals=yvals,
+                                              params=params,
+                                              logx=logx,
+                                              logy=logy,
+                                              xmin=xmin,
+                                              xmax=xmax,
+                                              ymin=ymin,
+                                              ymax=ymax,
+                                              resolution=resolution,
+                                              operation=operation)
+        figure = render(x=xcenters,
+                        y=ycenters,
+                        data=[layer],
+                        logx=logx,
+                        logy=logy,
+                        ax=ax)
+        figure["ax"].set_xlabel(x.label)
+        figure["ax"].set_ylabel(y.label)
+        return Plot(x=xcenters,
+                    y=ycenters,
+                    layers=[layer],
+                    fig=figure["fig"],
+                    ax=figure["ax"],
+                    filename=filename)
+    elif mode is not None:
+        raise ValueError("Unknown mode '{}' for scatter plots, use either None or "
+                         "'density'.".format(mode))
     to_render = [{
         "data": None,
         "mode": "scatter",
@@ -0,0 +1,345 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (c) 2022 Osyris contributors (https://github.com/nvaytet/osyris)
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+import os
+import shutil
+import tempfile
+import numpy as np
+from matplotlib.colors import LogNorm
+from pint.quantity import Quantity
+from typing import Union
+from ..core import Array, Dataset
+from ..io.utils import get_spatial_scaling
+from .animate import _FrameWriter, _frame, _render_spec
+from .map import _check_method, _make_plot, _parse_layers, _project
+
+
+def _resolve(layer, dataset):
+    """
+    Find the Array a layer refers to in a given Dataset. A layer can be a string
+    ``'group/key'``, a function taking the Dataset as argument, or a dict whose
+    ``'data'`` is one of these.
+    """
+    if isinstance(layer, dict):
+        return {**layer, "data": _resolve(layer["data"], dataset)}
+    if callable(layer):
+        return layer(dataset)
+    if isinstance(layer, str):
+        group, key = layer.split("/")
+        return dataset[group][key]
+    raise TypeError("A time series layer must be a string 'group/key', or a "
+                    "function which returns an Array from a Dataset.")
+
+
+def _magnitude(value, unit):
+    """
+    The magnitude of a length in the given unit. Plain numbers are assumed to
+    already be in that unit.
+    """
+    if isinstance(value, Quantity):
+        return value.to(unit.units).magnitude / unit.magnitude
+    return float(value)
+
+
+def _region_select(meta, origin, widths):
+    """
+    Functions for the ``select`` of the ``amr`` group which only keep the cells
+    inside a cube around the ``origin``, large enough to contain the cells used by
+    a map whose sizes are ``widths``.
+    """
+    ndim = meta["ndim"]
+    scaling = get_spatial_scaling(meta["unit_d"], meta["unit_l"], meta["unit_t"],
+                                  meta["scale"])
+    coarse = meta["boxlen"] * scaling / 2**meta["levelmin"]
+
+    def make(axis):
+        def inside(x):
+            center = 0.0
+            if origin is not None:
+                center = _magnitude(origin.values[0, axis] * origin.unit, x.unit)
+            window = max(_magnitude(width, x.unit) for width in widths)
+            half_width = np.sqrt(ndim) * (0.6 * window +
+                                          0.5 * _magnitude(coarse, x.unit))
+            return np.abs(x.values - center) <= half_width
+
+        return inside
+
+    return {c: make(i) for i, c in enumerate("xyz"[:ndim])}
+
+
+def _load(nout, path, scale, select, origin, widths):
+    dataset = Dataset(nout, scale=scale, path=path)
+    select = deepcopy(select) if select is not None else {}
+    if widths is not None:
+        amr = select.setdefault("amr", {})
+        if isinstance(amr, dict):
+            for key, func in _region_select(meta=dataset.meta,
+                                            origin=origin,
+                                            widths=widths).items():
+                if key not in amr and "xyz_" + key not in amr:
+                    amr[key] = func
+    return dataset.load(select=select)
+
+
+def _map(dataset, layers, filename, origin, weights, parse_args, project_args):
+    """
+    Map one output, returning the data of the frame, the rendered layers and the
+    axis labels.
+    """
+    to_process, to_render, to_scatter = _parse_layers(
+        [_resolve(layer, dataset) for layer in layers], **parse_args)
+    if len(to_scatter) > 0:
+        raise ValueError("Scatter layers are not supported by timeseries().")
+    _check_method(method=project_args["method"],
+                  dataset=dataset,
+                  thick=project_args["dz"] is not None)
+    projection = _project(
+        to_process=to_process,
+        to_render=to_render,
+        dataset=dataset,
+        origin=origin(dataset) if callable(origin) else origin,
+        weights=_resolve(weights, dataset) if weights is not None else None,
+        **project_args)[0]
+    maps = _make_plot(projection=projection,
+                      to_render=to_render,
+                      to_scatter=[],
+                      dataset=dataset,
+                      filename=None,
+                      plot=False,
+                      ax=None)
+    labels = (dataset["amr"]["xyz"].x.label, dataset["amr"]["xyz"].y.label)
+    return _frame(maps=maps, projection=projection, filename=filename), maps, labels
+
+
+def _spill(frame, files):
+    """
+    Save the layers of a frame to temporary files.
+    """
+    for data, name in zip(frame["layers"], files):
+        np.save(name, np.ma.filled(data.astype(np.float64), np.nan))
+
+
+def _update_range(ranges, specs, frame):
+    """
+    Update the running ranges of the scalar layers with the values of a frame.
+    For logarithmic norms, only positive values are considered.
+    """
+    for i, (spec, data) in enumerate(zip(specs, frame["layers"])):
+        if spec["mode"] == "vec":
+            continue
+        values = np.ma.masked_invalid(data).compressed()
+        if isinstance(spec["params"].get("norm"), LogNorm):
+            values = values[values > 0]
+        if len(values) == 0:
+            continue
+        lower, upper = ranges[i]
+        ranges[i] = (min(lower, values.min()), max(upper, values.max()))
+
+
+def timeseries(outputs,
+               *layers,
+               path: str = "",
+               scale: str = None,
+               select: dict = None,
+               filename: str = "frame_{:05d}.png",
+               direction: Union[str, list] = "z",
+               dx: Quantity = None,
+               dy: Quantity = None,
+               dz: Quantity = None,
+               origin: Array = None,
+               resolution: Union[int, dict] = None,
+               mode: str = None,
+               norm: str = None,
+               vmin: float = None,
+               vmax: float = None,
+               operation: str = "sum",
+               method: str = "sample",
+               weights=None,
+               lookahead: int = 2,
+               load_workers: int = 1,
+               workers: int = 1,
+               figsize: tuple = None,
+               dpi: float = 100,
+               **kwargs) -> list:
+    """
+    Render a map of each of the ``outputs`` of a simulation, and write them to an
+    image sequence. The work is pipelined: while output ``n`` is being mapped (with
+    the multi-threaded kernels of :func:`map`), the next ``lookahead`` outputs are
+    loaded by a pool of ``load_workers`` threads, and the previous frames are
+    written by a pool of ``workers`` processes (see :func:`animate`). Only the
+    Datasets being loaded or mapped are held in memory.
+
+    The same ``select`` is used for every output. When ``dx`` is given and the
+    ``origin`` is not a function, the ``amr`` selection is also restricted to the
+    region covered by the map, so that only the required cells (and files, for
+    Hilbert-ordered outputs) are read.
+
+    If ``vmin`` or ``vmax`` are not given, the color ranges of the scalar layers
+    are the global ranges over all the outputs. They are accumulated while the
+    outputs are mapped, and the binned maps are saved to temporary files on disk
+    by a background thread, instead of being kept in memory. As the color ranges
+    are only known once all the outputs have been mapped, the frames are then
+    encoded by the ``workers`` at the end. Give ``vmin`` and ``vmax`` to encode
+    the frames while the next outputs are loaded and mapped.
+
+    :param outputs: The numbers of the outputs to render.
+
+    :param layers: The quantities to be mapped, either as strings
+        ``'group/key'`` (e.g. ``'hydro/density'``), or as functions which return
+        an Array from a Dataset. Dicts with one of these as ``'data'`` can be used
+        to set rendering parameters, as for :func:`map`.
+
+    :param path: The path to the outputs. Default is ``''``.
+
+    :param scale: The spatial scale used when loading the outputs, see
+        :class:`Dataset`. Default is ``None``.
+
+    :param select: The selection used when loading each output, see
+        :meth:`Dataset.load`. Default is ``None``.
+
+    :param filename: The file names of the frames, formatted with the frame number.
+        Default is ``'frame_{:05d}.png'``.
+
+    :param origin: The center of the maps, as an Array, or a function which
+        returns the center from a Dataset (e.g. to follow a sink particle).
+        Default is ``None``.
+
+    :param weights: The weights for deposited averages, in the same form as the
+        ``layers``. Default is ``None``.
+
+    :param lookahead: The number of outputs loaded in advance. Default is ``2``.
+
+    :param load_workers: The number of threads loading outputs. Default is ``1``.
+
+    :param workers: The number of processes writing frames. Default is ``1``,
+        in which case the frames are written by the calling process.
+
+    The other arguments are the same as for :func:`map` and :func:`animate`.
+
+    :return: The list of the file names of the frames.
+    """
+    outputs = list(outputs)
+    widths = None
+    if dx is not None and not callable(origin):
+        # Plain numbers are in the unit of the positions, which is only known
+        # once an output is loaded
+        widths = [width for width in [dx, dy, dz] if width is not None]
+    map_args = {
+        "layers": layers,
+        "origin": origin,
+        "weights": weights,
+        "parse_args": {
+            "mode": mode,
+            "norm": norm,
+            "vmin": vmin,
+            "vmax": vmax,
+            **kwargs
+        },
+        "project_args": {
+            "directions": [direction],
+            "dx": dx,
+            "dy": dy,
+            "dz": dz,
+            "resolution": resolution,
+            "operation": operation,
+            "method": method
+        }
+    }
+
+    loaders = ThreadPoolExecutor(max_workers=max(load_workers, 1))
+    loading = deque()
+    savers = ThreadPoolExecutor(max_workers=1)
+    saving = deque()
+    writer = None
+    spill = None
+    frames = []
+    ranges = None
+    specs = None
+    labels = None
+
+    def handle(result):
+        nonlocal writer, spill, ranges, specs, labels
+        frame, maps, frame_labels = result
+        if specs is None:
+            labels = frame_labels
+            fixed = all(layer["mode"] in ["vec", "vector"] or (
+                layer["params"]["norm"].vmin is not None
+                and layer["params"]["norm"].vmax is not None) for layer in maps.layers)
+            if fixed:
+                specs = [_render_spec(layer) for layer in maps.layers]
+                writer = _FrameWriter(renderer_args=(specs, *labels, figsize, dpi),
+                                      workers=workers)
+            else:
+                # The color ranges are set once all the outputs have been mapped
+                specs = [
+                    _render_spec({
+                        **layer, "data": np.ma.masked_all((0, ))
+                    }) for layer in maps.layers
+                ]
+                ranges = [(np.inf, -np.inf)] * len(specs)
+                spill = tempfile.mkdtemp(prefix="osyris-")
+        if writer is not None:
+            writer.write(frame)
+            frames.append(frame["filename"])
+            return
+        _update_range(ranges, specs, frame)
+        files = [
+            os.path.join(spill, "{}_{}.npy".format(len(frames), i))
+            for i in range(len(frame["layers"]))
+        ]
+        # The frames are saved while the next outputs are mapped
+        if len(saving) > lookahead:
+            saving.popleft().result()
+        saving.append(savers.submit(_spill, frame, files))
+        frames.append({**frame, "layers": files})
+
+    try:
+        for i in range(len(outputs)):
+            while len(loading) < min(lookahead + 1, len(outputs) - i):
+                nout = outputs[i + len(loading)]
+                loading.append(
+                    loaders.submit(_load,
+                                   nout=nout,
+                                   path=path,
+                                   scale=scale,
+                                   select=select,
+                                   origin=origin,
+                                   widths=widths))
+            # The mapping is done by the calling thread, as the parallel kernels
+            # cannot be safely launched from several threads
+            handle(
+                _map(dataset=loading.popleft().result(),
+                     filename=filename.format(i),
+                     **map_args))
+
+        if spill is not None:
+            while saving:
+                saving.popleft().result()
+            # Write the frames with the global color ranges
+            for spec, (lower, upper) in zip(specs, ranges):
+                if spec["mode"] != "vec" and np.isfinite(lower):
+                    spec["params"]["norm"].vmin = lower
+                    spec["params"]["norm"].vmax = upper
+            writer = _FrameWriter(renderer_args=(specs, *labels, figsize, dpi),
+                                  workers=workers)
+            for i, frame in enumerate(frames):
+                writer.write({
+                    **frame, "layers":
+                    [np.ma.masked_invalid(np.load(name)) for name in frame["layers"]]
+                })
+                frames[i] = frame["filename"]
+        if writer is not None:
+            writer.finish()
+    finally:
+        for future in loading:
+            future.cancel()
+        loaders.shutdown()
+        savers.shutdown()
+        if writer is not None:
+            writer.shutdown()
+        if spill is not None:
+            shutil.rmtree(spill, ignore_errors=True)
+    return frames
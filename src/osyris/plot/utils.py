@@ -1,71 +1,895 @@
 # SPDX-License-Identifier: BSD-3-Clause
 # Copyright (c) 2022 Osyris contributors (https://github.com/nvaytet/osyris)
 
+from functools import lru_cache
 import numpy as np
-from numba import njit, prange
+from numba import get_num_threads, njit, prange
+from ..core.spatial import find_cell
+
+# Reductions which can be applied along the depth of a map
+_OPERATIONS = {"sum": 0, "mean": 1, "min": 2, "max": 3}
+
+
+def project_values(cell_values, layout, dir_vecs):
+    """
+    Project the values of the cells gathered for the layers of a map onto the
+    plane of the map, whose direction vectors are ``dir_vecs``. Each row of
+    ``layout`` describes a row of the output as ``(kind, start, ncomponents,
+    color)``: ``kind`` is 0 for a scalar, stored in the row ``start`` of
+    ``cell_values``, 1 or 2 for the component along the horizontal or vertical
+    axis of the map of a vector, whose ``ncomponents`` components are stored from
+    the row ``start``, and 3 for the color of a vector, stored in the row
+    ``color``, or the norm of the projected vector if ``color`` is -1. Vectors with
+    fewer than 3 components (from 2D simulations) already lie in the plane of the
+    map. The output has shape ``(len(layout), ncells)``.
+    """
+    return _project_values(np.ascontiguousarray(cell_values, dtype=np.float64),
+                           np.asarray(layout, dtype=np.int64),
+                           np.asarray(dir_vecs, dtype=np.float64))
 
 
 @njit(parallel=True)
-def evaluate_on_grid(cell_positions_in_new_basis, cell_positions_in_original_basis,
-                     cell_values, cell_sizes, grid_lower_edge_in_new_basis,
-                     grid_spacing_in_new_basis, grid_positions_in_original_basis, ndim):
-
-    nz, ny, nx = grid_positions_in_original_basis.shape[:3]
-    diagonal = np.sqrt(ndim)
-    out = np.full(shape=(cell_values.shape[0], nz, ny, nx),
-                  fill_value=np.nan,
-                  dtype=np.float64)
-
-    ncells = cell_positions_in_new_basis.shape[0]
-    for n in prange(ncells):
-
-        half_size = cell_sizes[n] * diagonal
-        ix1 = max(
-            int(((cell_positions_in_new_basis[n, 0] - half_size) -
-                 grid_lower_edge_in_new_basis[0]) / grid_spacing_in_new_basis[0]), 0)
-        ix2 = min(
-            int(((cell_positions_in_new_basis[n, 0] + half_size) -
-                 grid_lower_edge_in_new_basis[0]) / grid_spacing_in_new_basis[0]) + 1,
-            nx)
-        iy1 = max(
-            int(((cell_positions_in_new_basis[n, 1] - half_size) -
-                 grid_lower_edge_in_new_basis[1]) / grid_spacing_in_new_basis[1]), 0)
-        iy2 = min(
-            int(((cell_positions_in_new_basis[n, 1] + half_size) -
-                 grid_lower_edge_in_new_basis[1]) / grid_spacing_in_new_basis[1]) + 1,
-            ny)
-        iz1 = max(
-            int(((cell_positions_in_new_basis[n, 2] - half_size) -
-                 grid_lower_edge_in_new_basis[2]) / grid_spacing_in_new_basis[2]), 0)
-        iz2 = min(
-            int(((cell_positions_in_new_basis[n, 2] + half_size) -
-                 grid_lower_edge_in_new_basis[2]) / grid_spacing_in_new_basis[2]) + 1,
-            nz)
-
-        for k in range(iz1, iz2):
-            for j in range(iy1, iy2):
-                for i in range(ix1, ix2):
-                    dist = np.abs(grid_positions_in_original_basis[k, j, i, :] -
-                                  cell_positions_in_original_basis[n, :])
-                    if np.all(dist <= cell_sizes[n]):
-                        out[:, k, j, i] = cell_values[:, n]
+def _project_values(cell_values, layout, dir_vecs):
+    out = np.empty((layout.shape[0], cell_values.shape[1]))
+    for n in prange(cell_values.shape[1]):
+        for v in range(layout.shape[0]):
+            out[v, n] = _project_value(cell_values, layout, dir_vecs, v, n)
+    return out
+
+
+@njit
+def _component(cell_values, start, ncomponents, dir_vecs, axis, n):
+    if ncomponents < 3:
+        return cell_values[start + axis - 1, n]
+    value = 0.0
+    for d in range(ncomponents):
+        value += cell_values[start + d, n] * dir_vecs[axis, d]
+    return value
+
+
+@njit
+def _project_value(cell_values, layout, dir_vecs, v, n):
+    kind = layout[v, 0]
+    start = layout[v, 1]
+    if kind == 0:
+        return cell_values[start, n]
+    if kind < 3:
+        return _component(cell_values, start, layout[v, 2], dir_vecs, kind, n)
+    if layout[v, 3] >= 0:
+        return cell_values[layout[v, 3], n]
+    u = _component(cell_values, start, layout[v, 2], dir_vecs, 1, n)
+    w = _component(cell_values, start, layout[v, 2], dir_vecs, 2, n)
+    return np.sqrt(u * u + w * w)
+
+
+def evaluate_on_grid(cell_values, layout, dir_vecs, xcenters, ycenters, zcenters,
+                     operation, index):
+    """
+    Evaluate the values of the cells at the pixel centers of one or more maps, and
+    reduce them along the depth of the maps using ``operation`` (``'sum'``,
+    ``'mean'``, ``'min'`` or ``'max'``). Each pixel takes the values of the finest
+    cell which contains it (found using the :class:`CellIndex` ``index``), or NaN if
+    it is not inside any cell. The positions of the pixels are computed from the
+    pixel centers along the map axes and the direction vectors ``dir_vecs``.
+
+    ``dir_vecs``, ``xcenters``, ``ycenters`` and ``zcenters`` hold one entry per
+    map, and all the maps have the same number of pixels. The values of the cells
+    are projected onto the plane of each map as described by ``layout`` (see
+    :func:`project_values`), so that all the maps are computed from the same
+    ``cell_values`` in a single pass over their pixels.
+    The output has shape ``(nmaps, len(layout), ny, nx)``.
+    """
+    if operation not in _OPERATIONS:
+        raise ValueError("Unknown operation '{}', possible choices are {}.".format(
+            operation, list(_OPERATIONS.keys())))
+    # The maps may have different numbers of depths
+    nz = np.array([len(depths) for depths in zcenters], dtype=np.int64)
+    depths = np.zeros((len(zcenters), nz.max()))
+    for m, centers in enumerate(zcenters):
+        depths[m, :nz[m]] = centers
+    return _evaluate_on_grid(np.ascontiguousarray(cell_values, dtype=np.float64),
+                             np.asarray(layout, dtype=np.int64),
+                             np.asarray(dir_vecs, dtype=np.float64),
+                             np.asarray(xcenters, dtype=np.float64),
+                             np.asarray(ycenters, dtype=np.float64), depths, nz,
+                             _OPERATIONS[operation], *index.arrays)
+
+
+@njit(parallel=True)
+def _evaluate_on_grid(cell_values, layout, dir_vecs, xcenters, ycenters, zcenters, nz,
+                      operation, keys, cells, offsets, sizes, origins, extents):
+
+    nmaps = dir_vecs.shape[0]
+    nvalues = layout.shape[0]
+    ndim = dir_vecs.shape[2]
+    nx = xcenters.shape[1]
+    ny = ycenters.shape[1]
+    out = np.full(shape=(nmaps, nvalues, ny, nx), fill_value=np.nan, dtype=np.float64)
+
+    # Loop over the pixels of all the maps: every pixel is written by a single
+    # thread, and the values along the depth are reduced on the fly
+    for p in prange(nmaps * ny * nx):
+        m = p // (ny * nx)
+        j = (p // nx) % ny
+        i = p % nx
+        point = np.empty(ndim)
+        missing = False
+        for k in range(nz[m]):
+            for d in range(ndim):
+                point[d] = (xcenters[m, i] * dir_vecs[m, 1, d] + ycenters[m, j] *
+                            dir_vecs[m, 2, d]) + zcenters[m, k] * dir_vecs[m, 0, d]
+            n = find_cell(point, keys, cells, offsets, sizes, origins, extents)
+            if n < 0:
+                # Same as a reduction including NaNs
+                missing = True
+                break
+            for v in range(nvalues):
+                value = _project_value(cell_values, layout, dir_vecs[m], v, n)
+                if k == 0:
+                    out[m, v, j, i] = value
+                elif operation <= 1:
+                    out[m, v, j, i] += value
+                elif operation == 2:
+                    if value < out[m, v, j, i] or value != value:
+                        out[m, v, j, i] = value
+                elif value > out[m, v, j, i] or value != value:
+                    out[m, v, j, i] = value
+        if missing:
+            out[m, :, j, i] = np.nan
+        elif operation == 1:
+            out[m, :, j, i] /= nz[m]
 
     return out
 
 
+def deposit_on_grid(cell_values, cell_weights, cell_positions_in_new_basis, cell_sizes,
+                    dir_vecs, grid_lower_edge_in_new_basis,
+                    grid_upper_edge_in_new_basis, nx, ny, operation):
+    """
+    Project cells onto a map by depositing the exact contribution of each cell to
+    the pixels it covers, between the lower and upper depth of the map: the
+    overlap volume of the cell with the pixel column, divided by the pixel area.
+
+    If the map axes are aligned with the simulation axes, the overlap is the
+    product of the overlaps along each axis. Otherwise, the cell is a rotated cube
+    in the basis of the map, which is clipped by the depth range, the rows and
+    the columns of pixels, and the overlap is the volume of the clipped
+    polyhedron.
+
+    Possible operations are ``'sum'`` (the integral of the values along the
+    depth), ``'mean'`` (the average along the depth, weighted by ``cell_weights``)
+    and ``'max'``. Pixels not covered by any cell are NaN. The output has shape
+    ``(nvalues, ny, nx)``.
+
+    The map is split into slabs of rows, which are filled in parallel, each by a
+    single thread, so that no private copies of the map are needed.
+    """
+    if operation not in ["sum", "mean", "max"]:
+        raise ValueError("Unknown operation '{}' for depositing cells, possible "
+                         "choices are ['sum', 'mean', 'max'].".format(operation))
+    dir_vecs = np.asarray(dir_vecs, dtype=np.float64)
+    aligned = bool(np.all(np.sum(dir_vecs != 0, axis=1) == 1))
+    positions = np.asarray(cell_positions_in_new_basis, dtype=np.float64)
+    half_sizes = np.asarray(cell_sizes, dtype=np.float64)
+    lower = np.asarray(grid_lower_edge_in_new_basis, dtype=np.float64)
+    upper = np.asarray(grid_upper_edge_in_new_basis, dtype=np.float64)
+
+    # The rows of pixels covered by the footprints of the cells
+    extent = np.ones(2)
+    if not aligned:
+        extent = np.abs(dir_vecs[1:]).sum(axis=1)
+    yspacing = (upper[1] - lower[1]) / ny
+    first = np.floor((positions[:, 1] - half_sizes * extent[1] - lower[1]) /
+                     yspacing).astype(np.int64)
+    last = np.floor((positions[:, 1] + half_sizes * extent[1] - lower[1]) /
+                    yspacing).astype(np.int64)
+    nslabs = int(min(ny, 4 * get_num_threads()))
+    edges = (np.arange(nslabs + 1) * ny) // nslabs
+    outside = (last < 0) | (first >= ny) | ~np.isfinite(positions[:, 1])
+    buckets = np.empty((len(first), 2), dtype=np.int64)
+    buckets[:, 0] = np.searchsorted(edges, np.clip(first, 0, ny - 1), side="right") - 1
+    buckets[outside, 0] = -1
+    buckets[:, 1] = last
+    order, offsets, reach = sort_buckets(buckets, nslabs)
+
+    nvalues = cell_values.shape[0]
+    out = np.zeros((nvalues + 2, ny, nx))
+    if operation == "max":
+        out[:nvalues] = -np.inf
+    _deposit_on_grid(np.ascontiguousarray(cell_values, dtype=np.float64),
+                     np.asarray(cell_weights, dtype=np.float64), positions, half_sizes,
+                     dir_vecs, lower, upper, nx, ny, _OPERATIONS[operation], aligned,
+                     edges, order, offsets, reach, out)
+    coverage = out[nvalues + 1]
+    values = out[:nvalues]
+    if operation == "mean":
+        with np.errstate(invalid="ignore", divide="ignore"):
+            values /= out[nvalues]
+    values[:, coverage <= 0] = np.nan
+    return values
+
+
+@njit
+def sort_buckets(buckets, nslabs):
+    """
+    Sort items (e.g. particles or cells) by bucket with a counting sort. The
+    ``buckets`` contain the bucket of each item (-1 to skip it), and the last
+    index along the first axis of the grid reached by the item. Returns the
+    sorted items, the offsets of the buckets and the last index reached by the
+    items of each bucket.
+    """
+    offsets = np.zeros(nslabs + 1, dtype=np.int64)
+    reach = np.full(nslabs, -1, dtype=np.int64)
+    for p in range(len(buckets)):
+        b = buckets[p, 0]
+        if b >= 0:
+            offsets[b + 1] += 1
+            reach[b] = max(reach[b], buckets[p, 1])
+    for b in range(nslabs):
+        offsets[b + 1] += offsets[b]
+    order = np.empty(offsets[-1], dtype=np.int64)
+    fill = offsets[:-1].copy()
+    for p in range(len(buckets)):
+        b = buckets[p, 0]
+        if b >= 0:
+            order[fill[b]] = p
+            fill[b] += 1
+    return order, offsets, reach
+
+
+# The maximum number of faces, and of vertices per face, of the polyhedra made by
+# clipping a cube with 6 planes
+_MAX_FACES = 16
+_MAX_VERTICES = 32
+
+
+@njit
+def _cube(center, half, axes, faces, counts):
+    """
+    Fill the faces of a cube with the given ``center`` and ``half`` size, whose
+    edges are along the rows of ``axes``. Returns the number of faces.
+    """
+    for d in range(3):
+        e1 = (d + 1) % 3
+        e2 = (d + 2) % 3
+        for side in range(2):
+            f = 2 * d + side
+            for k in range(4):
+                # The corners of the face, in order around the face
+                s1 = 2 * (((k + 1) // 2) % 2) - 1
+                s2 = 1 if k >= 2 else -1
+                for c in range(3):
+                    faces[f, k,
+                          c] = center[c] + half * ((2 * side - 1) * axes[d, c] +
+                                                   s1 * axes[e1, c] + s2 * axes[e2, c])
+            counts[f] = 4
+    return 6
+
+
+@njit
+def _clip(faces, counts, nfaces, axis, value, sign, out, out_counts, angles):
+    """
+    Clip a convex polyhedron, given by its faces, by the plane where coordinate
+    ``axis`` is equal to ``value``, keeping the side where ``sign * (x - value)``
+    is positive. The faces of the result are written to ``out``, including the
+    new face on the plane. Returns the number of faces of the result.
+    """
+    nout = 0
+    cap = _MAX_FACES - 1
+    ncap = 0
+    for f in range(nfaces):
+        m = 0
+        n = counts[f]
+        for k in range(n):
+            following = k + 1 if k + 1 < n else 0
+            da = sign * (faces[f, k, axis] - value)
+            db = sign * (faces[f, following, axis] - value)
+            if da > 0:
+                for c in range(3):
+                    out[nout, m, c] = faces[f, k, c]
+                m += 1
+            if (da > 0) != (db > 0):
+                t = da / (da - db)
+                for c in range(3):
+                    delta = faces[f, following, c] - faces[f, k, c]
+                    out[nout, m, c] = faces[f, k, c] + t * delta
+                out[nout, m, axis] = value
+                for c in range(3):
+                    out[cap, ncap, c] = out[nout, m, c]
+                m += 1
+                ncap += 1
+        if m >= 3:
+            out_counts[nout] = m
+            nout += 1
+    if ncap < 3:
+        return nout
+    # Order the vertices of the new face by angle around their mean
+    u = (axis + 1) % 3
+    v = (axis + 2) % 3
+    mu = 0.0
+    mv = 0.0
+    for k in range(ncap):
+        mu += out[cap, k, u]
+        mv += out[cap, k, v]
+    mu /= ncap
+    mv /= ncap
+    for k in range(ncap):
+        angles[k] = np.arctan2(out[cap, k, v] - mv, out[cap, k, u] - mu)
+    for k in range(ncap):
+        # Insertion sort, moving the vertices into the next free face
+        j = k
+        while j > 0 and angles[j - 1] > angles[k]:
+            j -= 1
+        angle = angles[k]
+        for i in range(k, j, -1):
+            angles[i] = angles[i - 1]
+            for c in range(3):
+                out[nout, i, c] = out[nout, i - 1, c]
+        angles[j] = angle
+        for c in range(3):
+            out[nout, j, c] = out[cap, k, c]
+    out_counts[nout] = ncap
+    return nout + 1
+
+
+@njit
+def _range(faces, counts, nfaces, axis):
+    """
+    The minimum and maximum coordinates along ``axis`` of the vertices of a
+    polyhedron.
+    """
+    lower = np.inf
+    upper = -np.inf
+    for f in range(nfaces):
+        for k in range(counts[f]):
+            lower = min(lower, faces[f, k, axis])
+            upper = max(upper, faces[f, k, axis])
+    return lower, upper
+
+
+@njit
+def _volume(faces, counts, nfaces):
+    """
+    The volume of a convex polyhedron, as the sum of the volumes of the
+    tetrahedra joining its faces to the mean of its vertices.
+    """
+    x0 = 0.0
+    y0 = 0.0
+    z0 = 0.0
+    nvertices = 0
+    for f in range(nfaces):
+        for k in range(counts[f]):
+            x0 += faces[f, k, 0]
+            y0 += faces[f, k, 1]
+            z0 += faces[f, k, 2]
+        nvertices += counts[f]
+    if nvertices == 0:
+        return 0.0
+    x0 /= nvertices
+    y0 /= nvertices
+    z0 /= nvertices
+    volume = 0.0
+    for f in range(nfaces):
+        ax = faces[f, 0, 0] - x0
+        ay = faces[f, 0, 1] - y0
+        az = faces[f, 0, 2] - z0
+        for k in range(1, counts[f] - 1):
+            bx = faces[f, k, 0] - x0
+            by = faces[f, k, 1] - y0
+            bz = faces[f, k, 2] - z0
+            cx = faces[f, k + 1, 0] - x0
+            cy = faces[f, k + 1, 1] - y0
+            cz = faces[f, k + 1, 2] - z0
+            volume += abs(ax * (by * cz - bz * cy) - ay * (bx * cz - bz * cx) + az *
+                          (bx * cy - by * cx))
+    return volume / 6.0
+
+
+@njit
+def _add_contribution(out, i, j, n, length, cell_values, cell_weights, operation):
+    nvalues = cell_values.shape[0]
+    out[nvalues + 1, j, i] += length
+    if operation == 3:
+        for v in range(nvalues):
+            out[v, j, i] = max(out[v, j, i], cell_values[v, n])
+        return
+    weight = length
+    if operation == 1:
+        weight *= cell_weights[n]
+        out[nvalues, j, i] += weight
+    for v in range(nvalues):
+        out[v, j, i] += cell_values[v, n] * weight
+
+
+@njit(parallel=True)
+def _deposit_on_grid(cell_values, cell_weights, cell_positions_in_new_basis, cell_sizes,
+                     dir_vecs, grid_lower_edge_in_new_basis,
+                     grid_upper_edge_in_new_basis, nx, ny, operation, aligned, edges,
+                     order, offsets, reach, out):
+
+    xmin = grid_lower_edge_in_new_basis[0]
+    ymin = grid_lower_edge_in_new_basis[1]
+    zmin = grid_lower_edge_in_new_basis[2]
+    zmax = grid_upper_edge_in_new_basis[2]
+    xspacing = (grid_upper_edge_in_new_basis[0] - xmin) / nx
+    yspacing = (grid_upper_edge_in_new_basis[1] - ymin) / ny
+    area = xspacing * yspacing
+    nslabs = len(edges) - 1
+
+    # The axes of the cells in the basis of the map (x, y, depth)
+    axes = np.zeros((3, 3))
+    for d in range(dir_vecs.shape[1]):
+        axes[d, 0] = dir_vecs[1, d]
+        axes[d, 1] = dir_vecs[2, d]
+        axes[d, 2] = dir_vecs[0, d]
+    # Half-sizes of the projected cell footprints, in units of the cell half-size
+    extent_x = 1.0
+    extent_y = 1.0
+    if not aligned:
+        extent_x = np.abs(axes[:, 0]).sum()
+        extent_y = np.abs(axes[:, 1]).sum()
+
+    # Each slab of rows is filled by a single thread
+    for s in prange(nslabs):
+        # Polyhedra of the cell clipped by the depth range, by a row, and by the
+        # columns of the row
+        cell = np.empty((_MAX_FACES, _MAX_VERTICES, 3))
+        row = np.empty((_MAX_FACES, _MAX_VERTICES, 3))
+        part = np.empty((_MAX_FACES, _MAX_VERTICES, 3))
+        scratch = np.empty((_MAX_FACES, _MAX_VERTICES, 3))
+        cell_counts = np.empty(_MAX_FACES, dtype=np.int64)
+        row_counts = np.empty(_MAX_FACES, dtype=np.int64)
+        part_counts = np.empty(_MAX_FACES, dtype=np.int64)
+        scratch_counts = np.empty(_MAX_FACES, dtype=np.int64)
+        angles = np.empty(_MAX_VERTICES)
+        for b in range(s + 1):
+            if reach[b] < edges[s]:
+                continue
+            for m in range(offsets[b], offsets[b + 1]):
+                n = order[m]
+                half = cell_sizes[n]
+                cx = cell_positions_in_new_basis[n, 0]
+                cy = cell_positions_in_new_basis[n, 1]
+                cz = cell_positions_in_new_basis[n, 2]
+                # The unclipped ranges of columns and rows covered by the cell
+                first_x = int(np.floor((cx - half * extent_x - xmin) / xspacing))
+                last_x = int(np.floor((cx + half * extent_x - xmin) / xspacing))
+                ix1 = max(first_x, 0)
+                ix2 = min(last_x + 1, nx)
+                iy1 = max(int(np.floor((cy - half * extent_y - ymin) / yspacing)),
+                          edges[s])
+                iy2 = min(
+                    int(np.floor((cy + half * extent_y - ymin) / yspacing)) + 1,
+                    edges[s + 1])
+                if ix1 >= ix2 or iy1 >= iy2:
+                    continue
+
+                if aligned:
+                    depth = min(cz + half, zmax) - max(cz - half, zmin)
+                    if depth <= 0:
+                        continue
+                    for j in range(iy1, iy2):
+                        y1 = ymin + j * yspacing
+                        overlap_y = min(cy + half, y1 + yspacing) - max(cy - half, y1)
+                        if overlap_y <= 0:
+                            continue
+                        for i in range(ix1, ix2):
+                            x1 = xmin + i * xspacing
+                            overlap_x = min(cx + half, x1 + xspacing) - max(
+                                cx - half, x1)
+                            if overlap_x <= 0:
+                                continue
+                            _add_contribution(out, i, j, n,
+                                              depth * overlap_x * overlap_y / area,
+                                              cell_values, cell_weights, operation)
+                    continue
+
+                # Overlaps smaller than this are rounding errors
+                tolerance = 1.0e-12 * (2.0 * half)**3
+                nfaces = _cube(cell_positions_in_new_basis[n], half, axes, scratch,
+                               scratch_counts)
+                nfaces = _clip(scratch, scratch_counts, nfaces, 2, zmin, 1.0, part,
+                               part_counts, angles)
+                nfaces = _clip(part, part_counts, nfaces, 2, zmax, -1.0, cell,
+                               cell_counts, angles)
+                if nfaces == 0:
+                    continue
+                # Only visit the pixels covered by the clipped cell
+                lower, upper = _range(cell, cell_counts, nfaces, 1)
+                iy1 = max(iy1, int(np.floor((lower - ymin) / yspacing)))
+                iy2 = min(iy2, int(np.floor((upper - ymin) / yspacing)) + 1)
+                for j in range(iy1, iy2):
+                    y1 = ymin + j * yspacing
+                    nrow = _clip(cell, cell_counts, nfaces, 1, y1, 1.0, scratch,
+                                 scratch_counts, angles)
+                    nrow = _clip(scratch, scratch_counts, nrow, 1, y1 + yspacing, -1.0,
+                                 row, row_counts, angles)
+                    if nrow == 0:
+                        continue
+                    lower, upper = _range(row, row_counts, nrow, 0)
+                    first_x = int(np.floor((lower - xmin) / xspacing))
+                    last_x = int(np.floor((upper - xmin) / xspacing))
+                    ix1 = max(first_x, 0)
+                    ix2 = min(last_x + 1, nx)
+                    # The volume on the left of each column edge: the overlap with
+                    # a pixel is the difference between the volumes at its edges
+                    before = 0.0
+                    if ix1 > first_x:
+                        npart = _clip(row, row_counts, nrow, 0, xmin + ix1 * xspacing,
+                                      -1.0, part, part_counts, angles)
+                        before = _volume(part, part_counts, npart)
+                    for i in range(ix1, ix2):
+                        if i < last_x:
+                            npart = _clip(row, row_counts, nrow, 0,
+                                          xmin + (i + 1) * xspacing, -1.0, part,
+                                          part_counts, angles)
+                            after = _volume(part, part_counts, npart)
+                        else:
+                            after = _volume(row, row_counts, nrow)
+                        volume = after - before
+                        before = after
+                        if volume > tolerance:
+                            _add_contribution(out, i, j, n, volume / area, cell_values,
+                                              cell_weights, operation)
+
+
+# Statistics computed in the bins of a 2D histogram
+STATISTICS = ["sum", "count", "mean", "min", "max", "var"]
+
+# The memory available for the private bins of the threads of hist2d
+_HIST2D_MEMORY = 256 * 1024**2
+
+
+@njit
+def _transform(value, log):
+    """
+    Transform a coordinate to log space if needed. Non-positive values become NaN.
+    """
+    if log:
+        if value > 0:
+            return np.log10(value)
+        return np.nan
+    return value
+
+
+def finite_range(x, log=False):
+    """
+    The minimum and maximum of the finite values of ``x`` (of their logarithm if
+    ``log`` is ``True``), without making a copy of the array.
+    """
+    return _finite_range(np.asarray(x, dtype=np.float64), log, get_num_threads())
+
+
 @njit(parallel=True)
-def hist2d(x, y, values, xmin, xmax, nx, ymin, ymax, ny):
+def _finite_range(x, log, nthreads):
+    mins = np.full(nthreads, np.inf)
+    maxs = np.full(nthreads, -np.inf)
+    chunk = (len(x) + nthreads - 1) // nthreads
+    for t in prange(nthreads):
+        for i in range(t * chunk, min((t + 1) * chunk, len(x))):
+            value = _transform(x[i], log)
+            if np.isfinite(value):
+                mins[t] = min(mins[t], value)
+                maxs[t] = max(maxs[t], value)
+    return mins.min(), maxs.max()
+
 
-    out = np.zeros(shape=(values.shape[0], ny, nx), dtype=np.float64)
-    counts = np.zeros(shape=(ny, nx), dtype=np.int64)
+def hist2d(x,
+           y,
+           values,
+           xmin,
+           xmax,
+           nx,
+           ymin,
+           ymax,
+           ny,
+           logx=False,
+           logy=False,
+           statistics=None):
+    """
+    Bin the ``values`` (with shape ``(nvalues, npoints)``) of points with
+    coordinates ``x`` and ``y`` onto a 2D grid, computing the requested
+    ``statistics`` (all the :data:`STATISTICS` by default) in a single pass. Only
+    the bins needed for these statistics are allocated. If ``logx`` or ``logy`` are
+    ``True``, the limits are in log space and the coordinates are transformed on
+    the fly. Points with non-finite coordinates are ignored, and the last bins
+    include their upper edges.
+
+    Each thread accumulates a contiguous chunk of the points into private bins,
+    and the bins of the threads are reduced at the end, so that no updates are
+    lost. The number of threads is limited so that the private bins of all the
+    threads stay below ``_HIST2D_MEMORY`` bytes. The variance is computed with
+    Welford's algorithm, and the partial results are combined with the parallel
+    formulas of Chan et al.
+
+    Returns a dict with the ``count`` of points in each bin (shape ``(ny, nx)``),
+    and the requested statistics (shape ``(nvalues, ny, nx)``). The mean, min, max
+    and (population) variance are NaN in empty bins.
+    """
+    if statistics is None:
+        statistics = STATISTICS
+    for statistic in statistics:
+        if statistic not in STATISTICS:
+            raise ValueError("Unknown statistic '{}', possible choices are {}.".format(
+                statistic, STATISTICS))
+    with_sum = "sum" in statistics or "mean" in statistics
+    with_var = "var" in statistics
+    with_min = "min" in statistics
+    with_max = "max" in statistics
+    values = np.ascontiguousarray(values, dtype=np.float64)
+    nvalues, npoints = values.shape
+    # The sums, means, m2, minima and maxima of each value, and the counts
+    grids = nvalues * (with_sum + 2 * with_var + with_min + with_max) + 1
+    nthreads = max(
+        min(get_num_threads(), npoints // 1000,
+            _HIST2D_MEMORY // (grids * nx * ny * 8)), 1)
+    counts, sums, means, m2, mins, maxs = _hist2d(np.asarray(x, dtype=np.float64),
+                                                  np.asarray(y,
+                                                             dtype=np.float64), values,
+                                                  float(xmin), float(xmax), nx,
+                                                  float(ymin), float(ymax), ny, logx,
+                                                  logy, nthreads, with_sum, with_var,
+                                                  with_min, with_max)
+    empty = counts == 0
+    binned = {"count": counts}
+    with np.errstate(invalid="ignore", divide="ignore"):
+        if "sum" in statistics:
+            binned["sum"] = sums
+        if "mean" in statistics:
+            binned["mean"] = sums / counts
+        if with_var:
+            binned["var"] = m2 / counts
+    if with_min:
+        binned["min"] = mins
+    if with_max:
+        binned["max"] = maxs
+    for key in ["mean", "var", "min", "max"]:
+        if key in binned:
+            binned[key][:, empty] = np.nan
+    return binned
+
+
+@njit(parallel=True)
+def _hist2d(x, y, values, xmin, xmax, nx, ymin, ymax, ny, logx, logy, nthreads,
+            with_sum, with_var, with_min, with_max):
+
+    nvalues = values.shape[0]
+    npoints = values.shape[1]
+    counts = np.zeros((nthreads, ny, nx), dtype=np.int64)
+    # The bins of the statistics which are not needed are empty
+    sums = np.zeros(_shape(with_sum, nthreads, nvalues, ny, nx))
+    means = np.zeros(_shape(with_var, nthreads, nvalues, ny, nx))
+    m2 = np.zeros(_shape(with_var, nthreads, nvalues, ny, nx))
+    mins = np.full(_shape(with_min, nthreads, nvalues, ny, nx), np.inf)
+    maxs = np.full(_shape(with_max, nthreads, nvalues, ny, nx), -np.inf)
     dx = (xmax - xmin) / nx
     dy = (ymax - ymin) / ny
 
-    for i in prange(len(x)):
-        indx = int((x[i] - xmin) / dx)
-        indy = int((y[i] - ymin) / dy)
-        if (indx >= 0) and (indx < nx) and (indy >= 0) and (indy < ny):
-            out[:, indy, indx] += values[:, i]
-            counts[indy, indx] += 1
+    # Accumulate into the private bins of each thread
+    chunk = (npoints + nthreads - 1) // nthreads
+    for t in prange(nthreads):
+        for i in range(t * chunk, min((t + 1) * chunk, npoints)):
+            xi = _transform(x[i], logx)
+            yi = _transform(y[i], logy)
+            if not (np.isfinite(xi) and np.isfinite(yi)):
+                continue
+            fx = np.floor((xi - xmin) / dx)
+            fy = np.floor((yi - ymin) / dy)
+            # The last bins include their upper edges
+            if fx == nx and xi <= xmax:
+                fx -= 1
+            if fy == ny and yi <= ymax:
+                fy -= 1
+            # Written so that NaN limits also reject the point
+            if not (fx >= 0 and fx < nx and fy >= 0 and fy < ny):
+                continue
+            indx = int(fx)
+            indy = int(fy)
+            counts[t, indy, indx] += 1
+            n = counts[t, indy, indx]
+            for v in range(nvalues):
+                value = values[v, i]
+                if with_sum:
+                    sums[t, v, indy, indx] += value
+                if with_var:
+                    delta = value - means[t, v, indy, indx]
+                    means[t, v, indy, indx] += delta / n
+                    m2[t, v, indy, indx] += delta * (value - means[t, v, indy, indx])
+                if with_min:
+                    mins[t, v, indy, indx] = min(mins[t, v, indy, indx], value)
+                if with_max:
+                    maxs[t, v, indy, indx] = max(maxs[t, v, indy, indx], value)
+
+    # Reduce the bins of all the threads into the first one
+    for j in prange(ny):
+        for t in range(1, nthreads):
+            for i in range(nx):
+                nb = counts[t, j, i]
+                if nb == 0:
+                    continue
+                na = counts[0, j, i]
+                n = na + nb
+                for v in range(nvalues):
+                    if with_sum:
+                        sums[0, v, j, i] += sums[t, v, j, i]
+                    if with_var:
+                        delta = means[t, v, j, i] - means[0, v, j, i]
+                        means[0, v, j, i] += delta * nb / n
+                        m2[0, v, j, i] += m2[t, v, j, i] + delta * delta * na * nb / n
+                    if with_min:
+                        mins[0, v, j, i] = min(mins[0, v, j, i], mins[t, v, j, i])
+                    if with_max:
+                        maxs[0, v, j, i] = max(maxs[0, v, j, i], maxs[t, v, j, i])
+                counts[0, j, i] = n
+
+    return counts[0], sums[0], means[0], m2[0], mins[0], maxs[0]
+
+
+@njit
+def _shape(needed, nthreads, nvalues, ny, nx):
+    if needed:
+        return (nthreads, nvalues, ny, nx)
+    return (1, 0, ny, nx)
 
-    return out, counts
+
+@njit
+def find_bin(x, edges, lower, width, uniform, log):
+    """
+    The index of the bin containing ``x``, or -1 if it is outside the ``edges``
+    or not finite. The last bin includes its right edge. If ``uniform`` is
+    ``True``, the bins are equally spaced with the given ``width`` from ``lower``
+    (in log space if ``log`` is ``True``), and the bin is computed directly
+    instead of with a binary search.
+    """
+    nbins = len(edges) - 1
+    if not np.isfinite(x) or x < edges[0] or x > edges[-1]:
+        return -1
+    if uniform:
+        b = int(min(max(np.floor((_transform(x, log) - lower) / width), 0), nbins - 1))
+        # Correct for rounding errors near the edges
+        while b > 0 and x < edges[b]:
+            b -= 1
+        while b < nbins - 1 and x >= edges[b + 1]:
+            b += 1
+        return b
+    return min(np.searchsorted(edges, x, side="right") - 1, nbins - 1)
+
+
+def hist1d(x, edges, weights=None, log=False, uniform=False):
+    """
+    Bin the points ``x`` into the bins defined by the increasing ``edges``, as
+    matplotlib's ``hist`` does (the last bin includes its right edge). If
+    ``uniform`` is ``True``, the edges are assumed to be equally spaced (in log
+    space if ``log`` is ``True``), and the bin of a point is computed directly
+    instead of with a binary search. Non-finite points are ignored.
+
+    As for :func:`hist2d`, each thread fills private bins which are reduced at
+    the end. Returns a dict with the ``count`` of points in each bin, and the
+    ``sum``, ``mean`` and ``std`` (population standard deviation) of the
+    ``weights`` (which default to 1). The mean and std are NaN in empty bins.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    edges = np.asarray(edges, dtype=np.float64)
+    weighted = weights is not None
+    if weighted:
+        weights = np.asarray(weights, dtype=np.float64)
+    else:
+        weights = np.empty(0)
+    lower = np.log10(edges[0]) if log else edges[0]
+    upper = np.log10(edges[-1]) if log else edges[-1]
+    nthreads = max(min(get_num_threads(), len(x) // 1000), 1)
+    counts, sums, m2 = _hist1d(x, weights, weighted, edges, lower,
+                               (upper - lower) / (len(edges) - 1), uniform, log,
+                               nthreads)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = sums / counts
+        std = np.sqrt(m2 / counts)
+    empty = counts == 0
+    mean[empty] = np.nan
+    std[empty] = np.nan
+    return {"count": counts, "sum": sums, "mean": mean, "std": std}
+
+
+@njit(parallel=True)
+def _hist1d(x, weights, weighted, edges, lower, width, uniform, log, nthreads):
+
+    nbins = len(edges) - 1
+    counts = np.zeros((nthreads, nbins), dtype=np.int64)
+    sums = np.zeros((nthreads, nbins))
+    means = np.zeros((nthreads, nbins))
+    m2 = np.zeros((nthreads, nbins))
+
+    chunk = (len(x) + nthreads - 1) // nthreads
+    for t in prange(nthreads):
+        for i in range(t * chunk, min((t + 1) * chunk, len(x))):
+            b = find_bin(x[i], edges, lower, width, uniform, log)
+            if b < 0:
+                continue
+            value = weights[i] if weighted else 1.0
+            counts[t, b] += 1
+            sums[t, b] += value
+            delta = value - means[t, b]
+            means[t, b] += delta / counts[t, b]
+            m2[t, b] += delta * (value - means[t, b])
+
+    for t in range(1, nthreads):
+        for b in range(nbins):
+            nb = counts[t, b]
+            if nb == 0:
+                continue
+            na = counts[0, b]
+            n = na + nb
+            delta = means[t, b] - means[0, b]
+            means[0, b] += delta * nb / n
+            m2[0, b] += m2[t, b] + delta * delta * na * nb / n
+            sums[0, b] += sums[t, b]
+            counts[0, b] = n
+
+    return counts[0], sums[0], m2[0]
+
+
+@lru_cache(maxsize=8)
+def lic_noise(shape, seed=0):
+    """
+    The white noise texture convolved by :func:`lic`. It is generated once for
+    each shape and seed, and then re-used, so that the successive frames of an
+    animation share the same texture and do not flicker. The returned array is
+    read-only, so that the cached texture cannot be modified.
+    """
+    noise = np.random.default_rng(seed).random(shape)
+    noise.flags.writeable = False
+    return noise
+
+
+def lic(vectors, length=None, seed=0):
+    """
+    Compute the line integral convolution of a 2D vector field with shape
+    ``(ny, nx, 2)`` (as produced by ``map()``): each pixel is the average of a
+    white noise texture along the streamline which goes through the pixel, traced
+    ``length`` pixels forward and backward. The streamlines of the different
+    pixels are integrated in parallel. Masked or non-finite vectors stop the
+    streamlines. The result is normalized to the ``[0, 1]`` range.
+    """
+    field = np.ma.filled(np.ma.masked_invalid(vectors[..., :2]), 0.0)
+    field = np.ascontiguousarray(field, dtype=np.float64)
+    if length is None:
+        length = int(max(field.shape[:2]) * 15 / 128)
+    out = _lic(field, lic_noise(field.shape[:2], seed), max(int(length), 1))
+    lower = out.min()
+    upper = out.max()
+    if upper > lower:
+        out = (out - lower) / (upper - lower)
+    return out
+
+
+@njit(parallel=True)
+def _lic(field, noise, length):
+
+    ny, nx = noise.shape
+    out = np.zeros((ny, nx))
+    # Streamlines are traced with steps of half a pixel
+    nsteps = 2 * length
+    for p in prange(ny * nx):
+        j = p // nx
+        i = p % nx
+        total = noise[j, i]
+        count = 1
+        for sign in (-1.0, 1.0):
+            x = i + 0.5
+            y = j + 0.5
+            for _ in range(nsteps):
+                ix = int(x)
+                iy = int(y)
+                vx = field[iy, ix, 0]
+                vy = field[iy, ix, 1]
+                norm = np.sqrt(vx * vx + vy * vy)
+                if norm == 0:
+                    break
+                x += sign * 0.5 * vx / norm
+                y += sign * 0.5 * vy / norm
+                if x < 0 or x >= nx or y < 0 or y >= ny:
+                    break
+                total += noise[int(y), int(x)]
+                count += 1
+        out[j, i] = total / count
+    return out
@@ -0,0 +1,392 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (c) 2022 Osyris contributors (https://github.com/nvaytet/osyris)
+
+import weakref
+import numpy as np
+from matplotlib.cm import ScalarMappable
+from matplotlib.colors import to_rgb, to_rgba
+from numba import njit, prange
+from pint.quantity import Quantity
+from typing import Union
+from ..core import Array, DatagroupView, Plot
+from ..core.spatial import CellIndex, find_cell
+from ..core.tools import make_label
+from .render import render
+from .utils import _transform
+
+_AXES = {
+    "x": ([1, 0, 0], [0, 1, 0]),
+    "y": ([0, 1, 0], [0, 0, 1]),
+    "z": ([0, 0, 1], [1, 0, 0])
+}
+
+# Spatial indices of the cells of the amr groups, with the group versions
+_indices = weakref.WeakKeyDictionary()
+
+
+def _cell_index(amr):
+    """
+    The spatial index of the cells of an ``amr`` group. It is kept until the
+    positions or sizes of the cells are changed, so that successive renderings
+    re-use it.
+    """
+    version = (amr._version, id(amr["xyz"]._array), id(amr["dx"]._array))
+    entry = _indices.get(amr)
+    if entry is None or entry[0] != version:
+        entry = (version,
+                 CellIndex(positions=amr["xyz"].values,
+                           half_sizes=0.5 * amr["dx"].values))
+        _indices[amr] = entry
+    return entry[1]
+
+
+def _magnitude(value, unit):
+    """
+    The values of an Array, Quantity or number, in the unit of another Array.
+    Plain numbers are assumed to already be in that unit.
+    """
+    if isinstance(value, Array):
+        value = value.values * value.unit
+    if isinstance(value, Quantity):
+        return np.asarray(value.to(unit.units).magnitude / unit.magnitude,
+                          dtype=np.float64)
+    return np.asarray(value, dtype=np.float64)
+
+
+class Camera:
+    """
+    An orthographic camera for :func:`volume_render`. The rays are parallel to
+    the ``direction``, and travel from the viewer (on the side the ``direction``
+    points to) through a box of size ``width`` x ``height`` x ``depth`` centered
+    on ``center``. As for :func:`map`, the horizontal axis of the image is
+    ``horizontal``, and the vertical axis is the cross product of ``direction``
+    and ``horizontal``.
+
+    :param center: The center of the view, as an Array or a Quantity.
+
+    :param width: The horizontal size of the view, as a Quantity.
+
+    :param direction: The direction pointing to the viewer, ``'x'``, ``'y'``,
+        ``'z'`` or a vector. Default is ``'z'``.
+
+    :param horizontal: The horizontal axis of the image, as a vector. Default is
+        ``None``, in which case it is chosen as for :func:`map`.
+
+    :param height: The vertical size of the view. Default is ``None``, in which
+        case ``height = width``.
+
+    :param depth: The length of the rays. Default is ``None``, in which case
+        ``depth = width``.
+    """
+    def __init__(self,
+                 center: Union[Array, Quantity],
+                 width: Quantity,
+                 direction: Union[str, list] = "z",
+                 horizontal: list = None,
+                 height: Quantity = None,
+                 depth: Quantity = None):
+        if isinstance(direction, str):
+            normal, default = _AXES[direction]
+        else:
+            normal, default = direction, None
+        normal = np.asarray(normal, dtype=np.float64)
+        normal /= np.linalg.norm(normal)
+        if horizontal is None:
+            if default is None:
+                # Any vector which is not parallel to the direction
+                default = np.eye(3)[np.argmin(np.abs(normal))]
+            horizontal = default
+        horizontal = np.asarray(horizontal, dtype=np.float64)
+        horizontal = horizontal - np.dot(horizontal, normal) * normal
+        horizontal /= np.linalg.norm(horizontal)
+        self.direction = normal
+        self.horizontal = horizontal
+        self.vertical = np.cross(normal, horizontal)
+        self.center = center
+        self.width = width
+        self.height = width if height is None else height
+        self.depth = width if depth is None else depth
+
+    @classmethod
+    def from_path(cls, path, frame: int, depth: Quantity = None):
+        """
+        The camera of a ``frame`` of a :class:`CameraPath`.
+        """
+        params = path[frame]
+        normal, horizontal = params["direction"]
+        center = params["origin"]
+        if center is None:
+            center = np.zeros(3) * params["dx"].units
+        return cls(center=center,
+                   width=params["dx"],
+                   direction=normal,
+                   horizontal=horizontal,
+                   height=params["dy"],
+                   depth=depth)
+
+
+class TransferFunction:
+    """
+    A piecewise-linear transfer function for :func:`volume_render`, which maps the
+    values of a field to colors and opacities. The colors and opacities are
+    linearly interpolated between the ``values``, and values outside of the range
+    of the ``values`` are transparent.
+
+    The opacity is the optical depth accumulated by a ray crossing the full depth
+    of the camera through a medium of constant value.
+
+    :param values: The increasing values of the nodes of the function.
+
+    :param colors: The colors at the nodes, as RGB triplets or matplotlib colors.
+
+    :param opacities: The opacities at the nodes.
+
+    :param log: If ``True``, the ``values`` are in log space, and the function is
+        linear in the logarithm of the data. Default is ``False``.
+    """
+    def __init__(self, values, colors, opacities, log: bool = False):
+        self.values = np.asarray(values, dtype=np.float64)
+        self.colors = np.array([to_rgb(c) for c in colors], dtype=np.float64)
+        self.opacities = np.broadcast_to(np.asarray(opacities, dtype=np.float64),
+                                         self.values.shape).copy()
+        if len(self.colors) != len(self.values):
+            raise ValueError("The transfer function needs one color per value.")
+        if np.any(np.diff(self.values) <= 0):
+            raise ValueError("The values of the transfer function must be "
+                             "increasing.")
+        self.log = log
+
+    @classmethod
+    def from_cmap(cls,
+                  vmin: float,
+                  vmax: float,
+                  cmap: str = None,
+                  opacity: tuple = (0.0, 10.0),
+                  log: bool = False,
+                  nodes: int = 64):
+        """
+        A transfer function with the colors of a colormap between ``vmin`` and
+        ``vmax``, and an opacity which increases linearly from ``opacity[0]`` to
+        ``opacity[1]`` (or is constant if ``opacity`` is a number).
+
+        :param nodes: The number of nodes of the function. Default is ``64``.
+        """
+        if log:
+            vmin, vmax = np.log10(vmin), np.log10(vmax)
+        positions = np.linspace(0.0, 1.0, nodes)
+        colors = ScalarMappable(cmap=cmap).get_cmap()(positions)[:, :3]
+        opacity = np.broadcast_to(np.asarray(opacity, dtype=np.float64), (2, ))
+        return cls(values=vmin + (vmax - vmin) * positions,
+                   colors=colors,
+                   opacities=opacity[0] + (opacity[1] - opacity[0]) * positions,
+                   log=log)
+
+    def __call__(self, values):
+        """
+        The RGBA colors of the ``values`` (the alpha channel is the opacity).
+        """
+        values = np.asarray(values, dtype=np.float64)
+        if self.log:
+            with np.errstate(divide="ignore", invalid="ignore"):
+                values = np.log10(values)
+        out = np.zeros(values.shape + (4, ))
+        for c in range(3):
+            out[..., c] = np.interp(values, self.values, self.colors[:, c])
+        out[..., 3] = np.interp(values, self.values, self.opacities)
+        outside = ~((values >= self.values[0]) & (values <= self.values[-1]))
+        out[outside] = 0.0
+        return out
+
+    @property
+    def table(self):
+        return np.concatenate([self.colors, self.opacities.reshape(-1, 1)], axis=1)
+
+
+def volume_render(data: Array,
+                  camera: Camera,
+                  transfer_function: TransferFunction,
+                  resolution: Union[int, dict] = 512,
+                  background="black",
+                  filename: str = None,
+                  title: str = None,
+                  plot: bool = True,
+                  ax: object = None) -> Plot:
+    """
+    Render a cell field in 3D, by casting a ray through the AMR cells for each
+    pixel of the image. Each ray goes from cell to cell, and the colors and
+    opacities given by the ``transfer_function`` are composited front to back
+    with an emission-absorption model. A ray stops early once it is opaque. The
+    rays are traced in parallel, and the spatial index of the cells is re-used
+    between renderings of the same Dataset.
+
+    :param data: The cell field to render. The norm is used for vectors.
+
+    :param camera: The :class:`Camera`.
+
+    :param transfer_function: The :class:`TransferFunction`.
+
+    :param resolution: The number of pixels of the image, as an integer or a dict
+        ``{'x': 1024, 'y': 768}``. Default is ``512``.
+
+    :param background: The color behind the rendered volume. Default is
+        ``'black'``.
+
+    :param filename: If specified, the returned figure is also saved to file.
+        Default is ``None``.
+
+    :param title: The title of the figure. Default is ``None``.
+
+    :param plot: Make a plot if ``True``. If not, just return the ``Plot`` object
+        containing the image. Default is ``True``.
+
+    :param ax: A matplotlib axes inside which the figure will be plotted.
+        Default is ``None``, in which case some new axes a created.
+
+    :return: A ``Plot`` whose layer contains the RGBA image (with shape
+        ``(ny, nx, 4)`` and the origin at the bottom), composited over the
+        ``background``.
+    """
+    if isinstance(resolution, int):
+        resolution = {"x": resolution, "y": resolution}
+    dataset = data.parent.parent
+    amr = dataset["amr"]
+    xyz = amr["xyz"]
+    if xyz.shape[-1] != 3 or len(xyz.shape) != 2:
+        raise ValueError("Volume rendering requires a 3D simulation.")
+    index = _cell_index(amr)
+    half_sizes = 0.5 * np.asarray(amr["dx"].values, dtype=np.float64)
+    width = float(_magnitude(camera.width, xyz.unit))
+    height = float(_magnitude(camera.height, xyz.unit))
+    depth = float(_magnitude(camera.depth, xyz.unit))
+    center = _magnitude(camera.center, xyz.unit).reshape(3)
+
+    if isinstance(data.parent, DatagroupView):
+        # The cells which are not selected are transparent
+        values = np.full(len(half_sizes), np.nan)
+        values[data.parent.selection] = data.norm.values
+    else:
+        values = np.asarray(data.norm.values, dtype=np.float64)
+    image = _volume_render(values, transfer_function.log, xyz.values, half_sizes,
+                           center, camera.direction, camera.horizontal, camera.vertical,
+                           width, height, depth, resolution["x"], resolution["y"],
+                           transfer_function.values, transfer_function.table,
+                           2.0 * half_sizes.min(), *index.arrays)
+    if background is not None:
+        # The colors are premultiplied by the opacity
+        base = np.array(to_rgba(background))
+        image = image + (1.0 - image[..., 3:]) * base
+    image = np.clip(image, 0.0, 1.0)
+
+    xcenters = (np.arange(resolution["x"]) +
+                0.5) / resolution["x"] * width - 0.5 * width
+    ycenters = (np.arange(resolution["y"]) +
+                0.5) / resolution["y"] * height - 0.5 * height
+    to_return = {
+        "x": xcenters,
+        "y": ycenters,
+        "layers": [{
+            "data": image,
+            "mode": "rgba",
+            "name": data.name
+        }],
+        "filename": filename
+    }
+    if plot:
+        figure = render(ax=ax)
+        figure["ax"].imshow(
+            image,
+            origin="lower",
+            extent=[-0.5 * width, 0.5 * width, -0.5 * height, 0.5 * height])
+        figure["ax"].set_xlabel(make_label(unit=xyz.unit.units))
+        figure["ax"].set_ylabel(make_label(unit=xyz.unit.units))
+        if title is not None:
+            figure["ax"].set_title(title)
+        to_return.update({"fig": figure["fig"], "ax": figure["ax"]})
+    return Plot(**to_return)
+
+
+@njit
+def _sample(value, nodes, table, out):
+    """
+    Interpolate the transfer function at ``value``. Returns ``False`` if the value
+    is outside of the nodes.
+    """
+    if not (value >= nodes[0] and value <= nodes[-1]):
+        return False
+    k = min(max(np.searchsorted(nodes, value), 1), len(nodes) - 1)
+    w = (value - nodes[k - 1]) / (nodes[k] - nodes[k - 1])
+    for c in range(4):
+        out[c] = (1.0 - w) * table[k - 1, c] + w * table[k, c]
+    return True
+
+
+@njit(parallel=True)
+def _volume_render(values, log, positions, half_sizes, center, direction, horizontal,
+                   vertical, width, height, depth, nx, ny, nodes, table, min_step, keys,
+                   cells, offsets, sizes, origins, extents):
+
+    out = np.zeros((ny, nx, 4))
+    # Bounding box of all the cells
+    lower = np.full(3, np.inf)
+    upper = np.full(3, -np.inf)
+    for level in range(len(sizes)):
+        for d in range(3):
+            lower[d] = min(lower[d], origins[level, d])
+            upper[d] = max(upper[d],
+                           origins[level, d] + extents[level, d] * sizes[level])
+
+    for p in prange(nx * ny):
+        j = p // nx
+        i = p % nx
+        start = np.empty(3)
+        ray = np.empty(3)
+        for d in range(3):
+            start[d] = (center[d] + ((i + 0.5) / nx - 0.5) * width * horizontal[d] +
+                        ((j + 0.5) / ny - 0.5) * height * vertical[d] +
+                        0.5 * depth * direction[d])
+            ray[d] = -direction[d]
+
+        # Clip the ray to the bounding box of the cells
+        tmin = 0.0
+        tmax = depth
+        for d in range(3):
+            if ray[d] == 0:
+                if start[d] < lower[d] or start[d] > upper[d]:
+                    tmax = -1.0
+                continue
+            ta = (lower[d] - start[d]) / ray[d]
+            tb = (upper[d] - start[d]) / ray[d]
+            tmin = max(tmin, min(ta, tb))
+            tmax = min(tmax, max(ta, tb))
+
+        rgba = np.zeros(4)
+        color = np.empty(4)
+        point = np.empty(3)
+        # Start just inside the box, as the cells do not contain their upper faces
+        t = tmin + 1.0e-6 * min_step
+        # Front to back emission-absorption, until the ray is (almost) opaque
+        while t < tmax and rgba[3] < 0.995:
+            for d in range(3):
+                point[d] = start[d] + t * ray[d]
+            n = find_cell(point, keys, cells, offsets, sizes, origins, extents)
+            if n < 0:
+                t += min_step
+                continue
+            # Distance to the exit of the cell
+            h = half_sizes[n]
+            length = tmax - t
+            for d in range(3):
+                if ray[d] > 0:
+                    length = min(length, (positions[n, d] + h - point[d]) / ray[d])
+                elif ray[d] < 0:
+                    length = min(length, (positions[n, d] - h - point[d]) / ray[d])
+            length = max(length, 0.0)
+            if _sample(_transform(values[n], log), nodes, table, color):
+                absorbed = (1.0 - rgba[3]) * (1.0 - np.exp(-color[3] * length / depth))
+                for c in range(3):
+                    rgba[c] += absorbed * color[c]
+                rgba[3] += absorbed
+            # Step just past the boundary of the cell
+            t += length + 1.0e-6 * h
+        out[j, i] = rgba
+    return out
@@ -3,8 +3,7 @@
 
 from .. import config
 from ..core import Array
-from contextlib import redirect_stderr
-import io
+from .utils import lic
 import matplotlib.pyplot as plt
 from matplotlib.cm import ScalarMappable
 from matplotlib.collections import PatchCollection
@@ -194,13 +193,8 @@ def line_integral_convolution(ax,
     Wrapper that plots a line integral convolution of a vector field.
     Uses alpha blending to merge the LIC with a user-requested color.
     """
-    from lic import lic
-
     # Compute line integral convolution
-    if length is None:
-        length = int(max(z.shape[:-1]) * 15 / 128)
-    with redirect_stderr(io.StringIO()) as _:
-        lic_res = lic(z[..., 1], z[..., 0], length=length)
+    lic_res = lic(z, length=length)
 
     if color is not None:
         plot_args = {**kwargs}
@@ -0,0 +1,80 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (c) 2022 Osyris contributors (https://github.com/nvaytet/osyris)
+import pickle
+import numpy as np
+import pytest
+from osyris import Array, Histogram1D, Histogram2D, units
+
+
+def _data(npoints=6000, seed=12):
+    rng = np.random.default_rng(seed)
+    x = Array(values=10.0**rng.uniform(-1, 1, npoints), unit='cm')
+    y = Array(values=rng.normal(size=npoints), unit='K')
+    w = Array(values=1.0e3 + rng.random(npoints), unit='g')
+    return x, y, w
+
+
+def _chunks(array, nchunks):
+    return [array[i::nchunks] for i in range(nchunks)]
+
+
+def _assert_same_statistics(a, b, operations):
+    for operation in operations:
+        assert np.allclose(a.statistic(operation),
+                           b.statistic(operation),
+                           equal_nan=True,
+                           rtol=1.0e-10)
+
+
+def test_histogram1d_fill_merge_pickle_equivalence():
+    x, _, w = _data()
+    edges = dict(xmin=0.1 * units('cm'), xmax=10.0 * units('cm'), bins=20, logx=True)
+    whole = Histogram1D(**edges).fill(x, weights=w)
+    # Filled in chunks
+    chunked = Histogram1D(**edges)
+    for xc, wc in zip(_chunks(x, 4), _chunks(w, 4)):
+        chunked.fill(xc, weights=wc)
+    # Merged from separate histograms, after a round-trip through pickle
+    parts = [
+        pickle.loads(pickle.dumps(Histogram1D(**edges).fill(xc, weights=wc)))
+        for xc, wc in zip(_chunks(x, 3), _chunks(w, 3))
+    ]
+    merged = Histogram1D(**edges)
+    for part in parts:
+        merged.merge(part)
+    operations = ['sum', 'count', 'mean', 'std', 'var']
+    _assert_same_statistics(whole, chunked, operations)
+    _assert_same_statistics(whole, merged, operations)
+    counts, _ = np.histogram(x.values, bins=np.logspace(-1, 1, 21))
+    assert np.array_equal(whole.statistic('count'), counts)
+
+
+def test_histogram2d_fill_merge_pickle_equivalence():
+    x, y, w = _data()
+    edges = dict(xmin=0.1, xmax=10.0, ymin=-3.0, ymax=3.0, resolution={'x': 8, 'y': 6})
+    whole = Histogram2D(**edges, logx=True).fill(x, y, weights=w)
+    restored = pickle.loads(pickle.dumps(Histogram2D(**edges, logx=True)))
+    for xc, yc, wc in zip(_chunks(x, 3), _chunks(y, 3), _chunks(w, 3)):
+        restored.merge(Histogram2D(**edges, logx=True).fill(xc, yc, weights=wc))
+    _assert_same_statistics(whole, restored,
+                            ['sum', 'count', 'mean', 'std', 'var', 'min', 'max'])
+    counts = np.histogram2d(y.values,
+                            x.values,
+                            bins=[np.linspace(-3, 3, 7),
+                                  np.logspace(-1, 1, 9)])[0]
+    assert np.array_equal(whole.statistic('count'), counts)
+
+
+def test_histogram_merge_converts_weight_units():
+    x, y, w = _data()
+    kilograms = Array(values=w.values * 1.0e-3, unit='kg')
+    grams = Histogram2D(0.1, 10.0, -3.0, 3.0, resolution=5).fill(x, y, weights=w)
+    doubled = Histogram2D(0.1, 10.0, -3.0, 3.0, resolution=5).fill(x, y, weights=w)
+    doubled.merge(
+        Histogram2D(0.1, 10.0, -3.0, 3.0, resolution=5).fill(x, y, weights=kilograms))
+    assert np.allclose(doubled.statistic('sum'), 2.0 * grams.statistic('sum'))
+    assert np.allclose(doubled.statistic('var'), grams.statistic('var'))
+    with pytest.raises(ValueError):
+        grams.merge(Histogram2D(0.1, 10.0, -3.0, 3.0, resolution=6))
+    with pytest.raises(ValueError):
+        grams.merge(Histogram1D(0.1, 10.0, bins=5))
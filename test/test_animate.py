@@ -0,0 +1,91 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (c) 2022 Osyris contributors (https://github.com/nvaytet/osyris)
+import numpy as np
+from matplotlib.colors import Normalize
+from osyris import Array, CameraPath, units
+from osyris.plot.animate import _render_spec
+
+
+def test_camera_path_orbit():
+    path = CameraPath.orbit(4, dx=2.0 * units('cm'), axis='z', start='x')
+    assert len(path) == 4
+    assert np.allclose(path.normals, [[1, 0, 0], [0, 1, 0], [-1, 0, 0], [0, -1, 0]])
+    assert np.allclose(np.einsum('ij,ij->i', path.normals, path.horizontals), 0.0)
+    # The rotation axis points up in all the maps
+    assert np.allclose(np.cross(path.normals, path.horizontals), [0, 0, 1])
+    assert np.allclose(path.dx, 2.0)
+    assert np.allclose(path.dy, 2.0)
+    assert path.origin is None
+
+
+def test_camera_path_zoom():
+    origin = Array(values=np.array([[5.0, 5.0, 5.0]]), unit='mm')
+    path = CameraPath.zoom(5,
+                           dx_start=1.0 * units('cm'),
+                           dx_end=16.0 * units('um'),
+                           aspect=0.5,
+                           origin=origin)
+    assert np.allclose(path.dx, [1.0, 0.2, 0.04, 0.008, 0.0016])
+    assert np.allclose(path.dy, 0.5 * path.dx)
+    assert np.allclose(path.origin, 0.5)
+    frame = path[2]
+    assert np.isclose(frame['dx'].to('cm').magnitude, 0.04)
+    assert np.allclose(frame['origin'].values, 0.5)
+    # The origin given by the caller is left unchanged
+    assert origin.unit == units('mm')
+    assert np.allclose(origin.values, 5.0)
+
+
+def test_camera_path_concatenation():
+    first = CameraPath.orbit(2,
+                             dx=1.0 * units('cm'),
+                             origin=Array(values=np.array([[1.0, 2.0, 3.0]]),
+                                          unit='cm'))
+    second = CameraPath.zoom(3, dx_start=10.0 * units('mm'), dx_end=1.0 * units('mm'))
+    path = first + second
+    assert len(path) == 5
+    assert path.unit == units('cm').units
+    assert np.allclose(path.dx, [1.0, 1.0, 1.0, np.sqrt(0.1), 0.1])
+    assert np.allclose(path.origin[:2], [1.0, 2.0, 3.0])
+    assert np.allclose(path.origin[2:], 0.0)
+    assert np.allclose(path.normals[2:], [0, 0, 1])
+
+
+def test_render_spec_image():
+    data = np.ma.masked_invalid(np.array([[1.0, 2.0], [np.nan, 4.0]]))
+    spec = _render_spec({
+        'mode': None,
+        'params': {
+            'norm': Normalize(),
+            'cbar': False
+        },
+        'data': data,
+        'name': 'density',
+        'unit': units('g/cm**3')
+    })
+    assert spec['mode'] == 'image'
+    assert not spec['cbar']
+    assert spec['params']['norm'].vmin == 1.0
+    assert spec['params']['norm'].vmax == 4.0
+
+
+def test_render_spec_colored_vectors():
+    data = np.zeros((2, 2, 3))
+    data[..., 2] = [[10.0, 20.0], [30.0, 40.0]]
+    layer = {
+        'mode': 'vec',
+        'params': {
+            'norm': Normalize(),
+            'color': Array(values=np.ones(4))
+        },
+        'data': data
+    }
+    spec = _render_spec(layer)
+    assert spec['mode'] == 'vec'
+    assert spec['params']['color'] is None
+    assert spec['params']['norm'].vmin == 10.0
+    assert spec['params']['norm'].vmax == 40.0
+    layer['params'] = {'norm': Normalize(), 'color': 'k'}
+    spec = _render_spec(layer)
+    assert spec['params']['color'] == 'k'
+    assert 'norm' not in spec['params']
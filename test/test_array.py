@@ -318,3 +318,133 @@ def test_reshape():
     a = osyris.Array(values=[1., 2., 3., 4., 5., 6.], unit='m')
     expected = osyris.Array(values=[[1., 2., 3.], [4., 5., 6.]], unit='m')
     assert all(np.ravel(a.reshape(2, 3) == expected))
+
+
+def test_multiplication_different_units():
+    a = osyris.Array(values=[1., 2., 3.], unit='m')
+    b = osyris.Array(values=[1., 2., 3.], unit='km')
+    expected = osyris.Array(values=[1000., 4000., 9000.], unit='m**2')
+    result = a * b
+    assert result.unit.units == osyris.units('cm**2').units
+    assert np.allclose(result.to('m**2').values, expected.values)
+
+
+def test_unit_is_kept_on_to():
+    a = osyris.Array(values=[1., 2., 3.], unit='m')
+    a.to('au')
+    assert a.unit == 1.0 * osyris.units('au')
+    assert a.label == '[au]'
+
+
+def test_ufunc_add_converts_units():
+    a = osyris.Array(values=[1., 2., 3.], unit='m')
+    b = osyris.Array(values=[1., 2., 3.], unit='cm')
+    result = np.add(a, b)
+    assert result.unit == 1.0 * osyris.units('m')
+    assert np.allclose(result.values, [1.01, 2.02, 3.03])
+
+
+def test_ufunc_multiply_integer_arrays_with_different_units():
+    a = osyris.Array(values=np.array([1, 2, 3]), unit='m')
+    b = osyris.Array(values=np.array([10, 20, 30]), unit='cm')
+    product = np.multiply(a, b)
+    assert np.allclose(product.to('m**2').values, [0.1, 0.4, 0.9])
+    ratio = np.divide(a, b)
+    assert np.allclose(ratio.to('').values, [10., 10., 10.])
+
+
+def test_ufunc_arctan2_converts_units():
+    a = osyris.Array(values=[1., 2.], unit='m')
+    b = osyris.Array(values=[100., 100.], unit='cm')
+    angle = np.arctan2(a, b)
+    assert angle.unit == 1.0 * osyris.units('rad')
+    assert np.allclose(angle.values, np.arctan2([1., 2.], [1., 1.]))
+    assert np.allclose(
+        np.arctan2(a, 50. * osyris.units('cm')).values, np.arctan2([1., 2.],
+                                                                   [0.5, 0.5]))
+    quotient = np.floor_divide(a, osyris.Array(values=[30., 30.], unit='cm'))
+    assert quotient.unit == 1.0 * osyris.units('dimensionless')
+    assert np.array_equal(quotient.values, [3., 6.])
+    with pytest.raises(pint.errors.DimensionalityError):
+        np.arctan2(a, osyris.Array(values=[1., 1.], unit='s'))
+
+
+def test_ufunc_out():
+    a = osyris.Array(values=[1., 2., 3.], unit='m')
+    b = osyris.Array(values=[4., 5., 6.], unit='s')
+    out = osyris.Array(values=np.zeros(3), unit='kg')
+    buffer = out.values
+    result = np.multiply(a, b, out=out)
+    assert result is out
+    assert out.values is buffer
+    assert np.allclose(out.to('m*s').values, [4., 10., 18.])
+
+
+def test_ufunc_out_in_place():
+    a = osyris.Array(values=[1., 2., 3.], unit='m')
+    b = osyris.Array(values=[100., 200., 300.], unit='cm')
+    np.add(a, b, out=a)
+    assert np.allclose(a.values, [2., 4., 6.])
+    assert a.unit == 1.0 * osyris.units('m')
+
+
+def test_ufunc_where():
+    a = osyris.Array(values=[1., 2., 3.], unit='m')
+    out = osyris.Array(values=np.zeros(3), unit='m')
+    mask = osyris.Array(values=[True, False, True])
+    np.negative(a, out=out, where=mask)
+    assert np.allclose(out.values, [-1., 0., -3.])
+
+
+def test_ufunc_comparison_returns_ndarray():
+    a = osyris.Array(values=[1., 2., 3.], unit='m')
+    b = osyris.Array(values=[150., 150., 150.], unit='cm')
+    result = np.greater(a, b)
+    assert isinstance(result, np.ndarray)
+    assert np.array_equal(result, [False, True, True])
+
+
+def test_ufunc_reduce():
+    a = osyris.Array(values=[[1., 2.], [3., 4.]], unit='m')
+    result = np.add.reduce(a, axis=1)
+    assert np.allclose(result.values, [3., 7.])
+    assert result.unit == 1.0 * osyris.units('m')
+    assert np.maximum.reduce(a, axis=None).values == 4.
+    product = np.multiply.reduce(a, axis=0)
+    assert np.allclose(product.values, [3., 8.])
+    assert product.unit == 1.0 * osyris.units('m**2')
+
+
+def test_ufunc_accumulate():
+    a = osyris.Array(values=[1., 2., 3.], unit='s')
+    result = np.add.accumulate(a)
+    assert np.allclose(result.values, [1., 3., 6.])
+    assert result.unit == 1.0 * osyris.units('s')
+    with pytest.raises(TypeError):
+        _ = np.multiply.accumulate(a)
+
+
+def test_ufunc_at():
+    a = osyris.Array(values=[0., 0., 0.], unit='m')
+    b = osyris.Array(values=[100., 200., 300.], unit='cm')
+    np.add.at(a, [0, 0, 2], b)
+    assert np.allclose(a.values, [3., 0., 3.])
+    assert a.unit == 1.0 * osyris.units('m')
+
+
+def test_axis_reductions():
+    a = osyris.Array(values=[[1., 2.], [3., 4.]], unit='m')
+    assert np.allclose(a.sum(axis=0).values, [4., 6.])
+    assert np.allclose(a.mean(axis=1).values, [1.5, 3.5])
+    assert np.allclose(a.min(axis=0).values, [1., 2.])
+    assert np.allclose(a.max(axis=1).values, [2., 4.])
+    assert a.std().unit == 1.0 * osyris.units('m')
+    assert np.var(a).unit == 1.0 * osyris.units('m**2')
+
+
+def test_average_with_weights():
+    a = osyris.Array(values=[1., 2., 3.], unit='m')
+    w = osyris.Array(values=[1., 1., 2.], unit='kg')
+    result = np.average(a, weights=w)
+    assert result.values == 2.25
+    assert result.unit == 1.0 * osyris.units('m')
@@ -1,6 +1,7 @@
 # SPDX-License-Identifier: BSD-3-Clause
 # Copyright (c) 2022 Osyris contributors (https://github.com/nvaytet/osyris)
 import osyris
+import numpy as np
 import pytest
 
 
@@ -92,3 +93,149 @@ def test_datagroup_slice_range():
     sliced = dg[1:4]
     assert all(sliced['a'] == expected['a'])
     assert all(sliced['b'] == expected['b'])
+
+
+def test_datagroup_slice_is_a_view():
+    a = osyris.Array(values=[1., 2., 3., 4., 5.], unit='m')
+    b = osyris.Array(values=[6., 7., 8., 9., 10.], unit='s')
+    dg = osyris.Datagroup({'a': a, 'b': b})
+    sliced = dg[1:4]
+    assert isinstance(sliced, osyris.core.DatagroupView)
+    assert sliced.shape == 3
+    assert np.shares_memory(sliced['a'].values, a.values)
+
+
+def test_datagroup_chained_selection():
+    a = osyris.Array(values=np.arange(10.), unit='m')
+    b = osyris.Array(values=np.arange(10.) * 2., unit='s')
+    dg = osyris.Datagroup({'a': a, 'b': b})
+    selected = dg[dg['a'] > osyris.Array(values=2., unit='m')][::2][[0, 2]]
+    assert selected.shape == 2
+    assert np.array_equal(selected['a'].values, [3., 7.])
+    assert np.array_equal(selected['b'].values, [6., 14.])
+    assert selected['a'].unit == osyris.units('m')
+
+
+def test_datagroup_view_materialize():
+    a = osyris.Array(values=[1., 2., 3., 4., 5.], unit='m')
+    b = osyris.Array(values=[6., 7., 8., 9., 10.], unit='s')
+    dg = osyris.Datagroup({'a': a, 'b': b})
+    mask = np.array([True, False, True, False, True])
+    materialized = dg[mask].materialize()
+    assert isinstance(materialized, osyris.Datagroup)
+    assert all(materialized['a'] == osyris.Array(values=[1., 3., 5.], unit='m'))
+    assert all(materialized['b'] == osyris.Array(values=[6., 8., 10.], unit='s'))
+    assert materialized['a'].parent is materialized
+
+
+def test_datagroup_view_insertion():
+    a = osyris.Array(values=[1., 2., 3., 4., 5.], unit='m')
+    dg = osyris.Datagroup({'a': a})
+    sliced = dg[:3]
+    sliced['c'] = osyris.Array(values=[0., 1., 2.], unit='K')
+    assert 'c' in sliced.keys()
+    assert 'c' not in dg.keys()
+    with pytest.raises(RuntimeError):
+        sliced['d'] = osyris.Array(values=[0., 1.], unit='K')
+
+
+def test_derived_field_is_computed_on_access():
+    calls = []
+
+    def double(a):
+        calls.append(1)
+        return 2.0 * a
+
+    dg = osyris.Datagroup({'a': osyris.Array(values=[1., 2., 3.], unit='m')})
+    dg.derive('b', double, dependencies=['a'])
+    assert 'b' in dg
+    assert list(dg.keys()) == ['a', 'b']
+    assert len(calls) == 0
+    assert np.allclose(dg['b'].values, [2., 4., 6.])
+    assert dg['b'].name == 'b'
+    _ = dg['b']
+    assert len(calls) == 1
+
+
+def test_derived_field_is_invalidated_when_dependency_changes():
+    dg = osyris.Datagroup({'a': osyris.Array(values=[1., 2., 3.], unit='s')})
+    dg.derive('b', lambda a: 2.0 * a, dependencies=['a'])
+    dg.derive('c', lambda b: b + b, dependencies=['b'])
+    assert np.allclose(dg['c'].values, [4., 8., 12.])
+    dg['a'] = osyris.Array(values=[2., 2., 2.], unit='s')
+    assert np.allclose(dg['b'].values, [4., 4., 4.])
+    assert np.allclose(dg['c'].values, [8., 8., 8.])
+
+
+def test_derived_field_across_groups():
+    ds = osyris.Dataset()
+    ds['amr'] = osyris.Datagroup({'dx': osyris.Array(values=[1., 2.], unit='cm')})
+    ds['hydro'] = osyris.Datagroup(
+        {'density': osyris.Array(values=[1., 1.], unit='g/cm**3')})
+    ds['hydro'].derive('mass',
+                       lambda rho, dx: rho.lazy() * dx.lazy()**3,
+                       dependencies=['density', ('amr', 'dx')])
+    assert np.allclose(ds['hydro']['mass'].values, [1., 8.])
+    ds['amr']['dx'] = osyris.Array(values=[3., 3.], unit='cm')
+    assert np.allclose(ds['hydro']['mass'].values, [27., 27.])
+
+
+def test_derived_field_missing_dependency():
+    dg = osyris.Datagroup({'a': osyris.Array(values=[1., 2., 3.], unit='m')})
+    with pytest.raises(KeyError):
+        dg.derive('b', lambda x: x, dependencies=['x'])
+
+
+def test_setting_derived_field_replaces_it():
+    dg = osyris.Datagroup({'a': osyris.Array(values=[1., 2., 3.], unit='m')})
+    dg.derive('b', lambda a: 2.0 * a, dependencies=['a'])
+    dg['b'] = osyris.Array(values=[0., 0., 0.], unit='m')
+    dg['a'] = osyris.Array(values=[5., 5., 5.], unit='m')
+    assert not dg.is_derived('b')
+    assert np.allclose(dg['b'].values, [0., 0., 0.])
+
+
+def test_datagroup_view_caches_selected_columns():
+    a = osyris.Array(values=np.arange(6.), unit='m')
+    dg = osyris.Datagroup({'a': a})
+    view = dg[np.array([1, 3, 4])]
+    assert view['a'] is view['a']
+    # Replacing the column, or converting its unit, selects it again
+    dg['a'] = osyris.Array(values=np.arange(6.) * 2., unit='m')
+    assert np.array_equal(view['a'].values, [2., 6., 8.])
+    dg['a'].to('cm')
+    assert view['a'].unit == osyris.units('cm')
+    assert np.array_equal(view['a'].values, [200., 600., 800.])
+
+
+def test_datagroup_view_str_does_not_compute_fields():
+    calls = []
+
+    def double(a):
+        calls.append(1)
+        return 2.0 * a
+
+    dg = osyris.Datagroup({'a': osyris.Array(values=[1., 2., 3.], unit='m')})
+    dg.derive('b', double, dependencies=['a'])
+    view = dg[:2]
+    assert "'b' Not selected yet" in str(view)
+    assert len(calls) == 0
+
+
+def test_datagroup_view_materialize_keeps_derived_fields_lazy():
+    calls = []
+
+    def double(a):
+        calls.append(1)
+        return 2.0 * a
+
+    dg = osyris.Datagroup({'a': osyris.Array(values=[1., 2., 3.], unit='m')})
+    dg.derive('b', double, dependencies=['a'])
+    materialized = dg[[0, 2]].materialize()
+    assert materialized.is_derived('b')
+    assert len(calls) == 0
+    assert np.array_equal(materialized['b'].values, [2., 6.])
+    assert len(calls) == 1
+    # The copy is independent of the original group
+    materialized['a'].values[0] = 10.
+    assert dg['a'].values[0] == 1.
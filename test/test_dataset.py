@@ -1,6 +1,8 @@
 # SPDX-License-Identifier: BSD-3-Clause
 # Copyright (c) 2022 Osyris contributors (https://github.com/nvaytet/osyris)
 import osyris
+import numpy as np
+import pytest
 
 
 def test_dataset_creation():
@@ -17,3 +19,203 @@ def test_dataset_creation():
     ds['two'] = dg2
     assert 'one' in ds
     assert 'two' in ds
+
+
+def _make_cell_dataset():
+    # A uniform 8x8x8 grid of cells, shuffled randomly
+    n = 8
+    centers = (np.arange(n) + 0.5) / n
+    xyz = np.array(np.meshgrid(centers, centers, centers,
+                               indexing='ij')).reshape(3, -1).T
+    xyz = xyz[np.random.permutation(len(xyz))]
+    ds = osyris.Dataset()
+    ds['amr'] = osyris.Datagroup({
+        'xyz':
+        osyris.Array(values=xyz, unit='cm'),
+        'dx':
+        osyris.Array(values=np.full(len(xyz), 1.0 / n), unit='cm')
+    })
+    ds['hydro'] = osyris.Datagroup(
+        {'density': osyris.Array(values=xyz[:, 0] + 10 * xyz[:, 1], unit='g/cm**3')})
+    return ds
+
+
+def test_dataset_reorder_hilbert():
+    ds = _make_cell_dataset()
+    ds.reorder(kind='hilbert')
+    xyz = ds['amr']['xyz'].values
+    # Columns of the different groups must have been permuted together
+    assert np.allclose(ds['hydro']['density'].values, xyz[:, 0] + 10 * xyz[:, 1])
+    # Consecutive cells along a Hilbert curve are always direct neighbours
+    steps = np.linalg.norm(np.diff(xyz, axis=0), axis=1)
+    assert np.allclose(steps, 1.0 / 8)
+
+
+def test_dataset_reorder_morton():
+    ds = _make_cell_dataset()
+    ds.reorder(kind='morton')
+    xyz = ds['amr']['xyz'].values
+    assert np.allclose(ds['hydro']['density'].values, xyz[:, 0] + 10 * xyz[:, 1])
+    # The first 8 cells of a Morton curve form the first 2x2x2 block
+    assert np.all(xyz[:8] < 0.25)
+
+
+def test_dataset_reorder_bad_kind():
+    ds = _make_cell_dataset()
+    with pytest.raises(ValueError):
+        ds.reorder(kind='peano')
+
+
+def test_dataset_memory_limit_evicts_and_reloads():
+    ds = osyris.Dataset(memory_limit="2KB")
+    values = {key: np.random.random(100) for key in 'abc'}
+    ds['hydro'] = osyris.Datagroup(
+        {key: osyris.Array(values=v, unit='cm')
+         for key, v in values.items()})
+    # Each column is 800 bytes: only two of them fit in memory
+    assert ds.nbytes() <= 2000
+    assert list(ds['hydro'].keys()) == ['b', 'c', 'a']
+    for key in 'abc':
+        array = ds['hydro'][key]
+        assert np.array_equal(array.values, values[key])
+        assert array.unit == osyris.units('cm')
+        assert ds.nbytes() <= 2000
+    # Reading 'a', 'b' and 'c' in turn means 'a' is now the least recently used
+    assert 'a' not in ds['hydro']._container
+    assert 'c' in ds['hydro']._container
+
+
+def test_dataset_memory_limit_keeps_changes_to_held_references():
+    ds = osyris.Dataset(memory_limit="2KB")
+    ds['hydro'] = osyris.Datagroup(
+        {key: osyris.Array(values=np.zeros(100), unit='cm')
+         for key in 'abcd'})
+    a = ds['hydro']['a']
+    values = ds['hydro']['b'].values
+    ds['hydro']['c']
+    ds['hydro']['d']
+    assert 'a' in ds['hydro']._evicted
+    assert 'b' in ds['hydro']._evicted
+    a.values[:] = 1.0
+    values[:] = 2.0
+    assert np.all(ds['hydro']['a'].values == 1.0)
+    assert ds['hydro']['a'] is a
+    assert np.all(ds['hydro']['b'].values == 2.0)
+
+
+def test_dataset_reorder_respects_memory_limit():
+    ds = _make_cell_dataset()
+    xyz = ds['amr']['xyz'].values.copy()
+    density = ds['hydro']['density'].values.copy()
+    limited = osyris.Dataset(memory_limit="20KB")
+    limited['amr'] = osyris.Datagroup({
+        'xyz':
+        osyris.Array(values=xyz.copy(), unit='cm'),
+        'dx':
+        osyris.Array(values=np.full(len(xyz), 0.125), unit='cm')
+    })
+    limited['hydro'] = osyris.Datagroup({
+        key: osyris.Array(values=density * (i + 1), unit='g/cm**3')
+        for i, key in enumerate('abc')
+    })
+    limited.reorder(kind='hilbert')
+    assert limited.nbytes() <= 20000
+    ds.reorder(kind='hilbert')
+    assert np.array_equal(limited['amr']['xyz'].values, ds['amr']['xyz'].values)
+    for i, key in enumerate('abc'):
+        assert np.array_equal(limited['hydro'][key].values,
+                              ds['hydro']['density'].values * (i + 1))
+
+
+def test_dataset_memory_limit_drops_derived_fields():
+    ds = osyris.Dataset(memory_limit=1600)
+    ds['hydro'] = osyris.Datagroup({'a': osyris.Array(values=np.ones(100))})
+    ds['hydro'].derive('b', lambda a: 2.0 * a, dependencies=['a'])
+    ds['hydro'].derive('c', lambda a: 3.0 * a, dependencies=['a'])
+    assert np.allclose(ds['hydro']['b'].values, 2.0)
+    assert np.allclose(ds['hydro']['c'].values, 3.0)
+    assert ds['hydro'].is_derived('b')
+    assert 'b' not in ds['hydro']._evicted
+    assert np.allclose(ds['hydro']['b'].values, 2.0)
+
+
+def test_dataset_covering_grid_nearest():
+    ds = _make_cell_dataset()
+    grid = ds.covering_grid(ds['hydro']['density'], shape=16)
+    assert grid.shape == (1, 16, 16, 16)
+    centers = (np.arange(16) + 0.5) / 16
+    x, y, _ = np.meshgrid(centers, centers, centers, indexing='ij')
+    # Each voxel takes the value of the cell which contains its center
+    expected = (np.floor(x * 8) + 0.5) / 8 + 10 * (np.floor(y * 8) + 0.5) / 8
+    assert np.allclose(grid[0], expected)
+
+
+def test_dataset_covering_grid_conservative(tmp_path):
+    ds = _make_cell_dataset()
+    filename = str(tmp_path / 'grid.npy')
+    grid = ds.covering_grid(ds['hydro']['density'],
+                            shape=4,
+                            method='conservative',
+                            filename=filename,
+                            chunk=1)
+    fine = ds.covering_grid(ds['hydro']['density'], shape=8)
+    expected = fine[0].reshape(4, 2, 4, 2, 4, 2).mean(axis=(1, 3, 5))
+    assert np.allclose(grid[0], expected)
+    assert np.allclose(np.load(filename), grid)
+
+
+@pytest.mark.parametrize("shape", [3, 7, 13])
+def test_dataset_covering_grid_conservative_not_aligned(shape):
+    # A 4x4x4 grid of cells, where one cell is refined into 8 smaller cells
+    centers = (np.arange(4) + 0.5) / 4
+    xyz = np.array(np.meshgrid(centers, centers, centers,
+                               indexing='ij')).reshape(3, -1).T
+    refined = np.all(xyz == 0.375, axis=1)
+    offsets = np.array(np.meshgrid([-1, 1], [-1, 1], [-1, 1], indexing='ij')).reshape(
+        3, -1).T / 16
+    xyz = np.concatenate([xyz[~refined], xyz[refined] + offsets])
+    dx = np.concatenate([np.full(63, 0.25), np.full(8, 0.125)])
+    density = np.random.default_rng(3).random(len(dx))
+    ds = osyris.Dataset()
+    ds['amr'] = osyris.Datagroup({
+        'xyz': osyris.Array(values=xyz, unit='cm'),
+        'dx': osyris.Array(values=dx, unit='cm')
+    })
+    ds['hydro'] = osyris.Datagroup(
+        {'density': osyris.Array(values=density, unit='g/cm**3')})
+    grid = ds.covering_grid(ds['hydro']['density'], shape=shape, method='conservative')
+    assert np.isclose(grid[0].sum() / shape**3, np.sum(density * dx**3))
+    assert grid.min() >= density.min()
+    assert grid.max() <= density.max()
+
+
+def test_dataset_covering_grid_requires_level_or_shape():
+    ds = _make_cell_dataset()
+    with pytest.raises(ValueError):
+        ds.covering_grid(ds['hydro']['density'])
+    with pytest.raises(ValueError):
+        ds.covering_grid(ds['hydro']['density'], level=3, shape=8)
+
+
+def test_dataset_insert_row_selection():
+    ds = _make_cell_dataset()
+    select = ds['hydro']['density'] > 5.0 * osyris.units('g/cm**3')
+    ds['dense'] = ds['hydro'][select]
+    assert isinstance(ds['dense'], osyris.Datagroup)
+    assert ds['dense'].parent is ds
+    assert ds['dense'].shape == int(select.sum())
+    assert np.array_equal(ds['dense']['density'].values,
+                          ds['hydro']['density'].values[select])
+
+
+def test_dataset_materialize_view_keeps_columns_evicted():
+    ds = osyris.Dataset(memory_limit="2KB")
+    values = {key: np.random.random(100) for key in 'abc'}
+    ds['hydro'] = osyris.Datagroup(
+        {key: osyris.Array(values=v, unit='cm')
+         for key, v in values.items()})
+    assert 'a' in ds['hydro']._evicted
+    materialized = ds['hydro'][10:20].materialize()
+    assert 'a' in ds['hydro']._evicted
+    for key in 'abc':
+        assert np.array_equal(materialized[key].values, values[key][10:20])
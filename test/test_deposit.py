@@ -0,0 +1,87 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (c) 2022 Osyris contributors (https://github.com/nvaytet/osyris)
+import numpy as np
+import pytest
+from osyris import Array, Datagroup, Dataset, deposit, units
+
+
+def _dataset(npoints=2000):
+    rng = np.random.default_rng(7)
+    ds = Dataset()
+    ds['part'] = Datagroup({
+        'position':
+        Array(values=0.25 + 0.5 * rng.random((npoints, 3)), unit='cm'),
+        'mass':
+        Array(values=rng.random(npoints), unit='g'),
+        'velocity':
+        Array(values=rng.normal(size=(npoints, 3)), unit='cm/s')
+    })
+    return ds
+
+
+@pytest.mark.parametrize("kernel", ["ngp", "cic", "tsc", "sph"])
+def test_deposit_conserves_mass(kernel):
+    ds = _dataset()
+    grid = deposit(ds['part']['mass'],
+                   kernel=kernel,
+                   region=[[0.0, 0.0, 0.0], [1.0, 1.0, 1.0]],
+                   shape=16)
+    assert grid.shape == (16, 16, 16)
+    assert np.all(grid.values >= 0)
+    assert np.isclose(grid.values.sum(), ds['part']['mass'].values.sum())
+    assert grid.unit == units('g')
+
+
+def test_deposit_cic_weights():
+    ds = _dataset()
+    positions = ds['part']['position'].values
+    mass = ds['part']['mass'].values
+    n = 8
+    grid = deposit(ds['part']['mass'],
+                   kernel='cic',
+                   region=[[0.0, 0.0, 0.0], [1.0, 1.0, 1.0]],
+                   shape=n,
+                   operation='density')
+    # Reference deposition, one corner of the cloud at a time
+    u = positions * n - 0.5
+    first = np.floor(u).astype(int)
+    frac = u - first
+    expected = np.zeros((n, n, n))
+    for corner in np.ndindex(2, 2, 2):
+        weight = np.prod(np.where(corner, frac, 1.0 - frac), axis=1)
+        np.add.at(expected, tuple((first + corner).T), mass * weight)
+    assert np.allclose(grid.values, expected * n**3)
+    assert grid.unit == units('g/cm**3')
+
+
+def test_deposit_mean_of_vectors():
+    ds = _dataset()
+    ds['part']['velocity'] = Array(values=np.tile([1.0, -2.0, 3.0], (2000, 1)),
+                                   unit='cm/s')
+    grid = deposit(ds['part']['velocity'],
+                   kernel='tsc',
+                   region=[[0.0, 0.0, 0.0], [1.0, 1.0, 1.0]],
+                   shape=8,
+                   operation='mean',
+                   weights=ds['part']['mass'])
+    assert grid.shape == (8, 8, 8, 3)
+    filled = ~np.isnan(grid.values[..., 0])
+    assert filled.any() and not filled.all()
+    assert np.allclose(grid.values[filled], [1.0, -2.0, 3.0])
+
+
+@pytest.mark.parametrize("kernel", ["ngp", "cic", "tsc", "sph"])
+def test_deposit_default_region_conserves_mass(kernel):
+    rng = np.random.default_rng(5)
+    # Include particles on the faces and corners of the bounding box
+    positions = np.concatenate([rng.random((3000, 3)), [[0, 0, 0], [1, 1, 1]]])
+    positions[:100, 0] = 1.0
+    mass = rng.random(len(positions))
+    data = Datagroup({
+        'position': Array(values=positions, unit='cm'),
+        'mass': Array(values=mass, unit='g')
+    })
+    for shape in [16, 7]:
+        grid = deposit(data['mass'], kernel=kernel, shape=shape)
+        assert grid.shape == (shape, shape, shape)
+        assert np.isclose(grid.values.sum(), mass.sum())
@@ -0,0 +1,79 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (c) 2022 Osyris contributors (https://github.com/nvaytet/osyris)
+import numpy as np
+import pytest
+from osyris import Array, Datagroup, fof, units
+
+
+def _particles(positions, masses, velocities):
+    return Datagroup({
+        'position': Array(values=positions, unit='cm'),
+        'mass': Array(values=masses, unit='g'),
+        'velocity': Array(values=velocities, unit='cm/s')
+    })
+
+
+def test_fof_groups():
+    rng = np.random.default_rng(3)
+    big = [0.3, 0.3, 0.3] + 0.01 * rng.random((200, 3))
+    small = [0.7, 0.6, 0.5] + 0.01 * rng.random((50, 3))
+    background = rng.random((20, 3))
+    positions = np.concatenate([big, small, background])
+    masses = np.concatenate([np.full(200, 2.0), np.full(50, 1.0), np.full(20, 1.0)])
+    velocities = np.zeros_like(positions)
+    velocities[:200] = [1.0, 0.0, 0.0]
+    velocities[200:250] = [0.0, 2.0, 0.0]
+    ids, groups = fof(_particles(positions, masses, velocities),
+                      linking_length=0.01 * units('cm'),
+                      min_members=20)
+    assert np.array_equal(groups['npart'].values, [200, 50])
+    assert np.all(ids.values[:200] == 0)
+    assert np.all(ids.values[200:250] == 1)
+    assert np.all(ids.values[250:] == -1)
+    assert np.allclose(groups['mass'].values, [400.0, 50.0])
+    assert groups['mass'].unit == units('g')
+    assert np.allclose(groups['position'].values[0], big.mean(axis=0))
+    assert np.allclose(groups['position'].values[1], small.mean(axis=0))
+    assert np.allclose(groups['velocity'].values, [[1.0, 0.0, 0.0], [0.0, 2.0, 0.0]])
+
+
+def test_fof_matches_brute_force():
+    rng = np.random.default_rng(11)
+    positions = rng.random((500, 3))
+    length = 0.06
+    ids, _ = fof(_particles(positions, np.ones(500), np.zeros((500, 3))),
+                 linking_length=length,
+                 min_members=1)
+    # Reference partition from the connected components of the pair graph
+    distances = np.linalg.norm(positions[:, None] - positions[None, :], axis=-1)
+    labels = np.arange(500)
+    for _ in range(500):
+        new = np.where(distances <= length, labels[None, :], 500).min(axis=1)
+        if np.array_equal(new, labels):
+            break
+        labels = new
+    assert np.array_equal(ids.values[:, None] == ids.values[None, :],
+                          labels[:, None] == labels[None, :])
+
+
+def test_fof_periodic():
+    rng = np.random.default_rng(5)
+    positions = np.mod([0.0, 0.5, 0.5] + 0.01 * (rng.random((100, 3)) - 0.5), 1.0)
+    ids, groups = fof(_particles(positions, np.ones(100), np.zeros((100, 3))),
+                      linking_length=0.01,
+                      min_members=10,
+                      boxsize=1.0 * units('cm'))
+    assert np.all(ids.values == 0)
+    center = groups['position'].values[0]
+    assert min(center[0], 1.0 - center[0]) < 0.005
+    assert np.allclose(center[1:], 0.5, atol=0.005)
+    ids, groups = fof(_particles(positions, np.ones(100), np.zeros((100, 3))),
+                      linking_length=0.01,
+                      min_members=10)
+    assert len(groups['npart']) == 2
+
+
+def test_fof_bad_linking_length():
+    data = _particles(np.zeros((10, 3)), np.ones(10), np.zeros((10, 3)))
+    with pytest.raises(ValueError):
+        fof(data, linking_length=0.0)
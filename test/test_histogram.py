@@ -0,0 +1,194 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (c) 2022 Osyris contributors (https://github.com/nvaytet/osyris)
+import importlib
+import numpy as np
+import pytest
+from osyris import Array, histogram1d, histogram2d, units
+from osyris.plot.utils import hist1d, hist2d, _hist2d
+
+
+def _reference_2d(x, y, values, xedges, yedges):
+    # The statistics of each bin, computed with numpy
+    ix = np.clip(np.searchsorted(xedges, x, side='right') - 1, 0, len(xedges) - 2)
+    iy = np.clip(np.searchsorted(yedges, y, side='right') - 1, 0, len(yedges) - 2)
+    shape = (len(yedges) - 1, len(xedges) - 1)
+    stats = {
+        key: np.full((len(values), ) + shape, np.nan)
+        for key in ['mean', 'min', 'max', 'var']
+    }
+    for j in range(shape[0]):
+        for i in range(shape[1]):
+            select = (ix == i) & (iy == j)
+            if select.any():
+                for key, func in [('mean', np.mean), ('min', np.min), ('max', np.max),
+                                  ('var', np.var)]:
+                    stats[key][:, j, i] = func(values[:, select], axis=1)
+    return stats
+
+
+@pytest.mark.parametrize("nthreads", [1, 3])
+def test_hist2d_statistics_match_numpy(nthreads):
+    rng = np.random.default_rng(5)
+    x = rng.random(4000)
+    y = rng.random(4000)
+    values = np.array([rng.normal(size=4000), 1.0e6 + rng.random(4000)])
+    nx, ny = 7, 5
+    xedges = np.linspace(0, 1, nx + 1)
+    yedges = np.linspace(0, 1, ny + 1)
+    counts, sums, means, m2, mins, maxs = _hist2d(x, y, values, 0.0, 1.0, nx, 0.0, 1.0,
+                                                  ny, False, False, nthreads, True,
+                                                  True, True, True)
+    expected_counts = np.histogram2d(y, x, bins=[yedges, xedges])[0]
+    assert np.array_equal(counts, expected_counts)
+    for v in range(len(values)):
+        assert np.allclose(
+            sums[v],
+            np.histogram2d(y, x, bins=[yedges, xedges], weights=values[v])[0])
+    stats = _reference_2d(x, y, values, xedges, yedges)
+    assert np.allclose(means, stats['mean'])
+    assert np.array_equal(mins, stats['min'])
+    assert np.array_equal(maxs, stats['max'])
+    # The variance of values with a large offset is not lost to cancellation
+    assert np.allclose(m2 / counts, stats['var'], rtol=1.0e-9)
+
+
+def test_hist2d_log_and_non_finite():
+    rng = np.random.default_rng(6)
+    x = 10.0**rng.uniform(-2, 2, 3000)
+    y = rng.random(3000)
+    x[:10] = np.nan
+    y[10:20] = np.inf
+    x[20:30] = -1.0
+    values = rng.random((1, 3000))
+    binned = hist2d(x, y, values, -2.0, 2.0, 8, 0.0, 1.0, 4, logx=True)
+    keep = np.isfinite(x) & np.isfinite(y) & (x > 0)
+    xedges = np.logspace(-2, 2, 9)
+    yedges = np.linspace(0, 1, 5)
+    expected = np.histogram2d(y[keep], x[keep], bins=[yedges, xedges])[0]
+    assert np.array_equal(binned['count'], expected)
+    assert binned['count'].sum() == 2970
+    stats = _reference_2d(x[keep], y[keep], values[:, keep], xedges, yedges)
+    assert np.allclose(binned['mean'], stats['mean'], equal_nan=True)
+    assert np.allclose(binned['var'], stats['var'], equal_nan=True)
+
+
+def test_hist2d_allocates_only_requested_statistics(monkeypatch):
+    utils = importlib.import_module('osyris.plot.utils')
+    kernel = utils._hist2d
+    calls = []
+
+    def recording_kernel(*args):
+        result = kernel(*args)
+        calls.append((args[11], [array.size for array in result[1:]]))
+        return result
+
+    monkeypatch.setattr(utils, '_hist2d', recording_kernel)
+    rng = np.random.default_rng(8)
+    x = rng.random(5000)
+    y = rng.random(5000)
+    values = rng.random((2, 5000))
+    full = hist2d(x, y, values, 0.0, 1.0, 6, 0.0, 1.0, 4)
+    binned = hist2d(x, y, values, 0.0, 1.0, 6, 0.0, 1.0, 4, statistics=['min'])
+    assert set(binned) == {'count', 'min'}
+    assert np.array_equal(binned['count'], full['count'])
+    assert np.array_equal(binned['min'], full['min'])
+    # Only the minima are allocated
+    assert calls[-1][1] == [0, 0, 0, 2 * 6 * 4, 0]
+    binned = hist2d(x, y, values, 0.0, 1.0, 6, 0.0, 1.0, 4, statistics=['mean'])
+    assert set(binned) == {'count', 'mean'}
+    assert np.allclose(binned['mean'], full['mean'], equal_nan=True)
+    # The number of threads is limited by the memory of their private bins
+    monkeypatch.setattr(utils, '_HIST2D_MEMORY', 6 * 4 * 8 * 3)
+    binned = hist2d(x, y, values, 0.0, 1.0, 6, 0.0, 1.0, 4, statistics=['sum'])
+    assert calls[-1][0] == 1
+    assert np.allclose(binned['sum'], full['sum'])
+    with pytest.raises(ValueError):
+        hist2d(x, y, values, 0.0, 1.0, 6, 0.0, 1.0, 4, statistics=['median'])
+
+
+def _padded_edges(values, nbins):
+    # The automatic limits have a 5% margin on each side
+    width = values.max() - values.min()
+    return np.linspace(values.min() - 0.05 * width,
+                       values.max() + 0.05 * width, nbins + 1)
+
+
+@pytest.mark.parametrize("operation", ['sum', 'mean', 'min', 'max', 'var', 'count'])
+def test_histogram2d_operations(operation):
+    rng = np.random.default_rng(8)
+    x = Array(values=rng.random(2000), unit='cm')
+    y = Array(values=rng.random(2000), unit='s')
+    values = Array(values=rng.normal(size=2000), unit='g')
+    hist = histogram2d(x, y, values, operation=operation, resolution=6, plot=False)
+    xedges = _padded_edges(x.values, 6)
+    yedges = _padded_edges(y.values, 6)
+    assert np.allclose(hist.x, 0.5 * (xedges[1:] + xedges[:-1]))
+    assert np.allclose(hist.y, 0.5 * (yedges[1:] + yedges[:-1]))
+    if operation == 'count':
+        expected = np.histogram2d(y.values, x.values, bins=[yedges, xedges])[0]
+    elif operation == 'sum':
+        expected = np.histogram2d(y.values,
+                                  x.values,
+                                  bins=[yedges, xedges],
+                                  weights=values.values)[0]
+    else:
+        expected = _reference_2d(x.values, y.values, values.values[None, :], xedges,
+                                 yedges)[operation][0]
+    data = hist.layers[0]['data']
+    assert np.allclose(data.filled(np.nan), expected, equal_nan=True)
+
+
+@pytest.mark.parametrize("uniform", [True, False])
+@pytest.mark.parametrize("log", [True, False])
+def test_hist1d_matches_numpy(uniform, log):
+    rng = np.random.default_rng(9)
+    x = 10.0**rng.uniform(-1, 1, 5000) if log else rng.normal(size=5000)
+    weights = rng.random(5000)
+    x[:5] = np.nan
+    x[5:10] = np.inf
+    if uniform:
+        edges = np.logspace(-1, 1, 13) if log else np.linspace(-2, 2, 13)
+    else:
+        edges = np.sort(rng.choice(x[10:], 13, replace=False))
+    # Points exactly on the edges, including the right edge of the last bin
+    x[10:23] = edges
+    binned = hist1d(x, edges, weights=weights, log=log, uniform=uniform)
+    finite = np.isfinite(x)
+    counts = np.histogram(x[finite], bins=edges)[0]
+    sums = np.histogram(x[finite], bins=edges, weights=weights[finite])[0]
+    assert np.array_equal(binned['count'], counts)
+    assert np.allclose(binned['sum'], sums)
+    index = np.clip(np.searchsorted(edges, x, side='right') - 1, 0, len(edges) - 2)
+    inside = finite & (x >= edges[0]) & (x <= edges[-1])
+    for b in range(len(edges) - 1):
+        select = inside & (index == b)
+        assert np.isclose(binned['mean'][b], weights[select].mean())
+        assert np.isclose(binned['std'][b], weights[select].std())
+    # Without weights, the sums are the counts
+    assert np.array_equal(hist1d(x, edges, log=log, uniform=uniform)['sum'], counts)
+
+
+@pytest.mark.parametrize("operation", ['sum', 'mean', 'std', 'count'])
+def test_histogram1d_operations(operation):
+    rng = np.random.default_rng(10)
+    x = Array(values=rng.normal(size=3000), unit='cm')
+    weights = Array(values=rng.random(3000), unit='g')
+    edges = np.linspace(-3, 3, 11)
+    hist = histogram1d(x, bins=edges, weights=weights, operation=operation, plot=False)
+    assert np.allclose(hist.x, 0.5 * (edges[1:] + edges[:-1]))
+    counts = np.histogram(x.values, bins=edges)[0]
+    sums = np.histogram(x.values, bins=edges, weights=weights.values)[0]
+    index = np.searchsorted(edges, x.values, side='right') - 1
+    std = [weights.values[index == b].std() for b in range(len(edges) - 1)]
+    expected = {
+        'sum': sums,
+        'mean': sums / counts,
+        'std': std,
+        'count': counts
+    }[operation]
+    assert np.allclose(hist.layers[0]['data'], expected)
+    # The bins have the unit of the weights, except for the counts
+    expected_unit = units('dimensionless') if operation == 'count' else units('g')
+    assert hist.layers[0]['unit'] == expected_unit.units
+    unweighted = histogram1d(x, bins=edges, operation=operation, plot=False)
+    assert unweighted.layers[0]['unit'] == units('dimensionless').units
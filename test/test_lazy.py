@@ -0,0 +1,63 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (c) 2022 Osyris contributors (https://github.com/nvaytet/osyris)
+import osyris
+import numpy as np
+import pint
+import pytest
+
+
+def test_lazy_addition_matches_eager():
+    a = osyris.Array(values=np.random.random((100, 3)), unit='G')
+    b = osyris.Array(values=np.random.random((100, 3)), unit='mG')
+    expected = 0.5 * (a + b)
+    result = 0.5 * (a.lazy() + b)
+    assert isinstance(result, osyris.LazyArray)
+    result = result.compute()
+    assert result.unit == expected.unit
+    assert np.allclose(result.values, expected.values)
+
+
+def test_lazy_mass_with_conversion():
+    density = osyris.Array(values=np.random.random(100), unit='g/cm**3')
+    dx = osyris.Array(values=np.random.random(100), unit='au')
+    expected = density * dx**3
+    expected.to('msun')
+    result = (density.lazy() * dx.lazy()**3).compute(unit='msun')
+    assert result.unit == expected.unit
+    assert np.allclose(result.values, expected.values)
+
+
+def test_lazy_broadcast_vector_and_scalar_fields():
+    v = osyris.Array(values=np.random.random((50, 3)), unit='cm/s')
+    rho = osyris.Array(values=np.random.random(50), unit='g/cm**3')
+    expected = rho * v
+    result = (rho.lazy() * v).compute()
+    assert result.shape == (50, 3)
+    assert np.allclose(result.values, expected.values)
+
+
+def test_lazy_reflected_operations():
+    a = osyris.Array(values=[1., 2., 4.], unit='m')
+    b = osyris.Array(values=[1., 1., 1.], unit='m')
+    assert np.allclose((b - a.lazy()).compute().values, [0., -1., -3.])
+    assert np.allclose((2.0 / a.lazy()).compute().values, [2., 1., 0.5])
+    result = np.sqrt(a.lazy() * a).compute()
+    assert np.allclose(result.to('m').values, [1., 2., 4.])
+
+
+def test_lazy_incompatible_units():
+    a = osyris.Array(values=[1., 2., 4.], unit='m')
+    b = osyris.Array(values=[1., 1., 1.], unit='s')
+    with pytest.raises(pint.errors.DimensionalityError):
+        _ = a.lazy() + b
+    with pytest.raises(TypeError):
+        _ = a.lazy() + 1.0
+
+
+def test_lazy_insertion_in_datagroup():
+    a = osyris.Array(values=[1., 2., 4.], unit='m')
+    dg = osyris.Datagroup({'a': a})
+    dg['b'] = 3.0 * dg['a'].lazy()
+    assert isinstance(dg['b'], osyris.Array)
+    assert dg['b'].name == 'b'
+    assert np.allclose(dg['b'].values, [3., 6., 12.])
@@ -0,0 +1,57 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (c) 2022 Osyris contributors (https://github.com/nvaytet/osyris)
+import numpy as np
+import pytest
+from osyris.plot.utils import lic, lic_noise, _lic
+
+
+def _horizontal_reference(noise, length):
+    # Streamlines along the rows, sampled every half pixel in both directions
+    ny, nx = noise.shape
+    out = np.zeros_like(noise)
+    for j in range(ny):
+        for i in range(nx):
+            samples = [noise[j, i]]
+            for sign in (-1, 1):
+                for step in range(1, 2 * length + 1):
+                    x = i + 0.5 + sign * 0.5 * step
+                    if x < 0 or x >= nx:
+                        break
+                    samples.append(noise[j, int(x)])
+            out[j, i] = np.mean(samples)
+    return out
+
+
+def test_lic_uniform_horizontal_field():
+    shape = (12, 20)
+    vectors = np.zeros(shape + (3, ))
+    vectors[..., 0] = 2.5
+    expected = _horizontal_reference(lic_noise(shape, 3), 4)
+    assert np.allclose(_lic(vectors[..., :2].copy(), lic_noise(shape, 3), 4), expected)
+    out = lic(vectors, length=4, seed=3)
+    expected = (expected - expected.min()) / (expected.max() - expected.min())
+    assert np.allclose(out, expected)
+    assert out.min() == 0.0
+    assert out.max() == 1.0
+
+
+def test_lic_vertical_field_is_transposed_horizontal_field():
+    noise = np.random.default_rng(1).random((16, 16))
+    horizontal = np.zeros((16, 16, 2))
+    horizontal[..., 0] = 1.0
+    vertical = np.zeros((16, 16, 2))
+    vertical[..., 1] = -3.0
+    assert np.allclose(_lic(vertical, noise, 5), _lic(horizontal, noise.T, 5).T)
+
+
+def test_lic_zero_and_masked_field_returns_noise():
+    shape = (8, 10)
+    noise = lic_noise(shape)
+    # The noise texture is generated once and re-used
+    assert lic_noise(shape) is noise
+    # The cached texture cannot be modified
+    with pytest.raises(ValueError):
+        noise[0, 0] = 2.0
+    vectors = np.ma.masked_all(shape + (2, ))
+    out = lic(vectors, length=3)
+    assert np.allclose(out, (noise - noise.min()) / (noise.max() - noise.min()))
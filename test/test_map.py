@@ -0,0 +1,214 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (c) 2022 Osyris contributors (https://github.com/nvaytet/osyris)
+import importlib
+import numpy as np
+import osyris
+import pytest
+from osyris.plot import map_cache
+from osyris.plot.utils import deposit_on_grid
+
+
+def _oblique_deposit(xyz, half_sizes, values, normal, zrange, resolution, operation):
+    normal = np.asarray(normal, dtype=np.float64) / np.linalg.norm(normal)
+    horizontal = np.cross([0.0, 0.0, 1.0], normal)
+    horizontal /= np.linalg.norm(horizontal)
+    dir_vecs = np.array([normal, horizontal, np.cross(normal, horizontal)])
+    positions = np.array([xyz @ dir_vecs[1], xyz @ dir_vecs[2], xyz @ dir_vecs[0]]).T
+    return deposit_on_grid(cell_values=values,
+                           cell_weights=np.ones(len(xyz)),
+                           cell_positions_in_new_basis=positions,
+                           cell_sizes=half_sizes,
+                           dir_vecs=dir_vecs,
+                           grid_lower_edge_in_new_basis=[-1.0, -1.0, zrange[0]],
+                           grid_upper_edge_in_new_basis=[1.0, 1.0, zrange[1]],
+                           nx=resolution,
+                           ny=resolution,
+                           operation=operation)
+
+
+def test_deposit_on_grid_oblique_overlap_volume():
+    # A unit cube seen along a diagonal, in a slab of thickness 0.2
+    out = _oblique_deposit(np.zeros((1, 3)), np.array([0.5]), np.ones((1, 1)),
+                           [1.0, 1.0, 0.0], [-0.1, 0.1], 9, 'sum')
+    volume = 0.2 * np.sqrt(2.0) - 0.02
+    assert np.isclose(np.nansum(out) * (2.0 / 9)**2, volume)
+
+
+def test_deposit_on_grid_oblique_is_exact_per_pixel():
+    rng = np.random.default_rng(4)
+    centers = (np.arange(4) + 0.5) / 4 - 0.5
+    xyz = np.array(np.meshgrid(centers, centers, centers,
+                               indexing='ij')).reshape(3, -1).T
+    half_sizes = np.full(len(xyz), 0.125)
+    values = rng.random((1, len(xyz)))
+    normal = [1.0, 2.0, 3.0]
+    coarse = _oblique_deposit(xyz, half_sizes, values, normal, [-0.2, 0.3], 10, 'sum')
+    fine = _oblique_deposit(xyz, half_sizes, values, normal, [-0.2, 0.3], 20, 'sum')
+    # The pixels of the coarse map are the averages of the pixels of the fine map
+    fine = np.nan_to_num(fine[0]).reshape(10, 2, 10, 2).mean(axis=(1, 3))
+    assert np.allclose(np.nan_to_num(coarse[0]), fine)
+    # All the cells are inside the map: the integral is the volume integral
+    full = _oblique_deposit(xyz, half_sizes, values, normal, [-1.0, 1.0], 7, 'sum')
+    assert np.isclose(np.nansum(full) * (2.0 / 7)**2, values.sum() / 64)
+    top = _oblique_deposit(xyz, half_sizes, values, normal, [-1.0, 1.0], 7, 'max')
+    assert np.nanmax(top) == values.max()
+
+
+def _cell_dataset():
+    # A uniform 8x8x8 grid of cells, shuffled randomly
+    rng = np.random.default_rng(11)
+    n = 8
+    centers = (np.arange(n) + 0.5) / n
+    xyz = np.array(np.meshgrid(centers, centers, centers,
+                               indexing='ij')).reshape(3, -1).T
+    xyz = xyz[rng.permutation(len(xyz))]
+    ds = osyris.Dataset()
+    ds.meta.update({'ndim': 3})
+    ds['amr'] = osyris.Datagroup({
+        'xyz':
+        osyris.Array(values=xyz, unit='cm'),
+        'dx':
+        osyris.Array(values=np.full(len(xyz), 1.0 / n), unit='cm')
+    })
+    ds['hydro'] = osyris.Datagroup({
+        'density':
+        osyris.Array(values=1.0 + xyz[:, 0] + 10 * xyz[:, 1]**2, unit='g/cm**3'),
+        'velocity':
+        osyris.Array(values=rng.normal(size=(len(xyz), 3)), unit='cm/s')
+    })
+    return ds
+
+
+def _map_args():
+    return dict(dx=0.8 * osyris.units('cm'),
+                origin=osyris.Array(values=np.array([[0.5, 0.5, 0.5]]), unit='cm'),
+                resolution=16,
+                plot=False)
+
+
+def test_map_cache_hit_and_invalidation(monkeypatch):
+    map_module = importlib.import_module('osyris.plot.map')
+    calls = []
+    project = map_module._project
+
+    def counting_project(**kwargs):
+        calls.append(1)
+        return project(**kwargs)
+
+    monkeypatch.setattr(map_module, '_project', counting_project)
+    map_cache.clear()
+    ds = _cell_dataset()
+    args = _map_args()
+    first = osyris.map({'data': ds['hydro']['density']}, **args)
+    assert len(calls) == 1
+    # Only the style changes: the binned data is re-used
+    second = osyris.map({'data': ds['hydro']['density'], 'norm': 'log'}, **args)
+    assert len(calls) == 1
+    assert np.array_equal(first.layers[0]['data'], second.layers[0]['data'])
+    # A different geometry is a miss
+    osyris.map({'data': ds['hydro']['density']}, direction='x', **args)
+    assert len(calls) == 2
+    # Replacing the values invalidates the entry
+    ds['hydro']['density'] = 2.0 * ds['hydro']['density']
+    third = osyris.map({'data': ds['hydro']['density']}, **args)
+    assert len(calls) == 3
+    assert np.allclose(third.layers[0]['data'], 2.0 * first.layers[0]['data'])
+    # Converting the unit invalidates the entry
+    ds['hydro']['density'].to('kg/m**3')
+    fourth = osyris.map({'data': ds['hydro']['density']}, **args)
+    assert len(calls) == 4
+    assert np.allclose(fourth.layers[0]['data'], 2000.0 * first.layers[0]['data'])
+    map_cache.clear()
+
+
+@pytest.mark.parametrize("dz,method,window",
+                         [(None, 'sample', 0.8), (0.4, 'sample', 0.8),
+                          (0.4, 'deposit', 0.8), (None, 'sample', None)])
+def test_map_many_equals_map(dz, method, window):
+    map_cache.clear()
+    ds = _cell_dataset()
+    args = _map_args()
+    args['method'] = method
+    if window is None:
+        del args['dx']
+    if dz is not None:
+        args['dz'] = dz * osyris.units('cm')
+    directions = ['x', 'y', 'z', [1.0, 2.0, 3.0]]
+    layers = [{
+        'data': ds['hydro']['density']
+    }, {
+        'data': ds['hydro']['velocity'],
+        'mode': 'vec'
+    }]
+    many = osyris.map_many(*layers, directions=directions, **args)
+    assert len(many) == len(directions)
+    for direction, plot in zip(directions, many):
+        single = osyris.map(*layers, direction=direction, **args)
+        assert np.array_equal(plot.x, single.x)
+        assert np.array_equal(plot.y, single.y)
+        for a, b in zip(plot.layers, single.layers):
+            assert a['unit'] == b['unit']
+            assert np.ma.allclose(a['data'], b['data'])
+            assert np.array_equal(np.ma.getmaskarray(a['data']),
+                                  np.ma.getmaskarray(b['data']))
+    map_cache.clear()
+
+
+def test_map_many_gathers_and_samples_once(monkeypatch):
+    map_module = importlib.import_module('osyris.plot.map')
+    calls = {'gather': 0, 'evaluate': 0}
+    gather = map_module._gather
+    evaluate = map_module.evaluate_on_grid
+
+    def counting_gather(**kwargs):
+        calls['gather'] += 1
+        return gather(**kwargs)
+
+    def counting_evaluate(**kwargs):
+        calls['evaluate'] += 1
+        return evaluate(**kwargs)
+
+    monkeypatch.setattr(map_module, '_gather', counting_gather)
+    monkeypatch.setattr(map_module, 'evaluate_on_grid', counting_evaluate)
+    ds = _cell_dataset()
+    select = ds['hydro']['density'] > 1.5 * osyris.units('g/cm**3')
+    view = ds['hydro'][select]
+    many = osyris.map_many({'data': view['density']},
+                           directions=['x', 'y', 'z'],
+                           **_map_args())
+    assert calls == {'gather': 1, 'evaluate': 1}
+    # Only the selected cells are mapped
+    masked = ds['hydro']['density'].values.copy()
+    masked[~select] = np.nan
+    ds['hydro']['masked'] = osyris.Array(values=masked, unit='g/cm**3')
+    for direction, plot in zip(['x', 'y', 'z'], many):
+        expected = osyris.map({
+            'data': ds['hydro']['masked']
+        },
+                              direction=direction,
+                              **_map_args()).layers[0]['data']
+        assert np.array_equal(np.ma.getmaskarray(plot.layers[0]['data']),
+                              np.ma.getmaskarray(expected))
+        assert np.ma.allclose(plot.layers[0]['data'], expected)
+    map_cache.clear()
+
+
+@pytest.mark.parametrize("origin", [0.5, 0.2, 0.8])
+def test_map_of_row_selection(origin):
+    map_cache.clear()
+    ds = _cell_dataset()
+    select = ds['hydro']['density'] > 1.5 * osyris.units('g/cm**3')
+    view = ds['hydro'][select]
+    args = _map_args()
+    args['origin'] = osyris.Array(values=np.full((1, 3), origin), unit='cm')
+    selected = osyris.map({'data': view['density']}, **args).layers[0]['data']
+    # Only the selected cells are mapped, the other pixels are masked
+    masked = ds['hydro']['density'].values.copy()
+    masked[~select] = np.nan
+    ds['hydro']['masked'] = osyris.Array(values=masked, unit='g/cm**3')
+    expected = osyris.map({'data': ds['hydro']['masked']}, **args).layers[0]['data']
+    assert np.array_equal(np.ma.getmaskarray(selected), np.ma.getmaskarray(expected))
+    assert np.ma.allclose(selected, expected)
+    with pytest.raises(ValueError):
+        osyris.map({'data': view['density']}, {'data': ds['hydro']['density']}, **args)
+    map_cache.clear()
@@ -0,0 +1,134 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (c) 2022 Osyris contributors (https://github.com/nvaytet/osyris)
+import tracemalloc
+import numpy as np
+from osyris import Array, Datagroup, Dataset, profile, units
+
+
+def _dataset(npoints=5000):
+    rng = np.random.default_rng(42)
+    ds = Dataset()
+    ds['amr'] = Datagroup({'xyz': Array(values=rng.random((npoints, 3)), unit='cm')})
+    ds['hydro'] = Datagroup({
+        'density': Array(values=rng.random(npoints), unit='g/cm**3'),
+        'mass': Array(values=rng.random(npoints), unit='g')
+    })
+    return ds
+
+
+def test_spherical_profile():
+    ds = _dataset()
+    center = Array(values=np.array([[0.5, 0.5, 0.5]]), unit='cm')
+    p = profile(ds['hydro'], center=center, bins=8, weights=ds['hydro']['mass'])
+    r = np.linalg.norm(ds['amr']['xyz'].values - 0.5, axis=1)
+    edges = np.linspace(0, r.max(), 9)
+    mass = ds['hydro']['mass'].values
+    density = ds['hydro']['density'].values
+    assert np.array_equal(p['count'].values, np.histogram(r, bins=edges)[0])
+    assert np.allclose(p['radius'].values, 0.5 * (edges[1:] + edges[:-1]))
+    assert np.allclose(
+        p['density'].values,
+        np.histogram(r, bins=edges, weights=density * mass)[0] /
+        np.histogram(r, bins=edges, weights=mass)[0])
+    assert np.allclose(p['density_sum'].values,
+                       np.histogram(r, bins=edges, weights=density)[0])
+    assert np.allclose(p['mass_enclosed'].values,
+                       np.cumsum(np.histogram(r, bins=edges, weights=mass)[0]))
+    assert p['mass_enclosed'].unit == units('g')
+    assert p['radius'].unit == units('cm')
+
+
+def test_cylindrical_profile_with_bin_edges():
+    ds = _dataset()
+    center = [0.5, 0.5, 0.5] * units('cm')
+    edges = np.array([0.0, 0.1, 0.2, 0.4])
+    p = profile(ds['hydro']['density'],
+                center=center,
+                bins=edges * units('cm'),
+                kind='cylindrical',
+                axis='x',
+                height=0.5 * units('cm'))
+    delta = ds['amr']['xyz'].values - 0.5
+    r = np.hypot(delta[:, 1], delta[:, 2])
+    inside = np.abs(delta[:, 0]) <= 0.25
+    density = ds['hydro']['density'].values[inside]
+    counts = np.histogram(r[inside], bins=edges)[0]
+    assert np.array_equal(p['count'].values, counts)
+    assert np.allclose(p['density'].values,
+                       np.histogram(r[inside], bins=edges, weights=density)[0] / counts)
+
+
+def test_profile_of_row_selection():
+    ds = _dataset()
+    select = ds['hydro']['density'] > 0.5 * units('g/cm**3')
+    center = [0.5, 0.5, 0.5] * units('cm')
+    p = profile(ds['hydro'][select], center=center, bins=6)
+    r = np.linalg.norm(ds['amr']['xyz'].values[select] - 0.5, axis=1)
+    edges = np.linspace(0, r.max(), 7)
+    density = ds['hydro']['density'].values[select]
+    assert np.array_equal(p['count'].values, np.histogram(r, bins=edges)[0])
+    assert np.allclose(p['density_sum'].values,
+                       np.histogram(r, bins=edges, weights=density)[0])
+
+
+def test_profile_of_group_skips_derived_and_keeps_columns_evicted():
+    ds = Dataset(memory_limit="100KB")
+    rng = np.random.default_rng(7)
+    npoints = 5000
+    xyz = Array(values=rng.random((npoints, 3)), unit='cm')
+    values = {key: rng.random(npoints) for key in 'abc'}
+    ds['hydro'] = Datagroup(
+        {key: Array(values=v, unit='g')
+         for key, v in values.items()})
+    calls = []
+
+    def double(a):
+        calls.append(1)
+        return 2.0 * a
+
+    ds['hydro'].derive('twice', double, ['a'])
+    evicted = list(ds['hydro']._evicted)
+    assert len(evicted) > 0
+    center = [0.5, 0.5, 0.5] * units('cm')
+    p = profile(ds['hydro'], center=center, bins=5, position=xyz)
+    # Derived fields are neither computed nor profiled
+    assert len(calls) == 0
+    assert 'twice' not in p
+    # Evicted columns are read from their spill files
+    assert list(ds['hydro']._evicted) == evicted
+    r = np.linalg.norm(xyz.values - 0.5, axis=1)
+    edges = np.linspace(0, r.max(), 6)
+    for key in 'abc':
+        assert np.allclose(p[key + '_sum'].values,
+                           np.histogram(r, bins=edges, weights=values[key])[0])
+        assert p[key].unit == units('g')
+
+
+def test_profile_bins_fields_without_stacking_them():
+    npoints = 100000
+    rng = np.random.default_rng(3)
+    ds = Dataset()
+    ds['amr'] = Datagroup({'xyz': Array(values=rng.random((npoints, 3)), unit='cm')})
+    ds['hydro'] = Datagroup({
+        'f{}'.format(i): Array(values=rng.random(npoints), unit='g')
+        for i in range(8)
+    })
+    ds['hydro']['velocity'] = Array(values=rng.random((npoints, 3)).astype(np.float32),
+                                    unit='cm/s')
+    center = [0.5, 0.5, 0.5] * units('cm')
+    profile(ds['hydro'], center=center, bins=4)
+    tracemalloc.start()
+    p = profile(ds['hydro'], center=center, bins=4)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    # Much less than a float64 copy of all the fields
+    assert peak < 0.25 * 11 * npoints * 8
+    r = np.linalg.norm(ds['amr']['xyz'].values - 0.5, axis=1)
+    edges = np.linspace(0, r.max(), 5)
+    velocity = ds['hydro']['velocity'].values.astype(np.float64)
+    assert p['velocity'].shape == (4, 3)
+    for d in range(3):
+        assert np.allclose(p['velocity_sum'].values[:, d],
+                           np.histogram(r, bins=edges, weights=velocity[:, d])[0])
+    assert np.allclose(p['f3_sum'].values,
+                       np.histogram(r, bins=edges, weights=ds['hydro']['f3'].values)[0])
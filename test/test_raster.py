@@ -0,0 +1,87 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (c) 2022 Osyris contributors (https://github.com/nvaytet/osyris)
+import struct
+import zlib
+import numpy as np
+import pytest
+from matplotlib import colormaps
+from matplotlib.colors import LogNorm, Normalize
+from matplotlib.image import imread
+from osyris import rasterize, write_image
+from osyris.core import Plot
+from osyris.plot.raster import write_png
+
+
+def _read_png(filename):
+    # A minimal decoder for the unfiltered 8-bit RGBA images written by write_png
+    with open(filename, 'rb') as f:
+        content = f.read()
+    assert content[:8] == b'\x89PNG\r\n\x1a\n'
+    position = 8
+    chunks = []
+    while position < len(content):
+        length, = struct.unpack('>I', content[position:position + 4])
+        tag = content[position + 4:position + 8]
+        data = content[position + 8:position + 8 + length]
+        crc, = struct.unpack('>I',
+                             content[position + 8 + length:position + 12 + length])
+        assert crc == zlib.crc32(tag + data) & 0xffffffff
+        chunks.append((tag, data))
+        position += 12 + length
+    assert [tag for tag, _ in chunks] == [b'IHDR', b'IDAT', b'IEND']
+    width, height, depth, color, _, _, _ = struct.unpack('>IIBBBBB', chunks[0][1])
+    assert (depth, color) == (8, 6)
+    rows = np.frombuffer(zlib.decompress(chunks[1][1]), dtype=np.uint8)
+    rows = rows.reshape(height, width * 4 + 1)
+    assert np.all(rows[:, 0] == 0)
+    return rows[:, 1:].reshape(height, width, 4)
+
+
+@pytest.mark.parametrize("compression", [0, 6, 9])
+def test_write_png_round_trip(tmp_path, compression):
+    rng = np.random.default_rng(3)
+    image = rng.integers(0, 256, size=(7, 11, 4), dtype=np.uint8)
+    filename = str(tmp_path / 'image.png')
+    write_png(filename, image, compression=compression)
+    assert np.array_equal(_read_png(filename), image)
+    # The file can also be read by a standard decoder
+    assert np.array_equal(np.round(imread(filename) * 255).astype(np.uint8), image)
+
+
+def _plot(data, norm):
+    return Plot(layers=[{
+        'data': data,
+        'mode': 'image',
+        'params': {
+            'norm': norm,
+            'cmap': 'viridis'
+        }
+    }])
+
+
+def test_rasterize_colors_and_mask():
+    data = np.ma.masked_invalid(np.array([[1.0, 2.0, 3.0], [np.nan, 5.0, 9.0]]))
+    image = rasterize(_plot(data, Normalize()))
+    assert image.shape == (2, 3, 4)
+    # The first row of the image is the top row of the data
+    assert image[1, 0, 3] == 255
+    assert image[0, 0, 3] == 0
+    lut = np.round(colormaps['viridis'](np.linspace(0.0, 1.0, 256)) * 255)
+    assert np.array_equal(image[1, 0], lut[0])
+    assert np.array_equal(image[0, 2], lut[-1])
+    # With a log scale, 3 is in the middle of [1, 9]
+    image = rasterize(_plot(data, LogNorm()))
+    assert np.array_equal(image[1, 2], lut[128])
+
+
+def test_write_image_matches_rasterize(tmp_path):
+    data = np.arange(12.0).reshape(3, 4)
+    plot = _plot(data, Normalize())
+    write_image(plot, str(tmp_path / 'image.png'), scale=2, background='white')
+    write_image(plot, str(tmp_path / 'image.npy'), scale=2, background='white')
+    expected = rasterize(plot, scale=2, background='white')
+    assert expected.shape == (6, 8, 4)
+    assert np.array_equal(_read_png(str(tmp_path / 'image.png')), expected)
+    assert np.array_equal(np.load(str(tmp_path / 'image.npy')), expected)
+    with pytest.raises(ValueError):
+        write_image(plot, str(tmp_path / 'image.jpg'))
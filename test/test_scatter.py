@@ -0,0 +1,76 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (c) 2022 Osyris contributors (https://github.com/nvaytet/osyris)
+import numpy as np
+import pytest
+from matplotlib import pyplot as plt
+from osyris import Array, scatter
+from osyris.plot.scatter import aggregate
+
+
+def _points(npoints=5000):
+    rng = np.random.default_rng(13)
+    x = rng.random(npoints)
+    y = 10.0**rng.uniform(-2, 1, npoints)
+    c = rng.normal(size=npoints)
+    x[:7] = np.nan
+    y[7:14] = -1.0
+    return x, y, c
+
+
+@pytest.mark.parametrize("operation", ['count', 'sum', 'mean'])
+def test_density_scatter_sums(operation):
+    x, y, c = _points()
+    params = {} if operation == 'count' else {'c': c}
+    xcenters, ycenters, layer = aggregate(x,
+                                          y,
+                                          params,
+                                          logy=True,
+                                          xmin=0.0,
+                                          xmax=1.0,
+                                          ymin=1.0e-2,
+                                          ymax=10.0,
+                                          resolution={
+                                              'x': 9,
+                                              'y': 6
+                                          },
+                                          operation=operation)
+    xedges = np.linspace(0, 1, 10)
+    yedges = np.logspace(-2, 1, 7)
+    assert np.allclose(xcenters, 0.5 * (xedges[1:] + xedges[:-1]))
+    assert np.allclose(ycenters, 0.5 * (yedges[1:] + yedges[:-1]))
+    keep = np.isfinite(x) & (y > 0)
+    counts = np.histogram2d(y[keep], x[keep], bins=[yedges, xedges])[0]
+    sums = np.histogram2d(y[keep], x[keep], bins=[yedges, xedges], weights=c[keep])[0]
+    expected = {'count': counts, 'sum': sums, 'mean': sums / counts}[operation]
+    data = layer['data']
+    assert np.array_equal(np.ma.getmaskarray(data), counts == 0)
+    assert np.allclose(data.compressed(), expected[counts > 0])
+    if operation == 'count':
+        assert data.sum() == keep.sum()
+    if operation == 'sum':
+        assert np.isclose(data.sum(), c[keep].sum())
+
+
+def test_density_scatter_plot():
+    x, y, c = _points()
+    plot = scatter(Array(values=x, unit='cm'),
+                   Array(values=y, unit='s'),
+                   c=Array(values=c, unit='g'),
+                   mode='density',
+                   operation='sum',
+                   resolution=16)
+    plt.close(plot.fig)
+    layer = plot.layers[0]
+    assert layer['data'].shape == (16, 16)
+    assert layer['unit'] == Array(values=c, unit='g').unit.units
+    assert np.isclose(layer['data'].sum(), c[np.isfinite(x)].sum())
+
+
+def test_density_scatter_bad_arguments():
+    x, y, c = _points(100)
+    with pytest.raises(ValueError):
+        aggregate(x, y, {}, operation='sum')
+    with pytest.raises(ValueError):
+        aggregate(x, y, {'c': c}, operation='max')
+    with pytest.raises(ValueError):
+        scatter(Array(values=x), Array(values=y), mode='hexbin')
@@ -0,0 +1,73 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (c) 2022 Osyris contributors (https://github.com/nvaytet/osyris)
+import numpy as np
+from osyris.core.spatial import CellIndex, KDTree
+
+
+def _two_level_cells():
+    # A 4x4 grid of coarse cells, where the lower left coarse cell is refined
+    centers = (np.arange(4) + 0.5) / 4
+    coarse = np.array(np.meshgrid(centers, centers, indexing='ij')).reshape(2, -1).T
+    coarse = coarse[1:]
+    fine_centers = (np.arange(2) + 0.5) / 8
+    fine = np.array(np.meshgrid(fine_centers, fine_centers,
+                                indexing='ij')).reshape(2, -1).T
+    positions = np.concatenate([coarse, fine])
+    half_sizes = np.concatenate(
+        [np.full(len(coarse), 1 / 8),
+         np.full(len(fine), 1 / 16)])
+    return positions, half_sizes
+
+
+def test_cell_index_finds_containing_cells():
+    positions, half_sizes = _two_level_cells()
+    index = CellIndex(positions=positions, half_sizes=half_sizes)
+    points = np.random.random((1000, 2))
+    found = index.find(points)
+    assert np.all(found >= 0)
+    assert np.all(np.abs(points - positions[found]) <= half_sizes[found][:, None])
+
+
+def test_cell_index_finds_finest_cell():
+    positions, half_sizes = _two_level_cells()
+    index = CellIndex(positions=positions, half_sizes=half_sizes)
+    found = index.find([[0.2, 0.2], [0.05, 0.05]])
+    assert half_sizes[found[0]] == 1 / 16
+    assert np.allclose(positions[found[0]], [3 / 16, 3 / 16])
+    assert np.allclose(positions[found[1]], [1 / 16, 1 / 16])
+
+
+def test_cell_index_outside_points():
+    positions, half_sizes = _two_level_cells()
+    index = CellIndex(positions=positions, half_sizes=half_sizes)
+    found = index.find([[-0.1, 0.5], [0.5, 1.2]])
+    assert np.all(found == -1)
+
+
+def test_cell_index_shifted():
+    positions, half_sizes = _two_level_cells()
+    index = CellIndex(positions=positions, half_sizes=half_sizes)
+    offset = np.array([0.3, -0.2])
+    points = np.random.random((100, 2))
+    found = index.shifted(offset).find(points - offset)
+    assert np.array_equal(found, index.find(points))
+
+
+def test_kdtree_nearest_neighbours():
+    rng = np.random.default_rng(1)
+    positions = rng.random((1000, 3))
+    # Duplicated coordinates must not break the median splits
+    positions[:100, 0] = 0.5
+    points = rng.random((50, 3))
+    distances, indices = KDTree(positions).query(points, k=5)
+    brute = np.linalg.norm(points[:, None, :] - positions[None, :, :], axis=-1)
+    assert np.allclose(distances, np.sort(brute, axis=1)[:, :5])
+    assert np.allclose(np.take_along_axis(brute, indices, axis=1), distances)
+
+
+def test_kdtree_fewer_points_than_neighbours():
+    positions = np.array([[0.0, 0.0], [1.0, 0.0]])
+    distances, indices = KDTree(positions).query([[0.1, 0.0]], k=3)
+    assert np.allclose(distances[0, :2], [0.1, 0.9])
+    assert np.isinf(distances[0, 2])
+    assert np.array_equal(indices[0], [0, 1, -1])
@@ -0,0 +1,121 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (c) 2022 Osyris contributors (https://github.com/nvaytet/osyris)
+import importlib
+import numpy as np
+from osyris import Array, Datagroup, Dataset, timeseries, units
+
+_timeseries = importlib.import_module('osyris.plot.timeseries')
+
+
+def _output(nout):
+    # A uniform 8x8x8 grid of cells, whose density grows with the output number
+    centers = (np.arange(8) + 0.5) / 8
+    xyz = np.array(np.meshgrid(centers, centers, centers,
+                               indexing='ij')).reshape(3, -1).T
+    ds = Dataset()
+    ds.meta['ndim'] = 3
+    ds['amr'] = Datagroup({
+        'xyz': Array(values=xyz, unit='cm'),
+        'dx': Array(values=np.full(len(xyz), 0.125), unit='cm')
+    })
+    ds['hydro'] = Datagroup(
+        {'density': Array(values=nout * (1.0 + xyz[:, 0]), unit='g/cm**3')})
+    return ds
+
+
+class _Recorder:
+    """
+    Replaces the frame writer, to record the frames instead of drawing them.
+    """
+    instances = []
+
+    def __init__(self, renderer_args, workers):
+        self.specs = renderer_args[0]
+        self.frames = []
+        _Recorder.instances.append(self)
+
+    def write(self, frame):
+        self.frames.append(frame)
+
+    def finish(self):
+        pass
+
+    def shutdown(self):
+        pass
+
+
+def test_timeseries_writes_frames(tmp_path, monkeypatch):
+    loaded = []
+
+    def load(nout, widths, **kwargs):
+        loaded.append((nout, widths))
+        return _output(nout)
+
+    monkeypatch.setattr(_timeseries, '_load', load)
+    origin = Array(values=np.array([[0.5, 0.5, 0.5]]), unit='cm')
+    frames = timeseries([1, 2, 3],
+                        'hydro/density',
+                        filename=str(tmp_path / 'frame_{:03d}.png'),
+                        dx=8.0 * units('mm'),
+                        dy=0.6,
+                        origin=origin,
+                        resolution=16)
+    assert frames == [str(tmp_path / 'frame_{:03d}.png'.format(i)) for i in range(3)]
+    assert all((tmp_path / 'frame_{:03d}.png'.format(i)).exists() for i in range(3))
+    assert [nout for nout, _ in loaded] == [1, 2, 3]
+    assert loaded[0][1] == [8.0 * units('mm'), 0.6]
+
+
+def test_timeseries_global_color_range(monkeypatch):
+    monkeypatch.setattr(_timeseries, '_load', lambda nout, **kwargs: _output(nout))
+    monkeypatch.setattr(_timeseries, '_FrameWriter', _Recorder)
+    _Recorder.instances.clear()
+    timeseries([1, 2, 3],
+               'hydro/density',
+               dx=1.0 * units('cm'),
+               origin=Array(values=np.array([[0.5, 0.5, 0.5]]), unit='cm'),
+               resolution=8)
+    writer, = _Recorder.instances
+    assert len(writer.frames) == 3
+    norm = writer.specs[0]['params']['norm']
+    minimum = min(frame['layers'][0].min() for frame in writer.frames)
+    maximum = max(frame['layers'][0].max() for frame in writer.frames)
+    assert np.isclose(norm.vmin, minimum)
+    assert np.isclose(norm.vmax, maximum)
+    assert np.isclose(norm.vmin, 1.0 + 1.0 / 16.0)
+    assert np.isclose(norm.vmax, 3.0 * (2.0 - 1.0 / 16.0))
+
+
+def test_timeseries_fixed_color_range(monkeypatch):
+    monkeypatch.setattr(_timeseries, '_load', lambda nout, **kwargs: _output(nout))
+    monkeypatch.setattr(_timeseries, '_FrameWriter', _Recorder)
+    _Recorder.instances.clear()
+    timeseries([1, 2],
+               'hydro/density',
+               dx=1.0 * units('cm'),
+               resolution=8,
+               vmin=0.5,
+               vmax=5.0)
+    writer, = _Recorder.instances
+    assert len(writer.frames) == 2
+    assert writer.specs[0]['params']['norm'].vmin == 0.5
+    assert writer.specs[0]['params']['norm'].vmax == 5.0
+
+
+def test_region_select_mixed_widths():
+    meta = {
+        'ndim': 3,
+        'unit_d': 1.0,
+        'unit_l': 1.0,
+        'unit_t': 1.0,
+        'scale': None,
+        'boxlen': 1.0,
+        'levelmin': 3
+    }
+    origin = Array(values=np.array([[0.5, 0.5, 0.5]]), unit='cm')
+    select = _timeseries._region_select(meta=meta,
+                                        origin=origin,
+                                        widths=[2.0 * units('mm'), 0.3])
+    x = Array(values=np.array([0.0, 0.4, 0.5, 0.6, 0.9, 1.0]), unit='cm')
+    # The half width is sqrt(3) * (0.6 * 0.3 + 0.5 * 0.125) = 0.42 cm
+    assert np.array_equal(select['x'](x), [False, True, True, True, True, False])
@@ -0,0 +1,116 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (c) 2022 Osyris contributors (https://github.com/nvaytet/osyris)
+import numpy as np
+import pytest
+import osyris
+from osyris import Camera, TransferFunction, units, volume_render
+
+
+def _uniform_box(values=None, n=8):
+    # A unit cube of n^3 cells, shuffled randomly
+    rng = np.random.default_rng(14)
+    centers = (np.arange(n) + 0.5) / n
+    xyz = np.array(np.meshgrid(centers, centers, centers,
+                               indexing='ij')).reshape(3, -1).T
+    xyz = xyz[rng.permutation(len(xyz))]
+    if values is None:
+        values = np.ones(len(xyz))
+    else:
+        values = values(xyz)
+    ds = osyris.Dataset()
+    ds.meta.update({'ndim': 3})
+    ds['amr'] = osyris.Datagroup({
+        'xyz':
+        osyris.Array(values=xyz, unit='cm'),
+        'dx':
+        osyris.Array(values=np.full(len(xyz), 1.0 / n), unit='cm')
+    })
+    ds['hydro'] = osyris.Datagroup({'density': osyris.Array(values=values, unit='')})
+    return ds
+
+
+def _camera(direction='z', width=1.0, depth=2.0):
+    return Camera(center=osyris.Array(values=np.array([[0.5, 0.5, 0.5]]), unit='cm'),
+                  width=width * units('cm'),
+                  depth=depth * units('cm'),
+                  direction=direction)
+
+
+@pytest.mark.parametrize("tau", [0.5, 1.5, 4.0])
+def test_volume_render_uniform_box_optical_depth(tau):
+    ds = _uniform_box()
+    transfer = TransferFunction(values=[0.0, 2.0],
+                                colors=['white', 'white'],
+                                opacities=tau)
+    image = volume_render(ds['hydro']['density'],
+                          _camera(),
+                          transfer,
+                          resolution=8,
+                          background=None,
+                          plot=False).layers[0]['data']
+    # Every ray crosses one unit of the depth of 2 of the camera
+    alpha = 1.0 - np.exp(-0.5 * tau)
+    assert np.allclose(image[..., 3], alpha, rtol=1.0e-5)
+    # The colors are premultiplied by the opacity
+    assert np.allclose(image[..., :3], alpha, rtol=1.0e-5)
+
+
+def test_volume_render_diagonal_ray():
+    ds = _uniform_box()
+    transfer = TransferFunction(values=[0.0, 2.0],
+                                colors=['white', 'white'],
+                                opacities=1.0)
+    # A single ray through the center of the cube, along its diagonal
+    image = volume_render(ds['hydro']['density'],
+                          _camera(direction=[1.0, 1.0, 1.0], width=0.01),
+                          transfer,
+                          resolution=1,
+                          background=None,
+                          plot=False).layers[0]['data']
+    assert np.isclose(image[0, 0, 3], 1.0 - np.exp(-0.5 * np.sqrt(3.0)), rtol=1.0e-5)
+
+
+def test_volume_render_compositing_order_and_background():
+    # The front half of the box (towards the viewer at +z) is red, the back is blue
+    ds = _uniform_box(values=lambda xyz: np.where(xyz[:, 2] > 0.5, 1.0, 2.0))
+    transfer = TransferFunction(values=[0.5, 1.5, 1.6, 2.5],
+                                colors=['red', 'red', 'blue', 'blue'],
+                                opacities=[1.0, 1.0, 3.0, 3.0])
+    image = volume_render(ds['hydro']['density'],
+                          _camera(),
+                          transfer,
+                          resolution=4,
+                          background='white',
+                          plot=False).layers[0]['data']
+    front = 1.0 - np.exp(-0.25)
+    back = (1.0 - front) * (1.0 - np.exp(-0.75))
+    rest = 1.0 - front - back
+    assert np.allclose(image[..., 0], front + rest, rtol=1.0e-5)
+    assert np.allclose(image[..., 1], rest, rtol=1.0e-5)
+    assert np.allclose(image[..., 2], back + rest, rtol=1.0e-5)
+    assert np.allclose(image[..., 3], 1.0)
+    # Values outside of the transfer function are transparent
+    ds['hydro']['density'] = osyris.Array(values=np.full(512, 5.0), unit='')
+    image = volume_render(ds['hydro']['density'],
+                          _camera(),
+                          transfer,
+                          resolution=4,
+                          background=None,
+                          plot=False).layers[0]['data']
+    assert np.all(image == 0.0)
+
+
+def test_volume_render_row_selection():
+    ds = _uniform_box(values=lambda xyz: np.where(xyz[:, 2] > 0.5, 1.0, 2.0))
+    transfer = TransferFunction(values=[0.0, 3.0],
+                                colors=['white', 'white'],
+                                opacities=1.0)
+    view = ds['hydro'][ds['hydro']['density'] > 1.5 * units('dimensionless')]
+    image = volume_render(view['density'],
+                          _camera(),
+                          transfer,
+                          resolution=4,
+                          background=None,
+                          plot=False).layers[0]['data']
+    # Only the back half of the box is selected
+    assert np.allclose(image[..., 3], 1.0 - np.exp(-0.25), rtol=1.0e-5)